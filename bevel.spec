@@ -41,6 +41,8 @@ rm -rf $RPM_BUILD_ROOT
 %defattr(-,root,root,-)
 %doc README.md LICENSE CHANGES.md
 %attr(0755,root,root) %{_bindir}/bevel
+%attr(0755,root,root) %{_bindir}/bevel-complete
+%attr(0755,root,root) %{_bindir}/bevel-run
 %{python_sitelib}/*
 
 %changelog
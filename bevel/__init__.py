@@ -1,27 +1,46 @@
 __version__ = '0.3.0'
 __author__ = 'Jon McKenzie <github.com/jcmcken>'
 
+# Only what's needed to resolve, run and complete commands is imported up
+# front; everything else (``subprocess``, ``optparse``, ``logging``, ``json``,
+# ...) is imported where it's used, since ``bevel`` starts on every keystroke.
 import os
-import copy
 import sys
-import optparse
 import re
 import shlex
-import logging
 import time
-import subprocess
+_IMPORT_STARTED = time.time()
 import errno
-import pprint
+import stat
 
-json = None
-for lib in ['json', 'simplejson']:
-    try:
-        json = __import__(lib)
-    except ImportError:
+try:
+    # the ``scandir`` backport reports each entry's type while listing a
+    # directory, which saves a ``stat`` per entry
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
+class _Log(object):
+    """
+    Stand-in for the ``bevel`` logger. Until ``enable_debug`` is called, every
+    logging call is a no-op: ``logging`` isn't imported and messages are never
+    formatted, so logging in the resolution predicates costs next to nothing.
+    """
+    def _ignore(self, msg, *args):
         pass
 
-LOG = logging.getLogger('bevel')
-LOG.setLevel(logging.CRITICAL)
+    debug = info = warn = warning = _ignore
+
+    def enable(self):
+        import logging
+        logging.basicConfig()
+        logger = logging.getLogger('bevel')
+        logger.setLevel(logging.DEBUG)
+        self.debug = logger.debug
+        self.info = logger.info
+        self.warn = self.warning = logger.warning
+
+LOG = _Log()
 
 _RE_VALID_COMMAND = '^[A-Za-z0-9]+(?:-[A-Za-z0-9]+)*$'
 RE_VALID_COMMAND = re.compile(_RE_VALID_COMMAND)
@@ -39,33 +58,189 @@ def all(iterable):
 
 class Bevel(object):
     DRIVER_NAME = '_driver'
+    # completes the arguments of the leaf commands in its directory (see
+    # ``bevel.providers``)
+    PROVIDER_NAME = '_complete'
+    # at most this many "did you mean" suggestions are offered, of the
+    # subcommands closest to what was typed (and at most this many edits away)
+    MAX_SUGGESTIONS = 3
+    MAX_SUGGESTION_DISTANCE = 2
 
-    def __init__(self, bin_dir, app_name=None):
-        self.bin_dir = bin_dir.rstrip('/')
-        self.name = app_name or os.path.basename(self.bin_dir)
+    def __init__(self, bin_dir, app_name=None, cache_dir=None, reindex=False,
+      usage_log=None, metrics=None, live=False, in_process=False, limits=None,
+      memoize=False, index_file=None):
+        # ``bin_dir`` may list several layers, highest first, separated like
+        # ``$PATH``; commands in higher layers override lower ones
+        self.layers = [ layer.rstrip('/') for layer in bin_dir.split(os.pathsep) ]
+        self.bin_dir = os.pathsep.join(self.layers)
+        # a packed app (see ``bevel.bundle``) rather than a directory
+        self.bundle = None
+        # where completion providers' candidates are cached (when ``None``,
+        # the default per-user cache directory)
+        self.cache_dir = cache_dir
+        self._provider_cache = None
+        if _is_file(self.bin_dir):
+            from bevel.bundle import Bundle
+            self.bundle = Bundle(self.bin_dir)
+            app_name = app_name or self.bundle.name
+        # a layered app is named after its base layer
+        self.name = app_name or os.path.basename(self.layers[-1])
         if not self._is_valid_name(self.name):
             raise InvalidBevel(self.bin_dir) 
+        self.clear_cache()
+        # a ``bevel.metrics.Metrics`` instance, if timings should be recorded
+        self.metrics = metrics
+        # whether scripts for this interpreter run in a fork of this process
+        self.in_process = in_process
+        # soft limits on commands' resource usage, as loaded by
+        # ``bevel.rusage.load_limits``
+        self.limits = limits
+        # whether leaf commands which opt in (see ``bevel.memo``) have their
+        # output reused; when not, their headers aren't read at all
+        self.memoize = memoize
+        self._output_cache = None
+        # held while a live tree is brought up to date (``thread`` rather
+        # than ``threading``, which is already loaded and cheaper)
+        import thread
+        self._sync_lock = thread.allocate_lock()
+        # when set, resolution and completion are answered from an index of
+        # the command tree rather than from the filesystem
+        self.tree = self.bundle
+        if self.tree is None and live and len(self.layers) == 1:
+            # an index that follows changes to the tree, where possible
+            from bevel.live import LiveIndex, available
+            if available():
+                self.tree = LiveIndex(self)
+        if self.tree is None and index_file is not None:
+            # a compact index built with ``--build-index``
+            from bevel.compact import load
+            self.tree = load(self, index_file)
+        if self.tree is None and cache_dir is not None:
+            from bevel.index import load_index
+            self.tree = load_index(self, cache_dir, rebuild=reindex)
+        if self.tree is None and len(self.layers) > 1:
+            # merge the layers once, up front, rather than on every lookup
+            from bevel.index import build_index
+            self.tree = build_index(self)
+        # when set, runs are recorded here and completions are ranked by
+        # how often they're used
+        self.usage = None
+        if usage_log is not None:
+            from bevel.completion import UsageLog
+            self.usage = UsageLog(usage_log)
+
+    def clear_cache(self):
+        """
+        Forget everything this instance has learned about the filesystem.
+        ``syscalls`` counts the ``stat``/``access``/directory listing calls
+        that have actually been made since.
+        """
+        self._kinds = {}
+        self._access = {}
+        self._tries = {}
+        self._suggesters = {}
+        self._bins = {}
+        self._pythons = {}
+        self._memo_ttls = {}
+        self.syscalls = 0
 
-    def _args_to_path(self, args):
-        result = os.path.join(self.bin_dir, os.path.sep.join(args)).rstrip('/')
-        LOG.debug("args %s corresponds to path '%s'" % (args, result))
+    def _kind(self, path):
+        """
+        The file type bits (``stat.S_IFMT``) of ``path`` (following symlinks),
+        or ``None`` if it doesn't exist
+        """
+        try:
+            return self._kinds[path]
+        except KeyError:
+            pass
+        self.syscalls += 1
+        try:
+            result = stat.S_IFMT(os.stat(path).st_mode)
+        except OSError:
+            result = None
+        self._kinds[path] = result
         return result
 
+    def _isdir(self, path):
+        return self._kind(path) == stat.S_IFDIR
+
+    def _isfile(self, path):
+        return self._kind(path) == stat.S_IFREG
+
+    def _can_run(self, path):
+        try:
+            return self._access[path]
+        except KeyError:
+            pass
+        self.syscalls += 1
+        result = self._access[path] = os.access(path, os.R_OK|os.X_OK)
+        return result
+
+    def _listdir(self, path):
+        """
+        List the entries of directory ``path``, remembering the type of each
+        entry when the platform reports it for free
+        """
+        self.syscalls += 1
+        if scandir is None:
+            return os.listdir(path)
+        names = []
+        for entry in scandir(path):
+            names.append(entry.name)
+            if not entry.is_symlink():
+                if entry.is_dir():
+                    self._kinds[entry.path] = stat.S_IFDIR
+                elif entry.is_file():
+                    self._kinds[entry.path] = stat.S_IFREG
+        return names
+
+    def _sync(self):
+        """
+        Catch up with any changes to a live tree, forgetting anything that
+        was memoized before them. Safe to call from several threads at once
+        (e.g. ``run_batch``'s workers), which take turns.
+        """
+        if self.tree is None:
+            return
+        self._sync_lock.acquire()
+        try:
+            if self.tree.update():
+                self.clear_cache()
+        finally:
+            self._sync_lock.release()
+
+    def _args_to_path(self, args, base=None):
+        result = os.path.join(base or self.bin_dir, os.path.sep.join(args)).rstrip('/')
+        LOG.debug("args %s corresponds to path '%s'", args, result)
+        return result
+
+    def _path_to_args(self, path):
+        """
+        The command path of a file within the tree (the reverse of
+        ``_args_to_path``)
+        """
+        base = self.bin_dir
+        for layer in self.layers:
+            if path.startswith(layer + os.path.sep):
+                base = layer
+                break
+        return path[len(base):].split(os.path.sep)[1:]
+
     def _get_bin(self, path):
         bin = None
-        if os.path.isdir(path):
+        if self._isdir(path):
             bin = os.path.join(path, self.DRIVER_NAME)
-        elif os.path.isfile(path):
+        elif self._isfile(path):
             bin = path
-        if bin and not os.path.isfile(bin):
+        if bin and not self._isfile(bin):
             bin = None
-        LOG.debug("command path '%s' corresponds to script '%s'" % (path, bin))
+        LOG.debug("command path '%s' corresponds to script '%s'", path, bin)
         return bin
 
     def _is_valid_name(self, command):
         # Is ``command`` a valid command name?
         result = bool(RE_VALID_COMMAND.match(command))
-        LOG.debug("'%s' is a valid command name? %s" % (command, result))
+        LOG.debug("'%s' is a valid command name? %s", command, result)
         return result
 
     def _args_are_valid(self, args):
@@ -75,13 +250,16 @@ class Bevel(object):
         return all(map(self._is_valid_name, args))
 
     def _subcommands(self, args):
+        if self.tree is not None:
+            self._sync()
+            return self.tree.subcommands(args)
         bin = self._args_to_bin(args)
         if not bin or not self._is_driver_file(bin):
             return []
 
         basedir = os.path.dirname(bin)
-        result = [ i for i in os.listdir(basedir) if self._appears_as_command(os.path.join(basedir, i)) ]
-        LOG.debug("subcommands for %s are %s" % (args, result))
+        result = [ i for i in self._listdir(basedir) if self._appears_as_command(os.path.join(basedir, i)) ]
+        LOG.debug("subcommands for %s are %s", args, result)
         result.sort()
         return result
 
@@ -95,49 +273,73 @@ class Bevel(object):
         """
         Whether a particular command directory has a driver file
         """
-        result = self._is_driver_file(os.path.join(path, self.DRIVER_NAME))
-        LOG.debug("path '%s' has a driver? %s" % (path, result))
+        result = self._isdir(path) and \
+            self._is_driver_file(os.path.join(path, self.DRIVER_NAME))
+        LOG.debug("path '%s' has a driver? %s", path, result)
         return result
 
     def _is_runnable(self, path):
         """
         Whether a particular path is a runnable script
         """
-        runnable = os.access(path, os.R_OK|os.X_OK) and os.path.isfile(path)
-        LOG.debug("script '%s' is runnable? %s" % (path, runnable))
+        runnable = self._isfile(path) and self._can_run(path)
+        LOG.debug("script '%s' is runnable? %s", path, runnable)
         return runnable
 
     def _is_regular_command(self, bin):
-        result = not self._is_driver_file(bin) and os.path.isfile(bin) and \
-            self._is_valid_name(os.path.basename(bin)) and \
-            self._has_driver(os.path.dirname(bin)) and self._is_runnable(bin)
-        LOG.debug("'%s' is a leaf command? %s" % (bin, result))
+        # a valid name is never a driver's, so check that first: it's free
+        result = self._is_valid_name(os.path.basename(bin)) and \
+            self._isfile(bin) and self._has_driver(os.path.dirname(bin)) and \
+            self._is_runnable(bin)
+        LOG.debug("'%s' is a leaf command? %s", bin, result)
         return result
 
     def _is_driver_command(self, path):
-        result = self._has_driver(path) and self._is_valid_name(os.path.basename(path))
-        LOG.debug("'%s' is a parent command? %s" % (path, result))
+        result = self._is_valid_name(os.path.basename(path)) and self._has_driver(path)
+        LOG.debug("'%s' is a parent command? %s", path, result)
         return result
         
     def _is_driver_file(self, bin):
         """
         Whether a particular path is command driver
         """
-        result = bin.endswith(os.path.sep + self.DRIVER_NAME) and \
-            self._is_runnable(bin) 
-        LOG.debug("'%s' is a driver script? %s" % (bin, result))
+        result = self._is_driver_path(bin) and self._is_runnable(bin) 
+        LOG.debug("'%s' is a driver script? %s", bin, result)
         return result
 
+    def _is_driver_path(self, bin):
+        """
+        Whether a particular path names a command driver (without checking
+        that it's runnable)
+        """
+        return bin.endswith(os.path.sep + self.DRIVER_NAME)
+
     def _args_to_bin(self, args):
         """
         Convert command-line arguments to a script path
         """
+        key = tuple(args)
+        try:
+            return self._bins[key]
+        except KeyError:
+            pass
         result = None
-        if self._args_are_valid(args):
+        if self.tree is not None:
+            node = self.tree.node(args)
+            if node is not None:
+                base = None
+                if len(self.layers) > 1:
+                    base = self.tree.layer(args)
+                result = self._args_to_path(args, base)
+                if node[0]:
+                    result = os.path.join(result, self.DRIVER_NAME)
+        elif self._args_are_valid(args):
             result = self._get_bin(self._args_to_path(args))
-        if result is not None and not self._is_runnable(result):
+        if result is not None and self.tree is None and \
+          not self._is_runnable(result):
             result = None
-        LOG.debug("converted args %s to valid script '%s'" % (args, result))
+        LOG.debug("converted args %s to valid script '%s'", args, result)
+        self._bins[key] = result
         return result
 
     def _resolve_args(self, args):
@@ -147,24 +349,25 @@ class Bevel(object):
         E.g. if ``baz`` is an invalid subcommand to ``foo bar``, then resolve
         ``foo bar`` so that you can automatically call usage 
         """
-        lookup_args = copy.copy(args)
+        self._sync()
+        lookup_args = list(args)
         remainder = []
         bin = None
         while lookup_args:
             candidate = self._args_to_bin(lookup_args)
-            LOG.debug('candidate script for %s is "%s"' % (args, candidate))
+            LOG.debug('candidate script for %s is "%s"', args, candidate)
             if candidate is not None:
-                LOG.debug('selecting candidate "%s"' % candidate)
+                LOG.debug('selecting candidate "%s"', candidate)
                 bin = candidate
                 break
-            LOG.debug('skipping candidate "%s"' % candidate)
+            LOG.debug('skipping candidate "%s"', candidate)
             remainder.append(lookup_args.pop(-1))
         if bin is None:
             bin = self._args_to_bin(lookup_args)
         # remainder args were populated backwards, so reverse them
         remainder.reverse()
         results = (bin, remainder)
-        LOG.debug('args %s resolve to script path "%s" with remainder args %s' % (args, results[0], results[1]))
+        LOG.debug('args %s resolve to script path "%s" with remainder args %s', args, results[0], results[1])
         return results
 
     def _parse_args(self, args):
@@ -172,56 +375,410 @@ class Bevel(object):
         Convert string arguments to an array
         """
         parsed = shlex.split(args)
-        LOG.debug('parsed "%s" as %s' % (args, parsed))
+        LOG.debug('parsed "%s" as %s', args, parsed)
         return parsed
 
-    def _run(self, script, args=[]):
+    def _run(self, script, args=[], use_exec=False, stdout=None):
         """
-        Run ``script`` with arguments ``args``
+        Run ``script`` with arguments ``args``, returning a
+        ``bevel.rusage.Result``: its exit code, and the resources it used. If
+        ``use_exec`` is true, the current process is replaced by ``script``
+        and this never returns.
         """
-        LOG.info("running script '%s' with args %s" % (script, args))
+        if stdout is None:
+            stdout = sys.stdout
+        if self.bundle is not None:
+            script = self._materialize(script)
+        LOG.info("running script '%s' with args %s", script, args)
         now = time.time()
         full_args = [script] + args
+        if self.in_process and self._is_this_python(script):
+            return self._run_in_process(script, args, use_exec, stdout, now)
+        if use_exec:
+            return self._exec(script, full_args, now)
+        import subprocess
+        from bevel.rusage import wait
         try:
-            proc = subprocess.Popen(full_args, close_fds=True, stdout=sys.stdout,
+            proc = subprocess.Popen(full_args, close_fds=True, stdout=stdout,
               stderr=sys.stderr)
-            proc.wait()
-            code = proc.returncode
+            # reap the child ourselves, so that its resource usage is known
+            proc.returncode, rusage = wait(proc.pid)
+        except OSError, e:
+            if e.errno == errno.ENOEXEC:
+                raise InternalError('could not determine subcommand runtime')
+            else: raise
+        return self._finished(proc.returncode, rusage, now)
+
+    def _finished(self, code, rusage, started):
+        from bevel.rusage import Result
+        result = Result(code, rusage, time.time() - started)
+        LOG.info("command finished in %3f seconds with return code %d, using %s",
+          result.elapsed, code, result.as_dict())
+        return result
+
+    def _materialize(self, script):
+        """
+        Write the bundled ``script`` out to the script cache, and return the
+        path of the copy
+        """
+        try:
+            return self.bundle.materialize(self._path_to_args(script))
+        except RuntimeError, e:
+            raise InternalError(e.args[0])
+
+    def _is_this_python(self, script):
+        try:
+            return self._pythons[script]
+        except KeyError:
+            from bevel.inprocess import is_this_python
+            result = self._pythons[script] = is_this_python(script)
+            return result
+
+    def _run_in_process(self, script, args, use_exec, stdout, started):
+        from bevel import inprocess
+        LOG.info("running script '%s' in a fork of this interpreter", script)
+        if use_exec and self.metrics is not None:
+            self.metrics.emit(execd=True)
+        code, rusage = inprocess.run(script, args, stdout, use_exec)
+        return self._finished(code, rusage, started)
+
+    def _exec(self, script, full_args, started):
+        LOG.info("replacing bevel with script '%s' after %3f seconds",
+          script, time.time() - started)
+        if self.metrics is not None:
+            self.metrics.emit(execd=True)
+        # the child inherits the real fds, so flush anything buffered and
+        # point 1/2 at whatever ``sys.stdout``/``sys.stderr`` currently are
+        for stream, fd in ((sys.stdout, 1), (sys.stderr, 2)):
+            stream.flush()
+            if stream.fileno() != fd:
+                os.dup2(stream.fileno(), fd)
+        try:
+            os.execv(script, full_args)
         except OSError, e:
             if e.errno == errno.ENOEXEC:
                 raise InternalError('could not determine subcommand runtime')
             else: raise
-        LOG.info("command finished in %3f seconds with return code %d" % ((time.time() - now), code))
+
+    def run(self, args, noop=False, use_exec=False):
+        if self.metrics is None:
+            return self._dispatch(args, noop, use_exec)
+        try:
+            code = self._dispatch(args, noop, use_exec, self.metrics)
+        except InternalError, e:
+            self.metrics.emit(exit_code=1, error=e.args[0])
+            raise
+        self.metrics.emit(exit_code=code or 0)
         return code
 
-    def run(self, args, noop=False):
+    def _dispatch(self, args, noop=False, use_exec=False, metrics=None, stdout=None):
+        """
+        Resolve and run ``args``, recording phase timings in ``metrics``
+        (if given) and sending output to ``stdout`` (``sys.stdout`` by default)
+        """
+        def lap(phase):
+            if metrics is not None:
+                metrics.lap(phase)
+        if stdout is None:
+            stdout = sys.stdout
         parsed_args = self._parse_args(args)
+        lap('parse')
         bin, remainder_args = self._resolve_args(parsed_args)
+        lap('resolve')
         # TODO: don't call bin with remainder args if command resolves
         #       fuzzily; just call ``self._run(bin)`` 
         code = None
         if bin is None:
             raise InternalError('could not resolve any valid, runnable scripts')
-        if self._is_driver_file(bin):
-            valid_subcommands = [ item for item in parsed_args if item not in remainder_args \
-              or remainder_args.remove(item) ]
+        valid_subcommands = parsed_args[:len(parsed_args) - len(remainder_args)]
+        if metrics is not None:
+            metrics.set(command=valid_subcommands)
+        if self.usage is not None and valid_subcommands and not noop:
+            self.usage.record(valid_subcommands)
+        # ``bin`` is already known to be runnable at this point
+        if self._is_driver_path(bin):
             command_str = ' '.join([self.name] + valid_subcommands)
             subcommands = self._subcommands(valid_subcommands)
             if not subcommands:
-                LOG.warn("command '%s' is a parent command, but has no subcommands" % args)
+                LOG.warn("command '%s' is a parent command, but has no subcommands", args)
             if self._is_empty(bin):
-                print self._default_usage(command_str, subcommands)
+                unknown = suggestions = None
+                if remainder_args:
+                    # a parent command only ends up with leftover arguments
+                    # when the next one isn't one of its subcommands
+                    unknown = remainder_args[0]
+                    suggestions = self._suggestions(valid_subcommands, unknown)
+                    if metrics is not None:
+                        metrics.set(unknown=unknown, suggestions=suggestions)
+                print >>stdout, self._default_usage(command_str, subcommands,
+                  unknown, suggestions)
+                lap('usage')
             else:
-                self._run(bin)
+                lap('usage')
+                self._accounted(valid_subcommands, metrics,
+                  self._run(bin, use_exec=use_exec, stdout=stdout))
+                lap('execute')
         elif not noop:
-            code = self._run(bin, remainder_args)
+            # ``BEVEL_NO_MEMOIZE`` bypasses the cache for a single call
+            # (read here, since a zygote worker takes on its client's
+            # environment)
+            ttl = self.memoize and not os.environ.get('BEVEL_NO_MEMOIZE') and \
+                self._memo_ttl(bin)
+            if ttl:
+                code = self._run_memoized(bin, remainder_args, ttl, stdout, metrics)
+            else:
+                code = self._run(bin, remainder_args, use_exec=use_exec, stdout=stdout)
+            self._accounted(valid_subcommands, metrics, code)
+            lap('execute')
         return code
 
-    def _default_usage(self, command_str, subcommands):
-        return """usage: %s <subcommand> [arguments] [options]
+    def _memo_ttl(self, script):
+        """
+        How long the output of the leaf command ``script`` may be reused, or
+        ``None`` if it doesn't opt in to that
+        """
+        try:
+            return self._memo_ttls[script]
+        except KeyError:
+            pass
+        from bevel.memo import MAX_HEADER
+        if self.bundle is not None:
+            header = self.bundle.read(self._path_to_args(script))[:MAX_HEADER]
+        else:
+            try:
+                fd = open(script, 'rb')
+                try:
+                    header = fd.read(MAX_HEADER)
+                finally:
+                    fd.close()
+            except IOError:
+                # running it will fail in the usual way
+                header = ''
+        result = None
+        if 'bevel-memoize:' in header:
+            from bevel.memo import declared_ttl
+            result = declared_ttl(header)
+        self._memo_ttls[script] = result
+        return result
+
+    def _run_memoized(self, script, args, ttl, stdout, metrics):
+        """
+        Run the leaf command ``script`` like ``_run``, unless its output for
+        ``args`` is still cached
+        """
+        started = time.time()
+        if self._output_cache is None:
+            from bevel.memo import OutputCache
+            self._output_cache = OutputCache(self._user_cache('output'))
+        if self.bundle is not None:
+            stamp = self.bundle.scripts[tuple(self._path_to_args(script))][3]
+        else:
+            stamp = repr(os.stat(script).st_mtime)
+        key = [os.path.abspath(script), stamp] + list(args)
+        def run(output):
+            return self._run(script, args, stdout=output)
+        result, hit = self._output_cache.call(key, ttl, run, stdout)
+        if metrics is not None:
+            metrics.set(memoized=hit and 'hit' or 'miss')
+        if hit:
+            LOG.info("reusing the output of script '%s' with args %s", script, args)
+            result = self._finished(result, None, started)
+        return result
+
+    def _user_cache(self, name):
+        """
+        The path of the per-user cache ``name``
+        """
+        cache_dir = self.cache_dir
+        if cache_dir is None:
+            from bevel.index import default_cache_dir
+            cache_dir = default_cache_dir()
+        return os.path.join(cache_dir, name)
+
+    def _accounted(self, command, metrics, result):
+        """
+        Record the resources a command used, and warn about any soft limits
+        it exceeded
+        """
+        if metrics is not None:
+            metrics.set(rusage=result.as_dict())
+        if not self.limits:
+            return
+        from bevel.rusage import exceeded
+        for name, value, limit in exceeded(self.limits, command, result):
+            sys.stderr.write("%s: warning: '%s' exceeded its soft limit on %s "
+              "(%s > %s)\n" % (self.name, ' '.join([self.name] + command), name,
+              value, limit))
+
+    def _run_line(self, item):
+        number, line = item
+        now = time.time()
+        result = {'line': number, 'args': line}
+        try:
+            result['exit_code'] = self._dispatch(line, stdout=sys.stderr) or 0
+        except (InternalError, ValueError), e:
+            # ``ValueError`` is what ``shlex`` raises on unbalanced quotes
+            result['exit_code'] = None
+            result['error'] = str(e)
+        except EnvironmentError, e:
+            # the command resolved, but couldn't be started (e.g. its
+            # interpreter is missing), which only fails this line
+            result['exit_code'] = 1
+            result['error'] = str(e)
+        result['elapsed'] = round(time.time() - now, 6)
+        return result
+
+    def run_batch(self, lines, stream, jobs=1):
+        """
+        Run each command line in ``lines`` (skipping blank lines and
+        ``#`` comments), up to ``jobs`` at once, writing a newline-delimited
+        JSON record of each line's exit code and timing to ``stream`` as it
+        finishes, followed by a summary record. Commands' own output goes to
+        ``sys.stderr``, so that ``stream`` only has records on it.
+
+        Returns 0 if every command succeeded, 2 if any line couldn't be run
+        at all, and 1 otherwise.
+        """
+        from bevel.pool import imap_unordered
+        json = _import_json()
+        if json:
+            dumps = json.dumps
+        else:
+            dumps = repr
+
+        def numbered():
+            number = 0
+            for line in lines:
+                number += 1
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    yield number, line
+
+        counts = {'lines': 0, 'failed': 0, 'errors': 0}
+        now = time.time()
+        for result in imap_unordered(self._run_line, numbered(), jobs):
+            counts['lines'] += 1
+            if result['exit_code'] is None:
+                counts['errors'] += 1
+            elif result['exit_code'] != 0:
+                counts['failed'] += 1
+            stream.write(dumps(result) + '\n')
+            stream.flush()
+        summary = {'type': 'summary', 'elapsed': round(time.time() - now, 6)}
+        summary.update(counts)
+        stream.write(dumps(summary) + '\n')
+        stream.flush()
+        if counts['errors']:
+            return 2
+        return counts['failed'] and 1 or 0
+
+    def fan_out(self, args, targets, jobs=1, timeout=None, fail_fast=False,
+      stdout=None, stderr=None):
+        """
+        Run the leaf command ``args`` once for each of ``targets``, up to
+        ``jobs`` at once, with each target split into arguments and appended
+        to the command's. Every line of output is prefixed with its target,
+        and a summary is written to ``stderr`` at the end. Returns 0 if every
+        run succeeded, and 1 otherwise.
+        """
+        from bevel import fanout
+        if stderr is None:
+            stderr = sys.stderr
+        parsed_args = self._parse_args(args)
+        bin, remainder_args = self._resolve_args(parsed_args)
+        if bin is None:
+            raise InternalError('could not resolve any valid, runnable scripts')
+        if self._is_driver_path(bin):
+            raise InternalError("'%s' is a parent command; can only fan out leaf commands" %
+              ' '.join([self.name] + parsed_args[:len(parsed_args) - len(remainder_args)]))
+        if self.bundle is not None:
+            bin = self._materialize(bin)
+        commands = [ (target, [bin] + remainder_args + shlex.split(target))
+                     for target in targets ]
+        now = time.time()
+        try:
+            results = fanout.run(commands, jobs, timeout, fail_fast, stdout, stderr)
+        except OSError, e:
+            if e.errno == errno.ENOEXEC:
+                raise InternalError('could not determine subcommand runtime')
+            else: raise
+        failed = [ result for result in results
+                   if result['timed_out'] or result['exit_code'] != 0 ]
+        for result in failed:
+            if result['timed_out']:
+                reason = 'timed out'
+            else:
+                reason = 'exited with status %d' % result['exit_code']
+            stderr.write('%s: %s %s\n' % (self.name, result['target'], reason))
+        stderr.write('%s: %s in %.2f seconds\n' % (self.name,
+          fanout.summarize(results, len(commands) - len(results)), time.time() - now))
+        stderr.flush()
+        return (failed or len(results) < len(commands)) and 1 or 0
+
+    def _default_usage(self, command_str, subcommands, unknown=None,
+      suggestions=None):
+        result = """usage: %s <subcommand> [arguments] [options]
 
 Valid subcommands are: %s
 """ % (command_str, ', '.join(subcommands))
+        if suggestions:
+            result += "\nUnknown subcommand '%s'; did you mean: %s?\n" % (
+              unknown, ', '.join(suggestions))
+        return result
+
+    def _suggestions(self, args, word):
+        """
+        The subcommands of ``args`` closest to the mistyped ``word``, at most
+        ``MAX_SUGGESTIONS`` of them
+        """
+        # allow roughly one typo per three characters, but never so many
+        # that the whole word could be replaced
+        limit = min(max(1, len(word) // 3), len(word) - 1,
+                    self.MAX_SUGGESTION_DISTANCE)
+        index = self._suggestion_index(args)
+        # nearer searches are cheaper, so stop at the first distance which
+        # has any matches
+        for distance in range(1, limit + 1):
+            matches = index.search(word, distance)
+            if matches:
+                return [ name for found, name in matches[:self.MAX_SUGGESTIONS]
+                         if found == matches[0][0] ]
+        return []
+
+    def _suggestion_index(self, args):
+        """
+        A (cached) index of the subcommands of ``args`` by edit distance
+        """
+        key = tuple(args)
+        try:
+            return self._suggesters[key]
+        except KeyError:
+            pass
+        if self.cache_dir is None:
+            from bevel.completion import SuggestionIndex
+            result = SuggestionIndex(self._subcommands(args),
+              self.MAX_SUGGESTION_DISTANCE)
+        else:
+            from bevel.completion import load_suggestion_index
+            result = load_suggestion_index(self, self.cache_dir, args)
+        self._suggesters[key] = result
+        return result
+
+    def suggest(self, args):
+        """
+        Resolve the command line ``args``, and if it names an unknown
+        subcommand of a parent command, suggest the closest valid ones.
+        Returns a dict of the resolved ``command``, the ``unknown`` argument
+        (or ``None``) and the ``suggestions``.
+        """
+        parsed_args = self._parse_args(args)
+        bin, remainder_args = self._resolve_args(parsed_args)
+        command = parsed_args[:len(parsed_args) - len(remainder_args)]
+        result = {'command': command, 'unknown': None, 'suggestions': []}
+        if bin is not None and remainder_args and self._is_driver_path(bin):
+            result['unknown'] = remainder_args[0]
+            result['suggestions'] = self._suggestions(command, remainder_args[0])
+        return result
 
     def _parse_completion_args(self, args):
         parsed_args = self._parse_args(args)
@@ -229,24 +786,32 @@ Valid subcommands are: %s
             parsed_args.append('')
         return parsed_args
 
-    def _get_completion_args(self):
-        comp_line = self._get_comp_line() or ''
+    def _get_completion_args(self, comp_line=None):
+        if comp_line is None:
+            comp_line = self._get_comp_line() or ''
         parsed_args = self._parse_completion_args(comp_line)
-        parsed_args.pop(0)
+        # drop the name of the app itself
+        parsed_args[0:1] = []
         return parsed_args
 
     def _get_comp_line(self):
         result = os.environ.get('COMP_LINE') or os.environ.get('COMMAND_LINE')
-        LOG.debug('COMP_LINE is "%s"' % result)
+        LOG.debug('COMP_LINE is "%s"', result)
         return result
 
     def _in_completion(self):
         return bool(self._get_comp_line())
 
     def _is_empty(self, path):
+        if self.tree is not None and self._is_driver_path(path):
+            args = self._path_to_args(path)[:-1]
+            node = self.tree.node(args)
+            if node is not None:
+                return node[1]
         return not bool(open(path).readline().strip())
 
     def _complete(self, args=[]):
+        self._sync()
         if self._in_completion():
             args = self._get_completion_args()
 
@@ -257,70 +822,278 @@ Valid subcommands are: %s
             parent = []
             last = None
 
-        parent_subcommands = self._subcommands(parent)
-        subcommands = self._subcommands(args)
-        
-        command_matches = [ i for i in parent_subcommands if last is not None and i.startswith(last) ]
+        base = parent
+        result = []
+        if last is not None:
+            result = self._starting_with(parent, last)
 
-        if command_matches:
-            result = command_matches
-        elif not args:
-            result = subcommands
-        else:
-            result = [ i for i in subcommands if i.startswith(args[-1]) ]
-        LOG.debug("completions for %s are %s" % (args, result))
+        if not result:
+            base = args
+            if not args:
+                result = self._subcommands(args)
+            else:
+                result = self._starting_with(args, args[-1])
+        if not result and last is not None:
+            result = self._provided(parent, last)
+            LOG.debug("provided completions for %s are %s", args, result)
+            return result
+        if self.usage is not None:
+            result = self.usage.rank(base, result)
+        LOG.debug("completions for %s are %s", args, result)
         return result
 
+    def _starting_with(self, args, prefix):
+        """
+        The subcommands of ``args`` which start with ``prefix``
+        """
+        key = tuple(args)
+        trie = self._tries.get(key, False)
+        if trie is False:
+            # building a prefix tree costs far more than scanning once, so
+            # only an instance completing beneath ``args`` again (e.g. the
+            # completion server) builds one
+            self._tries[key] = None
+            return [ name for name in self._subcommands(args) if name.startswith(prefix) ]
+        if trie is None:
+            from bevel.completion import Trie
+            trie = self._tries[key] = Trie(self._subcommands(args))
+        return trie.startswith(prefix)
+
+    def _provider(self, args):
+        """
+        The completion provider for the arguments of the leaf command which
+        ``args`` starts with: the one in its directory, or else in the
+        closest parent directory. ``None`` if there isn't one (or ``args``
+        isn't a leaf command).
+        """
+        if self.bundle is not None:
+            return None
+        bin, remainder = self._resolve_args(args)
+        if bin is None or self._is_driver_path(bin):
+            return None
+        command = args[:len(args) - len(remainder)]
+        for i in range(len(command) - 1, -1, -1):
+            for layer in self.layers:
+                path = os.path.join(self._args_to_path(command[:i], layer),
+                  self.PROVIDER_NAME)
+                if self._is_runnable(path):
+                    return path
+        return None
+
+    def _provided(self, args, word):
+        """
+        The candidates for the argument ``word`` after ``args``, from the
+        leaf command's completion provider
+        """
+        provider = self._provider(args)
+        if provider is None:
+            return []
+        from bevel import providers
+        if self._provider_cache is None:
+            self._provider_cache = providers.ProviderCache(
+              self._user_cache('completions'))
+        candidates = providers.complete(provider, args, self._provider_cache)
+        return [ candidate for candidate in candidates if candidate.startswith(word) ]
+
     def complete(self, args=[]):
         return self._complete(self._parse_completion_args(args))
 
-    def _verify(self):
+    def complete_line(self, comp_line):
+        """
+        Complete a full command line, as bash would pass it in ``COMP_LINE``
+        """
+        return self._complete(self._get_completion_args(comp_line))
+
+    def _verify_targets(self):
+        """
+        Every directory and file in the tree, as ``(type, path)`` pairs. In a
+        layered tree, files which are overridden by a higher layer (and
+        anything beneath them) are skipped.
+        """
+        # paths (relative to their layer) of the layers walked so far
+        files = set()
+        dirs = set()
+        for layer in self.layers:
+            layer_files = []
+            layer_dirs = []
+            for basedir, subdirs, names in os.walk(layer):
+                rel = basedir[len(layer) + 1:]
+                for dir in list(subdirs):
+                    path = os.path.join(rel, dir)
+                    if path in files:
+                        subdirs.remove(dir)
+                        continue
+                    layer_dirs.append(path)
+                    yield 'directory', os.path.join(basedir, dir)
+                for file in names:
+                    path = os.path.join(rel, file)
+                    if path in files or path in dirs:
+                        continue
+                    layer_files.append(path)
+                    yield 'file', os.path.join(basedir, file)
+            files.update(layer_files)
+            dirs.update(layer_dirs)
+
+    def _check(self, target):
+        """
+        Check a single ``(type, path)`` pair from ``_verify_targets``,
+        returning the pair along with a list of its problems. This runs on
+        worker threads, so it deliberately bypasses the instance's caches.
+        """
+        type, fullname = target
+        bad = []
+        def problem(reason):
+            bad.append({'type': type, 'reason': reason, 'name': fullname})
+
+        readable = os.access(fullname, os.R_OK|os.X_OK)
+        if type == 'directory':
+            if not readable:
+                problem('could not read or execute')
+            return target, bad
+
+        isfile = os.path.isfile(fullname)
+        if not (readable and isfile):
+            problem('could not read or execute')
+        # only read the first two bytes of regular files, since e.g. a FIFO
+        # would block
+        shebang = None
+        if isfile:
+            try:
+                fd = open(fullname, 'rb')
+                try:
+                    shebang = fd.read(2)
+                finally:
+                    fd.close()
+            except IOError:
+                pass
+        if shebang is not None and shebang != '#!':
+            problem('missing shebang')
+        return target, bad
+
+    def _iter_verify(self, jobs=1, counts=None):
+        """
+        Yield problems with the tree as soon as they're found, checking up to
+        ``jobs`` paths at once. If ``counts`` is given, it's updated with the
+        number of directories and files checked so far.
+        """
+        from bevel.pool import imap_unordered
+        if counts is None:
+            counts = {}
+        counts.setdefault('directory', 0)
+        counts.setdefault('file', 0)
+        for target, bad in imap_unordered(self._check, self._verify_targets(), jobs):
+            counts[target[0]] += 1
+            for item in bad:
+                yield item
+
+    def _verify(self, jobs=1, max_problems=None):
         bad = []
-        for basedir, dirs, files in os.walk(self.bin_dir):
-            for dir in dirs:
-                fullname = os.path.join(basedir, dir)
-                if not os.access(fullname, os.R_OK|os.X_OK):
-                    bad.append({
-                        'type': 'directory', 
-                        'reason': 'could not read or execute',
-                        'name': fullname,
-                    })
-            for file in files:
-                fullname = os.path.join(basedir, file)
-                if not self._is_runnable(fullname):
-                    bad.append({
-                        'type': 'file', 
-                        'reason': 'could not read or execute',
-                        'name': fullname,
-                    })
-                if not open(fullname, 'r').readline().startswith('#!'):
-                    bad.append({
-                        'type': 'file', 
-                        'reason': 'missing shebang',
-                        'name': fullname,
-                    })
+        problems = self._iter_verify(jobs)
+        try:
+            for item in problems:
+                if max_problems is not None and len(bad) >= max_problems:
+                    break
+                bad.append(item)
+        finally:
+            problems.close()
         return bad
 
-    def verify(self):
-        data = self._verify()
+    def verify(self, jobs=1, max_problems=None):
+        data = self._verify(jobs, max_problems)
+        json = _import_json()
         if json:
             result = json.dumps(data, indent=2)
         else:
+            import pprint
             result = pprint.pformat(data)
         return result
 
+    def verify_stream(self, stream, jobs=1, max_problems=None):
+        """
+        Write problems to ``stream`` as newline-delimited JSON as soon as
+        they're found, followed by a summary record. Returns the number of
+        problems found.
+        """
+        json = _import_json()
+        if json:
+            dumps = json.dumps
+        else:
+            dumps = repr
+        counts = {}
+        found = 0
+        truncated = False
+        now = time.time()
+        problems = self._iter_verify(jobs, counts)
+        try:
+            for item in problems:
+                if max_problems is not None and found >= max_problems:
+                    truncated = True
+                    break
+                found += 1
+                stream.write(dumps(item) + '\n')
+                stream.flush()
+            elapsed = time.time() - now
+        finally:
+            problems.close()
+        stream.write(dumps({
+            'type': 'summary',
+            'directories': counts['directory'],
+            'files': counts['file'],
+            'problems': found,
+            'truncated': truncated,
+            'elapsed': round(elapsed, 6),
+        }) + '\n')
+        stream.flush()
+        return found
+
+def _is_file(path):
+    try:
+        return stat.S_ISREG(os.stat(path).st_mode)
+    except OSError:
+        return False
+
+def _import_json():
+    for lib in ['json', 'simplejson']:
+        try:
+            return __import__(lib)
+        except ImportError:
+            pass
+    return None
+
+def _open_input(path):
+    if path == '-':
+        return sys.stdin
+    return open(path)
+
 def enable_debug():
-    logging.basicConfig()
-    LOG.setLevel(logging.DEBUG)
+    LOG.enable()
 
 def create_cli():
+    import optparse
     cli = optparse.OptionParser(prog='bevel')
     cli.add_option('-a', '--args', default="",
         help="Arguments as passed from your CLI application")
     cli.add_option('-b', '--bindir',
-        help="The directory location of your `bevel' scripts")
+        help="The directory location of your `bevel' scripts, or a bundle made with --pack. "
+             "Several directories may be layered, highest first, separated by `%s'" % os.pathsep)
     cli.add_option('-c', '--complete', action='store_true',
         help="Instead of running your `bevel' app, just autocomplete the last subcommand.")
+    cli.add_option('--complete-server', action='store_true',
+        help="Run a resident completion server for BINDIR (see `bevel-complete').")
+    cli.add_option('--zygote', action='store_true',
+        help="Run a resident server which runs commands in BINDIR in forks of "
+             "itself, for `bevel-run'.")
+    cli.add_option('--emit-completion', type='choice', choices=['bash', 'zsh'],
+        metavar='SHELL',
+        help="Print a static completion script for BINDIR for SHELL (bash or "
+             "zsh), which completes without running bevel.")
+    cli.add_option('--compile', action='store_true',
+        help="Print a standalone POSIX sh script which dispatches commands in "
+             "BINDIR the same way bevel does, without running bevel.")
+    cli.add_option('--suggest', action='store_true',
+        help="Instead of running your `bevel' app, print (as JSON) the command "
+             "--args resolves to, any unknown subcommand and the closest valid "
+             "ones.")
     cli.add_option('-n', '--noop', action='store_true',
         help="Do everything normally, except don't run any scripts.")
     cli.add_option('-d', '--debug', action='store_true',
@@ -329,27 +1102,304 @@ def create_cli():
         help="Verify that your `bevel' commands are properly set up and configured."
              " This option is for development purposes. Returns a data structure "
              "containing all of the directories or files that may be incorrect.")
+    cli.add_option('--pack', metavar='FILE',
+        help="Check the bin directory like --verify, and pack it into a "
+             "single-file bundle, which can be passed to --bindir instead")
+    cli.add_option('--stream', action='store_true',
+        help="With --verify, print each problem as a line of JSON as soon as "
+             "it's found, followed by a summary line.")
+    cli.add_option('--batch', metavar='FILE',
+        help="Run each command line in FILE ('-' for stdin), writing each "
+             "one's exit code and timing to stdout as JSON")
+    cli.add_option('--fan-out', metavar='FILE',
+        help="Run the command in --args once for each target (a line of extra "
+             "arguments) in FILE ('-' for stdin), prefixing its output with the "
+             "target")
+    cli.add_option('--timeout', type='float', metavar='SECONDS',
+        help="With --fan-out, kill any run that takes longer than this")
+    cli.add_option('--fail-fast', action='store_true', default=False,
+        help="With --fan-out, stop everything after the first failure "
+             "(by default, every target is run regardless)")
+    cli.add_option('-j', '--jobs', type='int', default=1,
+        help="How many checks (with --verify) or commands (with --batch or "
+             "--fan-out) to run at once (default: 1)")
+    cli.add_option('--max-problems', type='int',
+        help="With --verify, stop after this many problems")
+    cli.add_option('-r', '--rank', action='store_true',
+        help="Record how often each command is run, and list the most used "
+             "completions first.")
+    cli.add_option('-m', '--metrics', metavar='SINK',
+        help="Write timing metrics for each invocation to SINK: a file path, "
+             "unix:PATH for a datagram socket or fd:N for a file descriptor. "
+             "Defaults to $BEVEL_METRICS.")
     cli.add_option('-N', '--app-name', 
         help="Override the default app name (which is the basename of BINDIR)")
+    cli.add_option('-P', '--in-process', action='store_true',
+        help="Run Python scripts written for the interpreter bevel is "
+             "running on in a fork of bevel, instead of starting another "
+             "interpreter")
+    cli.add_option('--limits', metavar='FILE',
+        help="Warn when a command uses more resources than the soft limits "
+             "in FILE (JSON mapping commands to e.g. {\"cpu\": 2, \"maxrss\": 524288})")
+    cli.add_option('--memoize', action='store_true',
+        help="Reuse the output of leaf commands which declare that it may be "
+             "reused (with a `# bevel-memoize: SECONDS' header)")
+    cli.add_option('--no-memoize', action='store_true',
+        help="Always run leaf commands (overrides --memoize; so does setting "
+             "BEVEL_NO_MEMOIZE)")
+    cli.add_option('-x', '--exec', action='store_true', dest='use_exec',
+        help="Replace the bevel process with the resolved script instead of "
+             "running it as a child process.")
+    cli.add_option('-i', '--index', action='store_true',
+        help="Resolve and complete commands from a cached index of BINDIR "
+             "instead of checking the filesystem on every invocation.")
+    cli.add_option('--cache-dir',
+        help="Where to keep the command index (implies --index). Defaults to "
+             "$BEVEL_CACHE_DIR, or $XDG_CACHE_HOME/bevel")
+    cli.add_option('--build-index', metavar='FILE',
+        help="Write a compact binary index of BINDIR to FILE, for --index-file")
+    cli.add_option('--index-file', metavar='FILE',
+        help="Resolve and complete commands from the compact index FILE (made "
+             "with --build-index) instead of checking the filesystem")
+    cli.add_option('--check-index', action='store_true',
+        help="With --index-file, exit with 1 if the index no longer matches "
+             "BINDIR")
+    cli.add_option('--reindex', action='store_true',
+        help="Rebuild the command index even if it appears up to date "
+             "(implies --index)")
     return cli
 
+# Options understood by ``_fast_parse``, mapped to ``(dest, takes_value)``.
+# These must stay in sync with ``create_cli``.
+_FAST_OPTIONS = {
+    '-a': ('args', True), '--args': ('args', True),
+    '-b': ('bindir', True), '--bindir': ('bindir', True),
+    '-N': ('app_name', True), '--app-name': ('app_name', True),
+    '--cache-dir': ('cache_dir', True),
+    '--index-file': ('index_file', True),
+    '-c': ('complete', False), '--complete': ('complete', False),
+    '--complete-server': ('complete_server', False),
+    '-n': ('noop', False), '--noop': ('noop', False),
+    '-d': ('debug', False), '--debug': ('debug', False),
+    '-V': ('verify', False), '--verify': ('verify', False),
+    '-x': ('use_exec', False), '--exec': ('use_exec', False),
+    '-P': ('in_process', False), '--in-process': ('in_process', False),
+    '-i': ('index', False), '--index': ('index', False),
+    '--reindex': ('reindex', False),
+    '--memoize': ('memoize', False),
+    '--no-memoize': ('no_memoize', False),
+    '-r': ('rank', False), '--rank': ('rank', False),
+    '-m': ('metrics', True), '--metrics': ('metrics', True),
+}
+_FAST_DEFAULTS = {
+    'args': '', 'bindir': None, 'app_name': None, 'cache_dir': None,
+    'complete': None, 'complete_server': None, 'noop': None, 'debug': None,
+    'verify': None, 'use_exec': None, 'index': None, 'reindex': None,
+    'in_process': None, 'emit_completion': None, 'compile': None, 'stream': None,
+    'jobs': 1, 'max_problems': None, 'rank': None, 'metrics': None, 'batch': None,
+    'fan_out': None, 'timeout': None, 'fail_fast': False, 'limits': None,
+    'pack': None, 'suggest': None, 'zygote': None, 'memoize': None,
+    'no_memoize': None,
+    'build_index': None, 'index_file': None, 'check_index': None,
+}
+
+class _Options(object):
+    def __init__(self, values):
+        self.__dict__.update(values)
+
+def _fast_parse(argv):
+    """
+    Parse the common, simple forms of ``bevel``'s options without building
+    the ``optparse`` parser. Returns ``None`` for anything else (``--help``,
+    bundled short options, abbreviations, errors, ...), which is then left to
+    ``optparse``.
+    """
+    values = dict(_FAST_DEFAULTS)
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        i += 1
+        if not arg.startswith('-') or arg == '-':
+            # positional arguments (e.g. from ``complete -C``) are ignored
+            continue
+        value = None
+        if arg.startswith('--') and '=' in arg:
+            arg, value = arg.split('=', 1)
+        if arg not in _FAST_OPTIONS:
+            return None
+        dest, takes_value = _FAST_OPTIONS[arg]
+        if takes_value:
+            if value is None:
+                if i >= len(argv):
+                    return None
+                value = argv[i]
+                i += 1
+            values[dest] = value
+        elif value is not None:
+            return None
+        else:
+            values[dest] = True
+    return _Options(values)
+
 def main(argv=None):
-    cli = create_cli()
-    opts, args = cli.parse_args(argv)
+    started = time.time()
+    if argv is None:
+        argv = sys.argv[1:]
+    opts = _fast_parse(argv)
+    if opts is None:
+        opts, args = create_cli().parse_args(argv)
+
+    def error(msg):
+        create_cli().error(msg)
 
     if opts.debug or os.environ.get('BEVEL_DEBUG'):
         enable_debug()
 
     if not opts.bindir:
-        cli.error('must pass bin directory (-b/--bindir)')
+        error('must pass bin directory (-b/--bindir)')
+
+    for layer in opts.bindir.split(os.pathsep):
+        if not os.path.isdir(layer) and not os.path.isfile(opts.bindir):
+            error('no such directory or bundle "%s"' % layer)
+    if os.path.isfile(opts.bindir):
+        for name in ('verify', 'complete_server', 'compile', 'emit_completion', 'pack',
+                     'build_index', 'index_file'):
+            if getattr(opts, name):
+                error('--%s needs a bin directory, not a bundle' % name.replace('_', '-'))
+
+    cache_dir = opts.cache_dir or os.environ.get('BEVEL_CACHE_DIR')
+    if (opts.index or opts.reindex) and not cache_dir:
+        from bevel.index import default_cache_dir
+        cache_dir = default_cache_dir()
 
-    if not os.path.isdir(opts.bindir):
-        cli.error('no such directory "%s"' % opts.bindir)
+    usage_log = None
+    if opts.rank:
+        from bevel.index import default_cache_dir, cache_file
+        usage_log = cache_file(opts.bindir, cache_dir or default_cache_dir(), 'usage')
 
-    app = Bevel(opts.bindir, app_name=opts.app_name)
+    metrics = None
+    sink = opts.metrics or os.environ.get('BEVEL_METRICS')
+    if sink:
+        from bevel.metrics import Metrics
+        metrics = Metrics(sink)
+        metrics.started = metrics.last = started
+        metrics.phases['import'] = _IMPORT_FINISHED - _IMPORT_STARTED
+
+    limits = None
+    if opts.limits:
+        from bevel.rusage import load_limits
+        try:
+            limits = load_limits(opts.limits)
+        except (IOError, ValueError), e:
+            error('could not read limits from "%s": %s' % (opts.limits, e))
+
+    if opts.zygote:
+        # workers run in their clients' working directories
+        opts.bindir = os.pathsep.join([ os.path.abspath(layer)
+                                        for layer in opts.bindir.split(os.pathsep) ])
+
+    # long-running modes follow changes to the tree as they happen
+    live = bool(opts.batch or opts.complete_server or opts.zygote)
+    if opts.check_index and not opts.index_file:
+        error('--check-index needs --index-file')
+    try:
+        app = Bevel(opts.bindir, app_name=opts.app_name, cache_dir=cache_dir,
+            reindex=opts.reindex, usage_log=usage_log, metrics=metrics, live=live,
+            in_process=opts.in_process, limits=limits,
+            memoize=bool(opts.memoize and not opts.no_memoize),
+            index_file=opts.index_file)
+    except (IOError, ValueError), e:
+        if not opts.index_file or isinstance(e, InvalidBevel):
+            raise
+        error('could not use index "%s": %s' % (opts.index_file, e))
+    if metrics is not None:
+        metrics.set(app=app.name)
+        metrics.lap('startup')
 
     if opts.verify:
-        print app.verify()
+        if opts.stream:
+            app.verify_stream(sys.stdout, opts.jobs, opts.max_problems)
+        else:
+            print app.verify(opts.jobs, opts.max_problems)
+        raise SystemExit
+
+    if opts.build_index:
+        from bevel.compact import write
+        from bevel.index import build_index
+        write(build_index(app), opts.build_index)
+        raise SystemExit
+
+    if opts.check_index:
+        if not app.tree.is_current(app):
+            sys.stderr.write("%s: index \"%s\" is out of date\n" % (app.name,
+              opts.index_file))
+            raise SystemExit(1)
+        raise SystemExit
+
+    if opts.pack:
+        from bevel.bundle import pack
+        problems = pack(app, opts.pack)
+        for problem in problems:
+            sys.stderr.write("%s: cannot pack %s '%s': %s\n" % (app.name,
+              problem['type'], problem['name'], problem['reason']))
+        raise SystemExit(problems and 1 or 0)
+
+    if opts.complete_server:
+        from bevel.server import serve_completions
+        serve_completions(app)
+        raise SystemExit
+
+    if opts.zygote:
+        from bevel.zygote import serve_runs
+        try:
+            serve_runs(app)
+        except RuntimeError, e:
+            error(e.args[0])
+        raise SystemExit
+
+    if opts.compile:
+        from bevel.shell import compile_dispatcher
+        sys.stdout.write(compile_dispatcher(app))
+        raise SystemExit
+
+    if opts.emit_completion:
+        from bevel.shell import emit_completion
+        sys.stdout.write(emit_completion(app, opts.emit_completion))
+        raise SystemExit
+
+    if opts.batch:
+        fd = _open_input(opts.batch)
+        try:
+            returncode = app.run_batch(fd, sys.stdout, opts.jobs)
+        finally:
+            if fd is not sys.stdin:
+                fd.close()
+        if metrics is not None:
+            metrics.emit(exit_code=returncode, batch=True)
+        raise SystemExit(returncode)
+
+    if opts.fan_out:
+        fd = _open_input(opts.fan_out)
+        try:
+            targets = [ line.strip() for line in fd ]
+        finally:
+            if fd is not sys.stdin:
+                fd.close()
+        targets = [ target for target in targets
+                    if target and not target.startswith('#') ]
+        try:
+            returncode = app.fan_out(opts.args, targets, opts.jobs, opts.timeout,
+              opts.fail_fast)
+        except InternalError, e:
+            sys.stderr.write("%s: internal error: %s\n" % (app.name, e.args[0]))
+            raise SystemExit(1)
+        raise SystemExit(returncode)
+
+    if opts.suggest:
+        json = _import_json()
+        if json is None:
+            error('--suggest needs json or simplejson')
+        print json.dumps(app.suggest(opts.args))
         raise SystemExit
 
     if opts.complete:
@@ -358,11 +1408,13 @@ def main(argv=None):
         raise SystemExit
 
     try:
-        returncode = app.run(opts.args, noop=opts.noop)
+        returncode = app.run(opts.args, noop=opts.noop, use_exec=opts.use_exec)
         raise SystemExit(returncode)
     except InternalError, e:
         sys.stderr.write("%s: internal error: %s\n" % (app.name, e.args[0]))
         raise SystemExit(1)
 
+_IMPORT_FINISHED = time.time()
+
 if __name__ == '__main__':
     main()
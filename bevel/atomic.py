@@ -0,0 +1,58 @@
+"""
+Atomically replacing files.
+
+Caches, indexes and bundles are written to a temporary file next to their
+destination, which is then renamed over it, so readers only ever see a whole
+file. The temporary file gets a unique name (``tempfile.mkstemp``), so any
+number of threads and processes can write the same file at once; whichever
+renames last wins.
+"""
+
+import os
+
+def umask():
+    """
+    The process's umask, read without changing it where possible (setting
+    it, even briefly, would affect files other threads are creating)
+    """
+    try:
+        fd = open('/proc/self/status')
+        try:
+            for line in fd:
+                if line.startswith('Umask:'):
+                    return int(line.split()[1], 8)
+        finally:
+            fd.close()
+    except (IOError, ValueError, IndexError):
+        pass
+    mask = os.umask(022)
+    os.umask(mask)
+    return mask
+
+def write(path, writer, mode=None, mtime=None):
+    """
+    Atomically replace ``path`` with what ``writer(fd)`` writes to the file
+    ``fd``. The file gets ``mode`` (by default, what ``open`` would have
+    given it) and, if given, ``mtime``.
+    """
+    import tempfile
+    if mode is None:
+        mode = 0666 & ~umask()
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+      prefix='.%s.' % os.path.basename(path), suffix='.tmp')
+    try:
+        fd = os.fdopen(fd, 'wb')
+        try:
+            writer(fd)
+            os.fchmod(fd.fileno(), mode)
+        finally:
+            fd.close()
+        if mtime is not None:
+            os.utime(tmp, (mtime, mtime))
+        os.rename(tmp, path)
+    except:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
@@ -0,0 +1,202 @@
+"""
+Packed, single-file ``bevel`` apps.
+
+A bundle holds a whole command tree: its structure (the same nodes as a
+``TreeIndex``) and every script's contents and mode. It's memory mapped, so
+resolving and completing commands only reads the manifest, and never touches
+the original tree. A script is only written out to disk when it's about to
+run, into a private cache keyed by its contents (so later runs, and other
+bundles with the same script, reuse it).
+
+The layout is a fixed header (magic, and the offset and length of the
+manifest), followed by the scripts' contents, followed by the pickled
+manifest.
+"""
+
+import os
+import stat
+import mmap
+import errno
+import struct
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+from bevel import atomic
+from bevel.index import TreeIndex, build_index, runtime_dir
+
+MAGIC = 'BEVELPK1'
+_HEADER = struct.Struct('>8sQQ')
+
+class BundleError(ValueError): pass
+
+def script_cache_dir():
+    return os.path.join(runtime_dir(), 'scripts')
+
+class Bundle(TreeIndex):
+    """
+    A memory mapped bundle, which serves as the index of its own tree.
+    ``scripts`` maps each script's path within the tree (a tuple) to its
+    ``(offset, length, mode, digest)``.
+    """
+    def __init__(self, path):
+        self.path = path
+        fd = open(path, 'rb')
+        try:
+            try:
+                self.map = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            except (mmap.error, ValueError), e:
+                raise BundleError('could not map "%s": %s' % (path, e))
+        finally:
+            fd.close()
+        if len(self.map) < _HEADER.size:
+            raise BundleError('"%s" is not a bevel bundle' % path)
+        magic, offset, length = _HEADER.unpack(self.map[:_HEADER.size])
+        if magic != MAGIC or offset + length > len(self.map):
+            raise BundleError('"%s" is not a bevel bundle' % path)
+        manifest = pickle.loads(self.map[offset:offset + length])
+        self.name = manifest['name']
+        self.scripts = manifest['scripts']
+        self.digest = manifest['fingerprint']
+        TreeIndex.__init__(self, path.rstrip('/'), manifest['nodes'], {})
+
+    def is_fresh(self):
+        return True
+
+    def read(self, rel):
+        offset, length, mode, digest = self.scripts[tuple(rel)]
+        return self.map[offset:offset + length]
+
+    def materialize(self, rel, cache_dir=None):
+        """
+        The path of a runnable copy of the script at ``rel``, writing it to
+        ``cache_dir`` first if it isn't there yet
+        """
+        rel = tuple(rel)
+        offset, length, mode, digest = self.scripts[rel]
+        if cache_dir is None:
+            # the runtime directory may be in ``/tmp``, where anyone could
+            # have created it first
+            _ensure_private_dir(runtime_dir())
+            cache_dir = script_cache_dir()
+        _ensure_private_dir(cache_dir)
+        # the script keeps its own name, since scripts may look at ``$0``
+        dirname = os.path.join(cache_dir, '%s-%o' % (digest, mode))
+        path = os.path.join(dirname, rel[-1])
+        try:
+            os.mkdir(dirname, 0700)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        _check_private(dirname)
+        if _is_cached(path, length, digest):
+            return path
+        try:
+            atomic.write(path, lambda fd: fd.write(self.map[offset:offset + length]),
+              mode)
+        except (IOError, OSError):
+            # another thread or process may have written it meanwhile
+            if not _is_cached(path, length, digest):
+                raise
+        return path
+
+def _ensure_private_dir(path):
+    try:
+        os.makedirs(path, 0700)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+    _check_private(path)
+
+def _check_private(path):
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or \
+      st.st_mode & 077:
+        raise RuntimeError('script cache "%s" is not private' % path)
+
+def _is_cached(path, length, digest):
+    """
+    Whether ``path`` is an intact copy of the script with ``length`` and
+    ``digest``, written by this user
+    """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    if not stat.S_ISREG(st.st_mode) or st.st_uid != os.getuid() or \
+      st.st_size != length:
+        return False
+    try:
+        fd = open(path, 'rb')
+        try:
+            data = fd.read()
+        finally:
+            fd.close()
+    except IOError:
+        return False
+    return sha1(data).hexdigest() == digest
+
+def pack(app, output):
+    """
+    Pack ``app``'s (a ``Bevel`` instance) tree into the bundle ``output``.
+
+    The same checks as ``--verify`` are applied to everything that would be
+    packed (empty drivers aside, since they're never run), and if any of them
+    fail, nothing is written and the problems are returned.
+    """
+    index = build_index(app)
+    scripts = []
+    nodes = index.nodes.items()
+    nodes.sort()
+    for args, node in nodes:
+        rel = args
+        if node[0]:
+            rel = args + (app.DRIVER_NAME,)
+        path = os.path.join(index.layer(args), *rel)
+        scripts.append((rel, path, node[0] and node[1]))
+
+    problems = []
+    for rel, path, empty in scripts:
+        if not empty:
+            problems.extend(app._check(('file', path))[1])
+    for rel in index.mtimes:
+        for layer in index.bin_dir.split(os.pathsep):
+            path = os.path.join(layer, rel)
+            if os.path.isdir(path):
+                problems.extend(app._check(('directory', path))[1])
+    if problems:
+        return problems
+
+    atomic.write(output, lambda fd: _write(fd, app.name, index, scripts))
+    return []
+
+def _write(fd, name, index, scripts):
+    fd.write(_HEADER.pack(MAGIC, 0, 0))
+    offset = _HEADER.size
+    entries = {}
+    for rel, script, empty in scripts:
+        source = open(script, 'rb')
+        try:
+            data = source.read()
+        finally:
+            source.close()
+        mode = stat.S_IMODE(os.stat(script).st_mode)
+        entries[rel] = (offset, len(data), mode, sha1(data).hexdigest())
+        fd.write(data)
+        offset += len(data)
+    manifest = pickle.dumps({
+        'name': name,
+        'nodes': index.nodes,
+        'scripts': entries,
+        'fingerprint': index.fingerprint(),
+    }, pickle.HIGHEST_PROTOCOL)
+    fd.write(manifest)
+    fd.seek(0)
+    fd.write(_HEADER.pack(MAGIC, offset, len(manifest)))
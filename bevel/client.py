@@ -0,0 +1,90 @@
+"""
+The client side of the completion server.
+
+``bevel-complete`` runs on every TAB, so it only imports what it needs to ask
+the server (``_socket``, ``os`` and ``hashlib``), rather than the server
+itself and everything it depends on. Even ``socket`` is too much: on Python 2
+it loads the SSL libraries. The rest of ``bevel`` is only imported
+when no server is listening and the client falls back to ``bevel
+--complete``.
+"""
+
+import os
+import sys
+import _socket
+
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+# how long the client waits on the server before giving up on it
+CLIENT_TIMEOUT = 1.0
+
+def runtime_dir():
+    """
+    A private, per-user directory for ``bevel``'s sockets and other
+    short-lived files
+    """
+    base = os.environ.get('XDG_RUNTIME_DIR')
+    if base:
+        return os.path.join(base, 'bevel')
+    return '/tmp/bevel-%d' % os.getuid()
+
+def _root(bin_dir):
+    """
+    The absolute form of a bin directory, or of each layer of a layered one
+    """
+    return os.pathsep.join([ os.path.abspath(layer.rstrip('/'))
+                             for layer in bin_dir.split(os.pathsep) ])
+
+def socket_dir():
+    """
+    A private, per-user directory for ``bevel`` sockets
+    """
+    return runtime_dir()
+
+def socket_path(bin_dir, kind='complete'):
+    digest = sha1(_root(bin_dir)).hexdigest()
+    return os.path.join(socket_dir(), '%s.%s.sock' % (digest, kind))
+
+def request_completions(path, comp_line):
+    """
+    Ask the server on ``path`` to complete ``comp_line``. Raises
+    ``socket.error`` if no server is listening.
+    """
+    sock = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+    try:
+        sock.settimeout(CLIENT_TIMEOUT)
+        sock.connect(path)
+        sock.sendall(comp_line)
+        sock.shutdown(_socket.SHUT_WR)
+        chunks = []
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        sock.close()
+    return ''.join(chunks)
+
+def complete_client(argv=None):
+    """
+    Entry point for ``bevel-complete BINDIR``, meant to be used with bash's
+    ``complete -C``
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    if not argv:
+        sys.stderr.write('usage: bevel-complete BINDIR\n')
+        raise SystemExit(2)
+    bin_dir = argv[0]
+    comp_line = os.environ.get('COMP_LINE') or os.environ.get('COMMAND_LINE') or ''
+    try:
+        reply = request_completions(socket_path(bin_dir), comp_line)
+    except _socket.error:
+        from bevel import main
+        main(['--bindir', bin_dir, '--complete'])
+    else:
+        print reply
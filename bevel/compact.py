@@ -0,0 +1,331 @@
+"""
+A compact, memory mapped binary index of a ``bevel`` command tree.
+
+Loading a pickled ``TreeIndex`` means reading and unpickling all of it before
+the first lookup, which dominates on trees with hundreds of thousands of
+commands. This format is mapped instead, and lookups only read the records
+along the path they follow, so opening it costs the same whatever the size of
+the tree.
+
+The layout is a fixed header, followed by a table of fixed-width node
+records, a table of directory records and a pool of strings (names and
+paths). Nodes are stored breadth first, with each node's children next to
+each other, sorted by name, so finding a child is a binary search over its
+parent's range of records. Besides commands, the tree holds the directories
+leading to commands beneath directories without a driver, which resolve but
+aren't listed as subcommands.
+
+The header stores the fingerprint of the tree the index was built from
+(``TreeIndex.fingerprint()``), which ``is_current`` compares against a fresh
+walk of the tree. The directory records hold the mtime of every directory in
+the tree, which ``is_fresh`` checks like a ``TreeIndex`` does. Checking all of
+them would cost as much as walking the tree, though, so each lookup only
+checks the directories along its own path (every node which is a directory
+refers to its records, one per layer it's in). An addition or removal
+anywhere along the way changes one of those mtimes, and if one has changed,
+the index answers from a fresh walk of the tree instead.
+"""
+
+import os
+import mmap
+import struct
+
+from bevel import atomic
+from bevel.index import TreeIndex, MergedIndex, build_index, _root
+
+MAGIC = 'BEVELIX2'
+# magic, fingerprint, number and offset of nodes, of directories, and the
+# offset of the string pool, and the length of the root at its start
+_HEADER = struct.Struct('<8s40sIIIIII')
+# name offset and length, first child and number of children, flags, layer,
+# first directory record and number of them
+_NODE = struct.Struct('<IHIIBBIB')
+# path offset and length, mtime, layer
+_DIR = struct.Struct('<IIdB')
+
+_COMMAND = 1
+_DRIVER = 2
+_EMPTY = 4
+
+class CompactIndexError(ValueError): pass
+
+class _Stale(Exception):
+    """
+    A directory along a lookup's path has changed since the index was built
+    """
+
+class _Subcommands(object):
+    """
+    The subcommands of a node, only read once they're needed (``node`` is
+    mostly called to resolve a command, which doesn't need them)
+    """
+    def __init__(self, index, record):
+        self.index = index
+        self.record = record
+        self.names = None
+
+    def _names(self):
+        if self.names is None:
+            self.names = self.index._subcommands(self.record)
+        return self.names
+
+    def __len__(self):
+        return len(self._names())
+
+    def __getitem__(self, i):
+        return self._names()[i]
+
+    def __iter__(self):
+        return iter(self._names())
+
+class CompactIndex(TreeIndex):
+    """
+    The compact index in ``path``, memory mapped. Once a lookup finds that
+    the tree has changed, the index answers from a fresh walk of ``app``'s
+    (a ``Bevel`` instance) tree; without ``app``, it raises
+    ``CompactIndexError``.
+    """
+    def __init__(self, path, app=None):
+        self.path = path
+        self.app = app
+        # the nodes whose directories have been checked
+        self.checked = set()
+        # the ``TreeIndex`` answering lookups once the index is stale
+        self.rebuilt = None
+        fd = open(path, 'rb')
+        try:
+            try:
+                self.map = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            except (mmap.error, ValueError), e:
+                raise CompactIndexError('could not map "%s": %s' % (path, e))
+        finally:
+            fd.close()
+        if len(self.map) < _HEADER.size:
+            raise CompactIndexError('"%s" is not a bevel index' % path)
+        magic, self.digest, self.count, self.nodes_offset, self.dir_count, \
+          self.dirs_offset, self.pool_offset, root_length = \
+          _HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or \
+          self.nodes_offset + self.count * _NODE.size > len(self.map) or \
+          self.dirs_offset + self.dir_count * _DIR.size > len(self.map) or \
+          self.pool_offset + root_length > len(self.map) or not self.count:
+            raise CompactIndexError('"%s" is not a bevel index' % path)
+        self.bin_dir = self.map[self.pool_offset:self.pool_offset + root_length]
+        self.layers = self.bin_dir.split(os.pathsep)
+
+    def close(self):
+        self.map.close()
+
+    def _record(self, i):
+        return _NODE.unpack_from(self.map, self.nodes_offset + i * _NODE.size)
+
+    def _name(self, i):
+        offset, length = _NODE.unpack_from(self.map, self.nodes_offset + i * _NODE.size)[:2]
+        offset += self.pool_offset
+        return self.map[offset:offset + length]
+
+    def _check(self, i, record):
+        """
+        Raise ``_Stale`` if any directory of node ``i`` has changed
+        """
+        if i in self.checked:
+            return
+        first = record[6]
+        for j in xrange(first, first + record[7]):
+            offset, length, mtime, layer = _DIR.unpack_from(self.map,
+              self.dirs_offset + j * _DIR.size)
+            offset += self.pool_offset
+            rel = self.map[offset:offset + length]
+            try:
+                if os.stat(os.path.join(self.layers[layer], rel)).st_mtime != mtime:
+                    raise _Stale()
+            except OSError:
+                raise _Stale()
+        self.checked.add(i)
+
+    def _stale(self):
+        """
+        The index to answer from instead of this one
+        """
+        if self.rebuilt is None:
+            if self.app is None:
+                raise CompactIndexError('"%s" is out of date' % self.path)
+            self.rebuilt = build_index(self.app)
+        return self.rebuilt
+
+    def _find(self, args):
+        """
+        The number of the record for ``args``, or ``None``. Raises ``_Stale``
+        if a directory on the way has changed.
+        """
+        i = 0
+        for name in args:
+            record = self._record(i)
+            self._check(i, record)
+            lo = first = record[2]
+            hi = end = first + record[3]
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self._name(mid) < name:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            if lo == end or self._name(lo) != name:
+                return None
+            i = lo
+        self._check(i, self._record(i))
+        return i
+
+    def node(self, args):
+        if self.rebuilt is not None:
+            return self.rebuilt.node(args)
+        try:
+            i = self._find(args)
+        except _Stale:
+            return self._stale().node(args)
+        if i is None:
+            return None
+        record = self._record(i)
+        flags = record[4]
+        if not flags & _COMMAND:
+            return None
+        subcommands = []
+        if flags & _DRIVER:
+            subcommands = _Subcommands(self, record)
+        return bool(flags & _DRIVER), bool(flags & _EMPTY), subcommands
+
+    def subcommands(self, args):
+        if self.rebuilt is not None:
+            return self.rebuilt.subcommands(args)
+        try:
+            i = self._find(args)
+        except _Stale:
+            return self._stale().subcommands(args)
+        if i is None:
+            return []
+        record = self._record(i)
+        if record[4] & (_COMMAND|_DRIVER) != _COMMAND|_DRIVER:
+            return []
+        return self._subcommands(record)
+
+    def _subcommands(self, record):
+        # children which are only directories leading to commands aren't
+        # subcommands
+        first = record[2]
+        return [ self._name(child) for child in xrange(first, first + record[3])
+                 if self._record(child)[4] & _COMMAND ]
+
+    def layer(self, args):
+        if self.rebuilt is not None:
+            return self.rebuilt.layer(args)
+        try:
+            i = self._find(args)
+        except _Stale:
+            return self._stale().layer(args)
+        return self.layers[self._record(i)[5]]
+
+    def fingerprint(self):
+        if self.rebuilt is not None:
+            return self.rebuilt.fingerprint()
+        return self.digest
+
+    def is_fresh(self):
+        for i in xrange(self.dir_count):
+            offset, length, mtime, layer = _DIR.unpack_from(self.map,
+              self.dirs_offset + i * _DIR.size)
+            offset += self.pool_offset
+            rel = self.map[offset:offset + length]
+            try:
+                if os.stat(os.path.join(self.layers[layer], rel)).st_mtime != mtime:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def is_current(self, app):
+        """
+        Whether the index still matches ``app``'s (a ``Bevel`` instance) tree
+        """
+        return self.bin_dir == _root(app.bin_dir) and \
+            self.digest == build_index(app).fingerprint()
+
+def write(index, path):
+    """
+    Atomically write ``index`` (a ``TreeIndex``) to ``path`` in the compact
+    format
+    """
+    layers = index.bin_dir.split(os.pathsep)
+    # a merged index's directories are checked layer by layer
+    sources = [index]
+    if isinstance(index, MergedIndex):
+        sources = index.layers
+    directories = {}
+    for layer, source in enumerate(sources):
+        for rel, mtime in source.mtimes.items():
+            args = tuple(rel and rel.split(os.path.sep) or ())
+            directories.setdefault(args, []).append((layer, rel, mtime))
+    children = {(): set()}
+    # every directory is a node, even without commands beneath it, so that
+    # a lookup passing through it checks it
+    for args in index.nodes.keys() + directories.keys():
+        for i in range(1, len(args) + 1):
+            if args[:i] not in children:
+                children[args[:i]] = set()
+            children[args[:i - 1]].add(args[i - 1])
+    # breadth first, so each node's children are contiguous
+    order = [()]
+    first = {}
+    i = 0
+    while i < len(order):
+        args = order[i]
+        names = list(children[args])
+        names.sort()
+        first[args] = len(order)
+        order.extend([ args + (name,) for name in names ])
+        i += 1
+
+    # each distinct string is stored once
+    pool = [index.bin_dir]
+    pool_size = [len(index.bin_dir)]
+    offsets = {}
+    def intern(value):
+        offset = offsets.get(value)
+        if offset is None:
+            offset = offsets[value] = pool_size[0]
+            pool.append(value)
+            pool_size[0] += len(value)
+        return offset
+
+    records = []
+    dirs = []
+    for args in order:
+        name = args and args[-1] or ''
+        node = index.nodes.get(args)
+        flags = 0
+        layer = 0
+        if node is not None:
+            flags = _COMMAND | (node[0] and _DRIVER) | (node[1] and _EMPTY)
+            layer = layers.index(index.layer(args))
+        own = directories.get(args, [])
+        records.append(_NODE.pack(intern(name), len(name), first[args],
+          len(children[args]), flags, layer, len(dirs), len(own)))
+        dirs.extend([ _DIR.pack(intern(rel), len(rel), mtime, dir_layer)
+                      for dir_layer, rel, mtime in sorted(own) ])
+
+    nodes_offset = _HEADER.size
+    dirs_offset = nodes_offset + len(records) * _NODE.size
+    pool_offset = dirs_offset + len(dirs) * _DIR.size
+    atomic.write(path, lambda fd: fd.write(''.join([_HEADER.pack(MAGIC,
+      index.fingerprint(), len(records), nodes_offset, len(dirs), dirs_offset,
+      pool_offset, len(index.bin_dir))] + records + dirs + pool)))
+
+def load(app, path):
+    """
+    Open the compact index ``path`` of ``app``'s (a ``Bevel`` instance) tree
+    """
+    index = CompactIndex(path, app)
+    if index.bin_dir != _root(app.bin_dir):
+        index.close()
+        raise CompactIndexError('"%s" is an index of "%s", not "%s"' % (path,
+          index.bin_dir, _root(app.bin_dir)))
+    return index
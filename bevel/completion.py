@@ -0,0 +1,364 @@
+"""
+Data structures behind subcommand completion: a prefix tree over sibling
+commands, an index for suggesting the ones closest to a mistyped command, and
+a small per-user log of how often each command is run, used to rank
+completions.
+"""
+
+import os
+
+from bevel import atomic
+
+# the format of persisted ``SuggestionIndex``es
+SUGGESTION_VERSION = 1
+
+class Trie(object):
+    """
+    A prefix tree over ``words``.
+
+    Each node records the range of (sorted) ``words`` which start with the
+    node's prefix, so ``startswith`` only has to walk the prefix itself.
+    """
+    def __init__(self, words):
+        self.words = sorted(words)
+        # nodes are ``[lo, hi, children]``
+        self.root = [0, len(self.words), {}]
+        for i, word in enumerate(self.words):
+            node = self.root
+            for char in word:
+                child = node[2].get(char)
+                if child is None:
+                    child = node[2][char] = [i, i, {}]
+                child[1] = i + 1
+                node = child
+
+    def startswith(self, prefix):
+        node = self.root
+        for char in prefix:
+            node = node[2].get(char)
+            if node is None:
+                return []
+        return self.words[node[0]:node[1]]
+
+def edit_distance(a, b, limit=None):
+    """
+    The Levenshtein distance between ``a`` and ``b``. If ``limit`` is given,
+    the work stops as soon as the distance is known to be greater than it,
+    and ``limit + 1`` is returned instead.
+    """
+    # a common prefix or suffix never needs editing
+    start = 0
+    while start < len(a) and start < len(b) and a[start] == b[start]:
+        start += 1
+    end = 0
+    while end < len(a) - start and end < len(b) - start and \
+      a[-1 - end] == b[-1 - end]:
+        end += 1
+    a = a[start:len(a) - end]
+    b = b[start:len(b) - end]
+    if len(a) < len(b):
+        a, b = b, a
+    if limit is not None and len(a) - len(b) > limit:
+        return limit + 1
+    previous = range(len(b) + 1)
+    for i, x in enumerate(a):
+        current = [i + 1]
+        for j, y in enumerate(b):
+            current.append(min(previous[j + 1] + 1, current[j] + 1,
+                               previous[j] + (x != y)))
+        if limit is not None and min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+def _partition(length, parts, skip=0):
+    """
+    Split ``length`` characters into ``parts`` consecutive segments, as
+    ``(start, size)`` pairs. The first ``skip`` characters all go to the
+    first segment, and the rest are shared out (nearly) equally.
+    """
+    result = []
+    start = skip
+    for i in range(parts):
+        size = (length - start) // (parts - i)
+        result.append((start, size))
+        start += size
+    result[0] = (0, result[0][1] + skip)
+    return result
+
+def _cost(sample, segments, total):
+    """
+    Roughly how many candidates a search for one of ``total`` words (of
+    which ``sample`` is a sample) would look at, were they split into
+    ``segments``
+    """
+    if len(sample) < 2:
+        return 0
+    pairs = len(sample) * (len(sample) - 1)
+    cost = 0.0
+    for start, size in segments:
+        counts = {}
+        for word in sample:
+            key = word[start:start + size]
+            counts[key] = counts.get(key, 0) + 1
+        # how likely two of the words are to share the segment
+        shared = sum([ count * (count - 1) for count in counts.itervalues() ])
+        cost += float(shared) / pairs * (total - 1)
+    return cost
+
+class SuggestionIndex(object):
+    """
+    An index over ``words`` for finding the ones within a small edit
+    distance (up to ``max_distance``) of a query, e.g. to suggest the command
+    someone meant to type. Searches usually only look at a handful of
+    candidates, so they stay fast with thousands of words.
+
+    Each word is split into ``k + 1`` segments for each distance ``k``.
+    ``k`` edits can touch at most ``k`` of them, so a word within ``k`` of
+    the query has a segment which appears unchanged in the query, only
+    slightly shifted, and a search looks up those few substrings of the
+    query.
+
+    The segments are the same for every word of a given length, and are
+    usually equal in size. Commands often share a prefix, though (e.g.
+    ``svc-``), and a segment within it would match every word, so when the
+    words of a length would share segments that way, the first segment is
+    stretched over the start of the words, to wherever it makes the
+    segments most selective.
+    """
+    # a length's segments are only reconsidered when searches for its words
+    # would look at more candidates than this, on average
+    MAX_CANDIDATES = 8
+    # how many of a length's words are looked at to choose its segments
+    SAMPLE = 64
+
+    def __init__(self, words, max_distance=2):
+        self.max_distance = max_distance
+        self.words = set(words)
+        lengths = {}
+        for word in self.words:
+            lengths.setdefault(len(word), []).append(word)
+        # ``(distance, length)`` -> segments
+        self.partitions = {}
+        # ``(distance, length, segment number, segment)`` -> words
+        self.segments = {}
+        for k in range(1, max_distance + 1):
+            for length, words in lengths.items():
+                segments = self.partitions[(k, length)] = \
+                  self._choose(words, length, k + 1)
+                for word in words:
+                    for i, (start, size) in enumerate(segments):
+                        key = (k, length, i, word[start:start + size])
+                        self.segments.setdefault(key, []).append(word)
+
+    def _choose(self, words, length, parts):
+        """
+        The most selective way of splitting ``words`` (all ``length``
+        characters long) into ``parts`` segments
+        """
+        best = _partition(length, parts)
+        if len(words) <= self.MAX_CANDIDATES:
+            return best
+        # a sample is enough to compare the ways of splitting them
+        sample = words[::max(1, len(words) // self.SAMPLE)]
+        lowest = _cost(sample, best, len(words))
+        if lowest <= self.MAX_CANDIDATES:
+            return best
+        for skip in range(1, length - parts + 1):
+            segments = _partition(length, parts, skip)
+            cost = _cost(sample, segments, len(words))
+            if cost < lowest:
+                best, lowest = segments, cost
+        return best
+
+    def _candidates(self, word, limit):
+        result = set()
+        for length in range(max(0, len(word) - limit), len(word) + limit + 1):
+            segments = self.partitions.get((limit, length))
+            if segments is None:
+                continue
+            delta = len(word) - length
+            for i, (start, size) in enumerate(segments):
+                # the first unchanged segment has at most ``i`` edits before
+                # it, and the rest make up for any difference in length
+                lo = max(-i, delta - (limit - i))
+                hi = min(i, delta + (limit - i))
+                for pos in range(start + lo, start + hi + 1):
+                    if 0 <= pos and pos + size <= len(word):
+                        key = (limit, length, i, word[pos:pos + size])
+                        result.update(self.segments.get(key, ()))
+        return result
+
+    def search(self, word, limit):
+        """
+        The ``(distance, word)`` of each word within ``limit`` (at most
+        ``max_distance``) of ``word``, closest (then alphabetically) first
+        """
+        limit = min(limit, self.max_distance)
+        if limit < 1:
+            return word in self.words and [(0, word)] or []
+        result = []
+        for candidate in self._candidates(word, limit):
+            distance = edit_distance(word, candidate, limit)
+            if distance <= limit:
+                result.append((distance, candidate))
+        result.sort()
+        return result
+
+    def dump(self, path):
+        """
+        Atomically write the index to ``path``
+        """
+        # ``marshal`` loads this kind of data several times faster than
+        # ``pickle``
+        import marshal
+        words = list(self.words)
+        words.sort()
+        data = (SUGGESTION_VERSION, self.max_distance, words, self.partitions,
+          self.segments)
+        atomic.write(path, lambda fd: marshal.dump(data, fd))
+
+    def load(cls, path):
+        import marshal
+        fd = open(path, 'rb')
+        try:
+            data = marshal.load(fd)
+        finally:
+            fd.close()
+        if not isinstance(data, tuple) or len(data) != 5 or \
+          data[0] != SUGGESTION_VERSION:
+            raise ValueError('unsupported suggestion index format')
+        self = cls.__new__(cls)
+        self.max_distance = data[1]
+        self.words = set(data[2])
+        self.partitions = data[3]
+        self.segments = data[4]
+        return self
+    load = classmethod(load)
+
+# building a suggestion index of fewer words than this is quicker than
+# loading it
+MIN_PERSISTED = 100
+
+def load_suggestion_index(app, cache_dir, args):
+    """
+    Load the cached ``SuggestionIndex`` of the subcommands of ``args`` in
+    ``app`` (a ``Bevel`` instance), (re)building it if it's missing or its
+    subcommands have changed. Failing to write the cache is not an error.
+    """
+    words = app._subcommands(args)
+    max_distance = app.MAX_SUGGESTION_DISTANCE
+    if len(words) < MIN_PERSISTED:
+        return SuggestionIndex(words, max_distance)
+    from bevel.index import cache_file, sha1
+    # next to the command index, one file per parent command
+    path = cache_file(app.bin_dir, cache_dir, 'suggest-%s' %
+      sha1('\0'.join(args)).hexdigest())
+    try:
+        index = SuggestionIndex.load(path)
+    except (IOError, EOFError, ValueError, TypeError):
+        index = None
+    if index is not None and \
+      (index.max_distance != max_distance or index.words != set(words)):
+        index = None
+    if index is None:
+        index = SuggestionIndex(words, max_distance)
+        try:
+            index.dump(path)
+        except (IOError, OSError):
+            pass
+    return index
+
+class UsageLog(object):
+    """
+    Counts how often each command is run.
+
+    ``record`` appends a single line to the log (one small ``O_APPEND``
+    write), so it's cheap enough to call from ``Bevel.run``. Once the log grows
+    past ``MAX_SIZE`` it's compacted: entries are merged, counts are halved so
+    that recent usage counts for more, and only the ``MAX_ENTRIES`` most used
+    commands are kept. Runs recorded by other processes while the log is being
+    compacted may be lost, which is fine for ranking purposes.
+    """
+    MAX_SIZE = 64 * 1024
+    MAX_ENTRIES = 500
+
+    def __init__(self, path):
+        self.path = path
+        self._counts = None
+        self._stamp = None
+
+    def record(self, args):
+        try:
+            fd = os.open(self.path, os.O_WRONLY|os.O_APPEND|os.O_CREAT, 0600)
+        except OSError:
+            return
+        try:
+            os.write(fd, '1\t%s\n' % ' '.join(args))
+            size = os.fstat(fd).st_size
+        finally:
+            os.close(fd)
+        if size > self.MAX_SIZE:
+            self.compact()
+
+    def _read(self):
+        """
+        The raw count for each command path in the log
+        """
+        counts = {}
+        try:
+            fd = open(self.path)
+        except IOError:
+            return counts
+        try:
+            for line in fd:
+                try:
+                    count, command = line.rstrip('\n').split('\t', 1)
+                    count = int(count)
+                except ValueError:
+                    continue
+                key = tuple(command.split())
+                counts[key] = counts.get(key, 0) + count
+        finally:
+            fd.close()
+        return counts
+
+    def compact(self):
+        counts = self._read().items()
+        counts.sort(key=lambda item: -item[1])
+        lines = [ '%d\t%s\n' % ((count + 1) // 2, ' '.join(key))
+                  for key, count in counts[:self.MAX_ENTRIES] ]
+        try:
+            atomic.write(self.path, lambda fd: fd.writelines(lines))
+        except (IOError, OSError):
+            pass
+
+    def counts(self):
+        """
+        How often each command, or any command beneath it, has been run,
+        keyed by command path. Only re-reads the log when it has changed.
+        """
+        try:
+            st = os.stat(self.path)
+            stamp = (st.st_ino, st.st_size, st.st_mtime)
+        except OSError:
+            stamp = None
+        if self._counts is None or stamp != self._stamp:
+            totals = {}
+            for key, count in self._read().items():
+                for i in range(1, len(key) + 1):
+                    totals[key[:i]] = totals.get(key[:i], 0) + count
+            self._counts = totals
+            self._stamp = stamp
+        return self._counts
+
+    def rank(self, parent, names):
+        """
+        Order subcommands ``names`` of ``parent`` by how often they're used,
+        most used first (and alphabetically otherwise)
+        """
+        counts = self.counts()
+        parent = tuple(parent)
+        decorated = [ (-counts.get(parent + (name,), 0), name) for name in names ]
+        decorated.sort()
+        return [ name for count, name in decorated ]
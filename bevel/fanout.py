@@ -0,0 +1,200 @@
+"""
+Run one command with many sets of arguments at once.
+
+Children are started up to a concurrency limit, and their stdout and stderr
+are read through non-blocking pipes from a single ``select`` loop. Output is
+written out a line at a time, each line prefixed with the target it came from,
+so lines from different children never interleave.
+"""
+
+import os
+import sys
+import time
+import errno
+import fcntl
+import signal
+import select
+
+# longest wait between checks for timed out children
+POLL_INTERVAL = 0.1
+# how long a timed out child gets to exit after ``SIGTERM``, before ``SIGKILL``
+KILL_GRACE = 2.0
+# lines longer than this are written out in pieces
+MAX_LINE = 64 * 1024
+
+class _Child(object):
+    def __init__(self, target, prefix, proc, timeout):
+        self.target = target
+        self.prefix = prefix
+        self.proc = proc
+        self.started = time.time()
+        self.deadline = timeout and self.started + timeout or None
+        self.killed = None
+        self.timed_out = False
+        self.buffers = {}
+
+    def terminate(self, now):
+        # the deadline moves along with each signal, so that the main loop
+        # waits for the child rather than spinning once it has passed
+        if self.killed is None:
+            self.killed = now
+            self.deadline = now + KILL_GRACE
+            self._signal(signal.SIGTERM)
+        elif now - self.killed > KILL_GRACE:
+            self.deadline = None
+            self._signal(signal.SIGKILL)
+
+    def _signal(self, signum):
+        # each child leads its own process group, so that anything it
+        # started (and which may be holding its pipes open) goes too
+        try:
+            os.killpg(self.proc.pid, signum)
+        except OSError:
+            pass
+
+def _spawn(target, argv, prefix, timeout):
+    import subprocess
+    devnull = open(os.devnull)
+    try:
+        proc = subprocess.Popen(argv, close_fds=True, stdin=devnull,
+          stdout=subprocess.PIPE, stderr=subprocess.PIPE, preexec_fn=os.setpgrp)
+    finally:
+        devnull.close()
+    child = _Child(target, prefix, proc, timeout)
+    for pipe in (proc.stdout, proc.stderr):
+        fd = pipe.fileno()
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        child.buffers[fd] = ''
+    return child
+
+def _pump(child, fd, stream):
+    """
+    Read what's available from ``fd`` and write out any complete lines.
+    Returns whether the pipe is still open.
+    """
+    while True:
+        try:
+            data = os.read(fd, 65536)
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return True
+            raise
+        buffered = child.buffers[fd]
+        if not data:
+            if buffered:
+                stream.write('%s%s\n' % (child.prefix, buffered))
+            del child.buffers[fd]
+            return False
+        buffered += data
+        lines = buffered.split('\n')
+        buffered = lines.pop()
+        while len(buffered) > MAX_LINE:
+            lines.append(buffered[:MAX_LINE])
+            buffered = buffered[MAX_LINE:]
+        child.buffers[fd] = buffered
+        if lines:
+            stream.write(''.join([ '%s%s\n' % (child.prefix, line) for line in lines ]))
+
+def run(commands, jobs=1, timeout=None, fail_fast=False, stdout=None, stderr=None):
+    """
+    Run ``commands`` (an iterable of ``(target, argv)``), up to ``jobs`` at
+    once, killing any that run for longer than ``timeout`` seconds. With
+    ``fail_fast``, the first failure stops any more commands from starting
+    and terminates the rest.
+
+    Returns a result dict for each command that was started, in the order
+    they finished.
+    """
+    if stdout is None:
+        stdout = sys.stdout
+    if stderr is None:
+        stderr = sys.stderr
+    commands = list(commands)
+    width = max([0] + [ len(target) for target, argv in commands ])
+    pending = iter(commands)
+    running = []
+    results = []
+    stopping = False
+    exhausted = False
+
+    try:
+        while True:
+            while not stopping and not exhausted and len(running) < max(jobs, 1):
+                try:
+                    target, argv = pending.next()
+                except StopIteration:
+                    exhausted = True
+                    break
+                running.append(_spawn(target, argv, '%-*s | ' % (width, target), timeout))
+            if not running:
+                break
+
+            streams = {}
+            wait = POLL_INTERVAL
+            now = time.time()
+            for child in running:
+                streams[child.proc.stdout.fileno()] = (child, stdout)
+                streams[child.proc.stderr.fileno()] = (child, stderr)
+                if child.deadline is not None:
+                    wait = max(0, min(wait, child.deadline - now))
+            # only pipes which haven't reached EOF yet
+            readable = [ fd for fd, (child, stream) in streams.items()
+                         if fd in child.buffers ]
+            try:
+                readable = select.select(readable, [], [], wait)[0]
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                readable = []
+            for fd in readable:
+                child, stream = streams[fd]
+                _pump(child, fd, stream)
+
+            now = time.time()
+            for child in list(running):
+                if child.deadline is not None and now > child.deadline:
+                    if child.killed is None:
+                        child.timed_out = True
+                    child.terminate(now)
+                if child.buffers or child.proc.poll() is None:
+                    continue
+                running.remove(child)
+                code = child.proc.returncode
+                child.proc.stdout.close()
+                child.proc.stderr.close()
+                result = {
+                    'target': child.target,
+                    'exit_code': code,
+                    'timed_out': child.timed_out,
+                    'elapsed': round(now - child.started, 6),
+                }
+                results.append(result)
+                if fail_fast and (code != 0 or child.timed_out):
+                    stopping = True
+            if stopping:
+                for child in running:
+                    child.terminate(now)
+            stdout.flush()
+            stderr.flush()
+    finally:
+        for child in running:
+            child._signal(signal.SIGKILL)
+            child.proc.wait()
+    return results
+
+def summarize(results, skipped=0):
+    """
+    A one-line description of ``results``
+    """
+    counts = {'succeeded': 0, 'failed': 0, 'timed out': 0}
+    for result in results:
+        if result['timed_out']:
+            counts['timed out'] += 1
+        elif result['exit_code'] == 0:
+            counts['succeeded'] += 1
+        else:
+            counts['failed'] += 1
+    parts = [ '%d %s' % (counts[key], key) for key in ('succeeded', 'failed', 'timed out') ]
+    if skipped:
+        parts.append('%d skipped' % skipped)
+    return ', '.join(parts)
@@ -0,0 +1,327 @@
+"""
+A persistent, on-disk index of a ``bevel`` command tree.
+
+Building the index walks the tree once, applying the same rules as
+``Bevel._args_to_bin`` and ``Bevel._subcommands``. The result is cached per
+user and revalidated on later invocations by comparing directory mtimes, so
+resolution and completion can be answered without touching each script.
+
+Note that some changes don't update the mtime of the containing directory
+(e.g. ``chmod``-ing a script or rewriting a ``_driver`` in place). Pass
+``--reindex`` (or remove the cache file) after such changes. Long-running
+processes can use ``bevel.live.LiveIndex`` instead, which follows every change.
+"""
+
+import os
+import stat
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+from bevel import atomic
+from bevel.client import runtime_dir, _root
+
+INDEX_VERSION = 1
+
+def default_cache_dir():
+    """
+    The per-user directory where ``bevel`` keeps its caches
+    """
+    base = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'bevel')
+
+class TreeIndex(object):
+    """
+    A snapshot of every resolvable command in a ``bevel`` tree.
+
+    ``nodes`` maps a command path (a tuple of command names) to a
+    ``(is_driver, is_empty, subcommands)`` tuple. ``mtimes`` maps each
+    directory that was walked (relative to the bin directory) to its mtime
+    at the time it was indexed.
+    """
+    def __init__(self, bin_dir, nodes, mtimes):
+        self.bin_dir = bin_dir
+        self.nodes = nodes
+        self.mtimes = mtimes
+
+    def node(self, args):
+        return self.nodes.get(tuple(args))
+
+    def subcommands(self, args):
+        node = self.node(args)
+        if node is None or not node[0]:
+            return []
+        return list(node[2])
+
+    def update(self):
+        """
+        Catch up with changes to the tree, returning whether there were any.
+        A snapshot never changes; see ``bevel.live.LiveIndex``.
+        """
+        return False
+
+    def layer(self, args):
+        """
+        The directory that the command ``args`` comes from
+        """
+        return self.bin_dir
+
+    def fingerprint(self):
+        """
+        A digest of the tree's structure, which changes whenever the set of
+        commands (or whether their drivers are empty) changes
+        """
+        items = self.nodes.items()
+        items.sort()
+        return sha1(repr(items)).hexdigest()
+
+    def is_fresh(self):
+        """
+        Whether no directory in the tree has changed since it was indexed
+        """
+        for rel, mtime in self.mtimes.items():
+            try:
+                if os.stat(os.path.join(self.bin_dir, rel)).st_mtime != mtime:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def dump(self, path):
+        """
+        Atomically write the index to ``path``
+        """
+        data = (INDEX_VERSION, self.bin_dir, self.nodes, self.mtimes)
+        atomic.write(path, lambda fd: pickle.dump(data, fd, pickle.HIGHEST_PROTOCOL))
+
+    def load(cls, path):
+        fd = open(path, 'rb')
+        try:
+            data = pickle.load(fd)
+        finally:
+            fd.close()
+        if not isinstance(data, tuple) or len(data) != 4 or \
+          data[0] != INDEX_VERSION:
+            raise ValueError('unsupported index format')
+        return cls(*data[1:])
+    load = classmethod(load)
+
+def _stat(path):
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+def _is_runnable(path, st):
+    return st is not None and stat.S_ISREG(st.st_mode) and \
+        os.access(path, os.R_OK|os.X_OK)
+
+def _is_empty(path):
+    fd = open(path)
+    try:
+        return not bool(fd.readline().strip())
+    finally:
+        fd.close()
+
+class MergedIndex(TreeIndex):
+    """
+    The merged index of a layered app. ``layers`` holds the index of each
+    layer, highest first, and ``origins`` maps each command to the layer
+    directory it comes from.
+    """
+    def __init__(self, bin_dir, nodes, mtimes, layers, origins):
+        TreeIndex.__init__(self, bin_dir, nodes, mtimes)
+        self.layers = layers
+        self.origins = origins
+
+    def layer(self, args):
+        return self.origins[tuple(args)]
+
+    def is_fresh(self):
+        for index in self.layers:
+            if not index.is_fresh():
+                return False
+        return True
+
+    def dump(self, path):
+        data = (INDEX_VERSION, self.bin_dir, self.nodes, self.mtimes,
+            self.layers, self.origins)
+        atomic.write(path, lambda fd: pickle.dump(data, fd, pickle.HIGHEST_PROTOCOL))
+
+    def load(cls, path):
+        fd = open(path, 'rb')
+        try:
+            data = pickle.load(fd)
+        finally:
+            fd.close()
+        if not isinstance(data, tuple) or len(data) != 6 or \
+          data[0] != INDEX_VERSION:
+            raise ValueError('unsupported index format')
+        return cls(*data[1:])
+    load = classmethod(load)
+
+def _is_beneath(args, prefixes):
+    for i in range(len(args)):
+        if args[:i] in prefixes:
+            return True
+    return False
+
+def merge_layers(layers):
+    """
+    Merge the indexes of each layer of a tree, highest first. A command in a
+    higher layer overrides the same command in lower ones, and parent
+    commands' subcommands are merged. A leaf command hides everything beneath
+    it in lower layers, and a directory hides lower layers' leaf commands of
+    the same name.
+    """
+    nodes = {}
+    origins = {}
+    mtimes = {}
+    leaves = set()
+    dirs = set()
+    for index in layers:
+        layer_dirs = []
+        for rel, mtime in index.mtimes.items():
+            args = tuple(rel and rel.split(os.path.sep) or [])
+            if not _is_beneath(args, leaves):
+                mtimes.setdefault(rel, mtime)
+                layer_dirs.append(args)
+        layer_leaves = []
+        for args, node in index.nodes.items():
+            if not node[0]:
+                layer_leaves.append(args)
+            if args in nodes or _is_beneath(args, leaves) or \
+              (not node[0] and args in dirs):
+                continue
+            nodes[args] = (node[0], node[1], [])
+            origins[args] = index.bin_dir
+        leaves.update(layer_leaves)
+        dirs.update(layer_dirs)
+    names = nodes.keys()
+    names.sort()
+    for args in names:
+        parent = nodes.get(args[:-1])
+        if args and parent is not None and parent[0]:
+            parent[2].append(args[-1])
+    bin_dir = os.pathsep.join([ index.bin_dir for index in layers ])
+    return MergedIndex(bin_dir, nodes, mtimes, layers, origins)
+
+class _Layer(object):
+    """
+    Just enough of a ``Bevel`` for ``build_index`` to index one directory
+    (e.g. a layer, or a subdirectory) of an app
+    """
+    def __init__(self, app, bin_dir):
+        self.bin_dir = bin_dir
+        self.layers = [bin_dir]
+        self.DRIVER_NAME = app.DRIVER_NAME
+        self._is_valid_name = app._is_valid_name
+
+def build_index(app):
+    """
+    Walk the command tree of ``app`` (a ``Bevel`` instance) and index it
+    """
+    if len(app.layers) > 1:
+        return merge_layers([ build_index(_Layer(app, layer)) for layer in app.layers ])
+    bin_dir = os.path.abspath(app.bin_dir)
+    nodes = {}
+    mtimes = {}
+    # the directories on the way to the current one; a symlink back to one
+    # of them would be a cycle, while other aliases are walked like any
+    # other directory
+    ancestors = []
+
+    def walk(args, path, st):
+        key = (st.st_dev, st.st_ino)
+        if key in ancestors:
+            return
+        ancestors.append(key)
+        try:
+            _walk(args, path, st)
+        finally:
+            ancestors.pop()
+
+    def _walk(args, path, st):
+        mtimes[os.path.sep.join(args)] = st.st_mtime
+
+        driver = os.path.join(path, app.DRIVER_NAME)
+        driver_st = _stat(driver)
+        has_driver = _is_runnable(driver, driver_st)
+        if has_driver:
+            nodes[tuple(args)] = (True, _is_empty(driver), [])
+
+        try:
+            names = os.listdir(path)
+        except OSError:
+            return
+        subcommands = []
+        for name in names:
+            if not app._is_valid_name(name):
+                continue
+            child = os.path.join(path, name)
+            child_st = _stat(child)
+            if child_st is None:
+                continue
+            child_args = args + [name]
+            if stat.S_ISDIR(child_st.st_mode):
+                walk(child_args, child, child_st)
+                if tuple(child_args) in nodes:
+                    subcommands.append(name)
+            elif _is_runnable(child, child_st):
+                nodes[tuple(child_args)] = (False, False, [])
+                subcommands.append(name)
+        if has_driver:
+            subcommands.sort()
+            nodes[tuple(args)][2].extend(subcommands)
+
+    root_st = _stat(bin_dir)
+    if root_st is not None and stat.S_ISDIR(root_st.st_mode):
+        walk([], bin_dir, root_st)
+    return TreeIndex(bin_dir, nodes, mtimes)
+
+def cache_file(bin_dir, cache_dir, kind):
+    """
+    The path of the ``kind`` cache file for ``bin_dir``, making sure
+    ``cache_dir`` exists (if possible)
+    """
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir, 0700)
+        except OSError:
+            pass
+    digest = sha1(_root(bin_dir)).hexdigest()
+    return os.path.join(cache_dir, '%s.%s' % (digest, kind))
+
+def load_index(app, cache_dir, rebuild=False):
+    """
+    Load the cached index for ``app``, (re)building it if it's missing or
+    stale. Failing to write the cache is not an error.
+    """
+    path = cache_file(app.bin_dir, cache_dir, 'index')
+    index = None
+    cls = TreeIndex
+    if len(app.layers) > 1:
+        cls = MergedIndex
+    if not rebuild:
+        try:
+            index = cls.load(path)
+        except (IOError, OSError, EOFError, ValueError, pickle.UnpicklingError):
+            index = None
+    if index is not None and \
+      (index.bin_dir != _root(app.bin_dir) or not index.is_fresh()):
+        index = None
+    if index is None:
+        index = build_index(app)
+        try:
+            index.dump(path)
+        except (IOError, OSError):
+            pass
+    return index
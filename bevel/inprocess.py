@@ -0,0 +1,155 @@
+"""
+Run Python scripts in a fork of the running interpreter.
+
+A subcommand whose shebang names the interpreter ``bevel`` is already running
+on would otherwise pay for a second interpreter start. Instead, ``run`` forks
+and runs the script in the child with ``runpy``, with the same ``sys.argv``,
+``sys.path[0]``, file descriptors and exit status it would have had as a
+separate process. Python 2.6's ``runpy`` can't run a script by its path,
+so there scripts always run as separate processes.
+"""
+
+import os
+import sys
+
+# only this much of a script is read to find its interpreter
+MAX_SHEBANG = 256
+
+def _which(name):
+    for dirname in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        path = os.path.join(dirname or '.', name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+def interpreter(script):
+    """
+    The interpreter named by ``script``'s shebang (following ``env``), or
+    ``None``. Shebangs which pass the interpreter options aren't followed.
+    """
+    try:
+        fd = open(script, 'rb')
+        try:
+            line = fd.readline(MAX_SHEBANG)
+        finally:
+            fd.close()
+    except IOError:
+        return None
+    if not line.startswith('#!') or not line.endswith('\n'):
+        return None
+    words = line[2:].split()
+    if len(words) == 2 and os.path.basename(words[0]) == 'env':
+        return _which(words[1])
+    if len(words) == 1:
+        return words[0]
+    return None
+
+def is_this_python(script):
+    """
+    Whether ``script`` would run on the same interpreter as this process,
+    and can be run in it
+    """
+    import runpy
+    if not hasattr(runpy, 'run_path'):
+        return False
+    path = interpreter(script)
+    return path is not None and sys.executable and \
+        os.path.realpath(path) == os.path.realpath(sys.executable)
+
+def _exit_code(code):
+    # the same conversion the interpreter applies to ``SystemExit``
+    if code is None:
+        return 0
+    if isinstance(code, (int, long)):
+        return code & 0xff
+    sys.stderr.write('%s\n' % code)
+    return 1
+
+def _run_script(script, args):
+    """
+    Run ``script`` as ``__main__`` in this process, and return its exit code
+    """
+    import atexit
+    import runpy
+    import signal
+    import traceback
+    # handlers installed by ``bevel``'s process aren't the script's
+    del atexit._exithandlers[:]
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    sys.argv = [script] + list(args)
+    sys.path[0] = os.path.dirname(os.path.realpath(script))
+    try:
+        try:
+            runpy.run_path(script, run_name='__main__')
+            code = 0
+        except SystemExit, e:
+            code = _exit_code(e.code)
+        except:
+            traceback.print_exc()
+            code = 1
+        atexit._run_exitfuncs()
+    finally:
+        for stream in (sys.stdout, sys.stderr):
+            try:
+                stream.flush()
+            except (IOError, ValueError):
+                pass
+    return code
+
+def _redirect(stdout):
+    """
+    Set up the child's file descriptors the way ``subprocess.Popen(...,
+    close_fds=True, stdout=stdout, stderr=sys.stderr)`` would
+    """
+    for stream, fd in ((stdout, 1), (sys.stderr, 2)):
+        if stream.fileno() != fd:
+            os.dup2(stream.fileno(), fd)
+    _close_fds()
+    sys.stdout = os.fdopen(1, 'w')
+    sys.stderr = os.fdopen(2, 'w', 0)
+
+def _close_fds():
+    # listing the open descriptors is much cheaper than closing every
+    # possible one when the limit is high
+    try:
+        fds = [ int(fd) for fd in os.listdir('/proc/self/fd') ]
+    except OSError:
+        try:
+            limit = os.sysconf('SC_OPEN_MAX')
+        except (AttributeError, ValueError):
+            limit = 256
+        os.closerange(3, limit)
+        return
+    for fd in fds:
+        if fd > 2:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+def run(script, args, stdout=None, use_exec=False):
+    """
+    Run the Python ``script`` with ``args`` in a fork of this process and
+    return its exit code (negative if it was killed by a signal, like
+    ``subprocess``) and resource usage. If ``use_exec`` is true, the script
+    takes over this process instead, and this never returns.
+    """
+    if stdout is None:
+        stdout = sys.stdout
+    sys.stdout.flush()
+    sys.stderr.flush()
+    stdout.flush()
+    if use_exec:
+        _redirect(stdout)
+        os._exit(_run_script(script, args))
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            _redirect(stdout)
+            code = _run_script(script, args)
+        finally:
+            os._exit(code)
+    from bevel.rusage import wait
+    return wait(pid)
@@ -0,0 +1,266 @@
+"""
+A command tree index which keeps itself up to date, using Linux's inotify.
+
+``LiveIndex`` starts out as a full ``TreeIndex`` of the tree, and watches the
+bin directory and every directory beneath it. Each change (scripts being
+added, removed, renamed, ``chmod``-ed or rewritten) only updates the nodes it
+affects, so lookups stay as cheap as with a static index, and checking for
+changes is a single non-blocking ``read``. If the kernel's event queue
+overflows, the whole tree is rescanned.
+
+inotify is used through ``ctypes``; where it isn't available, ``available()``
+is false and callers should use a plain ``TreeIndex`` instead.
+"""
+
+import os
+import sys
+import stat
+import errno
+import struct
+
+from bevel.index import TreeIndex, build_index, _Layer, _stat, _is_runnable, _is_empty
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = 00004000
+IN_CLOEXEC = 02000000
+
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+    IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+_EVENT = struct.Struct('iIII')
+
+_libc = None
+
+def _load():
+    global _libc
+    if _libc is None:
+        _libc = False
+        if sys.platform.startswith('linux'):
+            try:
+                import ctypes
+                import ctypes.util
+                libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                  use_errno=True)
+                libc.inotify_init1
+                libc.inotify_add_watch
+                libc.inotify_rm_watch
+                _libc = libc
+            except (ImportError, OSError, AttributeError):
+                pass
+    return _libc
+
+def available():
+    """
+    Whether inotify can be used here
+    """
+    return bool(_load())
+
+def _check(result):
+    if result < 0:
+        import ctypes
+        code = ctypes.get_errno()
+        raise OSError(code, os.strerror(code))
+    return result
+
+class LiveIndex(TreeIndex):
+    """
+    An index of ``app``'s (a ``Bevel`` instance) tree which follows changes
+    to it. Call ``update()`` to apply any changes made since the last call.
+    """
+    def __init__(self, app):
+        libc = _load()
+        if not libc:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.app = app
+        self.fd = _check(libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+        # watch descriptor -> command paths (several, when a directory is
+        # reachable through symlinks), and command path -> watch descriptor
+        self._watches = {}
+        self._dirs = {}
+        self._rescan()
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def _rescan(self):
+        for wd in self._watches.keys():
+            _load().inotify_rm_watch(self.fd, wd)
+        self._watches.clear()
+        self._dirs.clear()
+        self.bin_dir = os.path.abspath(self.app.bin_dir)
+        self.nodes = {}
+        self.mtimes = {}
+        self._add_tree(())
+
+    def _path(self, args):
+        return os.path.join(self.bin_dir, *args)
+
+    def _watch(self, args):
+        try:
+            wd = _check(_load().inotify_add_watch(self.fd, self._path(args), WATCH_MASK))
+        except OSError:
+            return
+        self._watches.setdefault(wd, set()).add(args)
+        self._dirs[args] = wd
+
+    def update(self):
+        """
+        Apply any pending changes to the tree. Returns whether anything
+        changed.
+        """
+        changed = False
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.EAGAIN:
+                    return changed
+                raise
+            changed = True
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = data[offset:offset + length].rstrip('\0')
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    self._rescan()
+                    continue
+                self._apply(wd, mask, name)
+
+    def _apply(self, wd, mask, name):
+        paths = self._watches.get(wd)
+        if paths is None:
+            return
+        if mask & IN_IGNORED:
+            # the directory went away (or was moved); its parent's event
+            # takes care of the nodes
+            del self._watches[wd]
+            for args in paths:
+                if self._dirs.get(args) == wd:
+                    del self._dirs[args]
+            return
+        if not name:
+            return
+        # applying a change may unwatch some of the paths meanwhile
+        for args in list(paths):
+            if self._dirs.get(args) == wd:
+                self._apply_to(args, mask, name)
+
+    def _apply_to(self, args, mask, name):
+        st = _stat(self._path(args))
+        if st is not None:
+            self.mtimes[os.path.sep.join(args)] = st.st_mtime
+        if name == self.app.DRIVER_NAME:
+            self._update_driver(args)
+        elif self.app._is_valid_name(name):
+            self._update_entry(args + (name,), mask & (IN_CREATE | IN_MOVED_TO))
+
+    def _link(self, args):
+        """
+        Add or remove ``args`` from its parent's subcommands, depending on
+        whether it's a command
+        """
+        parent = self.nodes.get(args[:-1])
+        if parent is None or not parent[0]:
+            return
+        subcommands = parent[2]
+        if args in self.nodes:
+            if args[-1] in subcommands:
+                return
+            subcommands = sorted(subcommands + [args[-1]])
+        elif args[-1] in subcommands:
+            subcommands = [ name for name in subcommands if name != args[-1] ]
+        else:
+            return
+        # a new list rather than changing the old one in place, since
+        # lookups on other threads may be holding on to it
+        self.nodes[args[:-1]] = (parent[0], parent[1], subcommands)
+
+    def _update_driver(self, args):
+        path = self._path(args)
+        driver = os.path.join(path, self.app.DRIVER_NAME)
+        old = self.nodes.get(args)
+        try:
+            runnable = _is_runnable(driver, _stat(driver))
+            empty = runnable and _is_empty(driver)
+            if runnable and (old is None or not old[0]):
+                names = os.listdir(path)
+        except (IOError, OSError):
+            runnable = False
+        if runnable:
+            if old is not None and old[0]:
+                subcommands = old[2]
+            else:
+                subcommands = [ name for name in names
+                                if self.app._is_valid_name(name) and
+                                args + (name,) in self.nodes ]
+                subcommands.sort()
+            self.nodes[args] = (True, empty, subcommands)
+        elif old is not None:
+            del self.nodes[args]
+        if args:
+            self._link(args)
+
+    def _update_entry(self, args, replaced):
+        path = self._path(args)
+        st = _stat(path)
+        if st is not None and stat.S_ISDIR(st.st_mode):
+            if replaced or args not in self._dirs:
+                self._remove_tree(args)
+                self._add_tree(args)
+        else:
+            self._remove_tree(args)
+            if _is_runnable(path, st):
+                self.nodes[args] = (False, False, [])
+        self._link(args)
+
+    def _add_tree(self, args):
+        # watch before walking, so that nothing created meanwhile is missed
+        self._watch(args)
+        sub = build_index(_Layer(self.app, self._path(args)))
+        for rel, mtime in sub.mtimes.items():
+            rel = tuple(rel and rel.split(os.path.sep) or [])
+            self.mtimes[os.path.sep.join(args + rel)] = mtime
+            if rel:
+                self._watch(args + rel)
+        for rel, node in sub.nodes.items():
+            self.nodes[args + rel] = node
+
+    def _remove_tree(self, args):
+        size = len(args)
+        for key in self.nodes.keys():
+            if key[:size] == args:
+                del self.nodes[key]
+        for key in self._dirs.keys():
+            if key[:size] == args:
+                wd = self._dirs.pop(key)
+                paths = self._watches.get(wd)
+                if paths is not None:
+                    paths.discard(key)
+                    if paths:
+                        # still watched through another alias
+                        continue
+                    del self._watches[wd]
+                _load().inotify_rm_watch(self.fd, wd)
+        for rel in self.mtimes.keys():
+            key = tuple(rel and rel.split(os.path.sep) or [])
+            if key[:size] == args:
+                del self.mtimes[rel]
@@ -0,0 +1,257 @@
+"""
+Memoized output of idempotent leaf commands.
+
+A leaf command opts in with a header comment in its first few lines, giving
+how many seconds its output stays valid (``# bevel-memoize: 10``). Its stdout
+and exit code are then kept in a per-user cache, keyed by the script's path
+and mtime and the arguments it was given, and later runs within the TTL are
+answered from the cache without running the script.
+
+Memoization has to be turned on for an app (``Bevel(..., memoize=True)``,
+or ``--memoize`` in its wrapper script); otherwise headers aren't even read,
+so apps which don't use it don't pay for it. A caller can bypass it for a
+single call by setting ``BEVEL_NO_MEMOIZE``.
+
+Each entry is a file whose mtime is when it expires. Runs of the same entry
+are serialized with a lock file (``flock``), so when many callers miss at
+once, one of them runs the command and the rest wait for, and then reuse,
+its output. The lock file is removed once the entry is written; waiters
+notice, and check the cache again.
+
+The output of a run is passed through as it's produced, and recorded on the
+side until it grows beyond ``MAX_OUTPUT``, when the run is no longer cached.
+"""
+
+import os
+import re
+import time
+import errno
+import fcntl
+import select
+
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+from bevel import atomic
+
+# only this much of a script is read to find its TTL
+MAX_HEADER = 256
+# output bigger than this is passed through, but not cached
+MAX_OUTPUT = 16 * 1024 * 1024
+# how often the thread passing output through checks whether the command has
+# finished
+POLL_INTERVAL = 0.05
+
+_RE_TTL = re.compile(r'^#\s*bevel-memoize:\s*(\d+(?:\.\d*)?)\s*$', re.MULTILINE)
+_RE_ENTRY = re.compile(r'^[0-9a-f]{40}$')
+
+def declared_ttl(header):
+    """
+    The TTL a script with ``header`` (its first ``MAX_HEADER`` bytes)
+    declares, or ``None`` if it doesn't opt in
+    """
+    match = _RE_TTL.search(header)
+    if match is None:
+        return None
+    return float(match.group(1)) or None
+
+def tee(run, stdout, limit=None):
+    """
+    Call ``run(pipe)``, copying what's written to the file ``pipe`` to the
+    file ``stdout`` as it arrives. Returns ``run``'s return value and the
+    output, or ``None`` instead of the output if it was bigger than
+    ``limit`` (``MAX_OUTPUT`` by default).
+    """
+    import threading
+    if limit is None:
+        limit = MAX_OUTPUT
+    r, w = os.pipe()
+    chunks = []
+    state = {'size': 0, 'finished': False}
+
+    def copy():
+        while True:
+            try:
+                # once the command has finished, only what it left in the
+                # pipe is read, rather than waiting for anything it left
+                # running in the background to close it
+                timeout = not state['finished'] and POLL_INTERVAL or 0
+                ready = select.select([r], [], [], timeout)[0]
+                if not ready:
+                    if state['finished']:
+                        return
+                    continue
+                data = os.read(r, 65536)
+            except (select.error, OSError), e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                return
+            if not data:
+                return
+            stdout.write(data)
+            stdout.flush()
+            if state['size'] is not None:
+                state['size'] += len(data)
+                if state['size'] > limit:
+                    del chunks[:]
+                    state['size'] = None
+                else:
+                    chunks.append(data)
+
+    thread = threading.Thread(target=copy)
+    thread.setDaemon(True)
+    thread.start()
+    try:
+        pipe = os.fdopen(w, 'wb')
+        try:
+            result = run(pipe)
+        finally:
+            pipe.close()
+            state['finished'] = True
+            thread.join()
+    finally:
+        os.close(r)
+    if state['size'] is None:
+        return result, None
+    return result, ''.join(chunks)
+
+class OutputCache(object):
+    """
+    Commands' output and exit codes, one file per command in ``path``
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def _file(self, key):
+        return os.path.join(self.path, sha1('\0'.join(key)).hexdigest())
+
+    def get(self, key):
+        """
+        The ``(exit_code, output)`` cached for ``key`` (a list of strings),
+        or ``None`` if there isn't one or it has expired
+        """
+        return self._read(self._file(key))
+
+    def _read(self, path):
+        try:
+            fd = open(path, 'rb')
+        except IOError:
+            return None
+        try:
+            if os.fstat(fd.fileno()).st_mtime <= time.time():
+                return None
+            code = fd.readline()
+            output = fd.read()
+        finally:
+            fd.close()
+        try:
+            return int(code), output
+        except ValueError:
+            return None
+
+    def _write(self, path, ttl, code, output):
+        try:
+            atomic.write(path, lambda fd: fd.write('%d\n%s' % (code, output)),
+              mtime=time.time() + ttl)
+        except (IOError, OSError):
+            pass
+
+    def _lock(self, path):
+        """
+        Take the lock for the entry ``path``, returning its file descriptor
+        """
+        path += '.lock'
+        while True:
+            fd = os.open(path, os.O_RDWR|os.O_CREAT, 0600)
+            try:
+                while True:
+                    try:
+                        fcntl.flock(fd, fcntl.LOCK_EX)
+                        break
+                    except IOError, e:
+                        if e.errno != errno.EINTR:
+                            raise
+                # the previous holder may have removed the file meanwhile
+                st = os.fstat(fd)
+                try:
+                    current = os.stat(path)
+                except OSError:
+                    current = None
+            except:
+                os.close(fd)
+                raise
+            if current is not None and \
+              (current.st_dev, current.st_ino) == (st.st_dev, st.st_ino):
+                return fd
+            os.close(fd)
+
+    def _unlock(self, path, fd):
+        try:
+            os.unlink(path + '.lock')
+        except OSError:
+            pass
+        os.close(fd)
+
+    def call(self, key, ttl, run, stdout):
+        """
+        Write the output of the command ``key`` to the file ``stdout``, from
+        the cache if possible. Otherwise ``run(pipe)`` is called to run it,
+        writing its output to the file ``pipe`` and returning its exit code,
+        and the output is passed through to ``stdout`` and cached for
+        ``ttl`` seconds. Returns ``(result, hit)``, where ``hit`` is whether
+        the cache was used, and ``result`` is the exit code (``run``'s own
+        return value on a miss).
+        """
+        path = self._file(key)
+        entry = self._read(path)
+        if entry is not None:
+            return _replay(entry, stdout)
+        lock = None
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path, 0700)
+            lock = self._lock(path)
+        except (IOError, OSError):
+            # without a lock, just run the command
+            pass
+        try:
+            if lock is not None:
+                entry = self._read(path)
+                if entry is not None:
+                    return _replay(entry, stdout)
+            result, output = tee(run, stdout)
+            # commands killed by a signal didn't really finish
+            if lock is not None and result >= 0 and output is not None:
+                self._write(path, ttl, result, output)
+                self.sweep()
+            return result, False
+        finally:
+            if lock is not None:
+                self._unlock(path, lock)
+
+    def sweep(self):
+        """
+        Remove expired entries
+        """
+        now = time.time()
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return
+        for name in names:
+            if not _RE_ENTRY.match(name):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                if os.stat(path).st_mtime <= now:
+                    os.unlink(path)
+            except OSError:
+                pass
+
+def _replay(entry, stdout):
+    code, output = entry
+    stdout.write(output)
+    stdout.flush()
+    return code, True
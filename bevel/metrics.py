@@ -0,0 +1,174 @@
+"""
+Per-invocation timing metrics.
+
+When enabled (``--metrics SINK`` or ``BEVEL_METRICS=SINK``), each invocation
+writes one JSON record with the time spent in each phase (``import``,
+``startup``, ``parse``, ``resolve``, ``usage`` and ``execute``), the resolved
+command and its exit code. ``SINK`` is one of:
+
+* ``PATH`` or ``file:PATH``: append to a file
+* ``unix:PATH``: send a datagram to a Unix socket
+* ``fd:N``: write to an inherited file descriptor
+
+Writing a record never blocks: records are capped at ``MAX_RECORD`` bytes (so
+that appends and pipe writes are atomic), and are dropped if the sink isn't
+ready. Run this module to turn records into per-command percentiles::
+
+    $ python -m bevel.metrics /var/log/myapp-metrics.log
+"""
+
+import os
+import sys
+import time
+
+MAX_RECORD = 4096
+
+def _import_json():
+    from bevel import _import_json
+    return _import_json()
+
+def percentile(values, pct):
+    """
+    The ``pct``-th percentile of ``values``, by the nearest-rank method
+    """
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[index]
+
+class Metrics(object):
+    """
+    Collects phase timings for one invocation and writes them to ``sink``.
+
+    Phases are measured as laps: ``lap(name)`` charges the time since the
+    previous lap (or since this object was created) to ``name``.
+    """
+    def __init__(self, sink):
+        self.sink = sink
+        self.phases = {}
+        self.fields = {}
+        self.started = self.last = time.time()
+        self.emitted = False
+
+    def lap(self, name):
+        now = time.time()
+        self.phases[name] = self.phases.get(name, 0) + (now - self.last)
+        self.last = now
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    def record(self):
+        result = {
+            'time': self.started,
+            'pid': os.getpid(),
+            'total': time.time() - self.started,
+            'phases': self.phases,
+        }
+        result.update(self.fields)
+        return result
+
+    def emit(self, **fields):
+        """
+        Write the record to the sink, at most once. Failures are ignored.
+        """
+        if self.emitted:
+            return
+        self.emitted = True
+        self.set(**fields)
+        json = _import_json()
+        if json is None:
+            return
+        data = json.dumps(self.record()) + '\n'
+        if len(data) > MAX_RECORD:
+            return
+        try:
+            _write(self.sink, data)
+        except (IOError, OSError):
+            pass
+
+def _write(sink, data):
+    if sink.startswith('unix:'):
+        import socket
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sock.setblocking(0)
+            try:
+                sock.sendto(data, sink[len('unix:'):])
+            except socket.error:
+                pass
+        finally:
+            sock.close()
+    elif sink.startswith('fd:'):
+        import select
+        fd = int(sink[len('fd:'):])
+        # don't touch the descriptor's flags, since they're shared with
+        # whoever passed it to us; just skip the write if it would block
+        if select.select([], [fd], [], 0)[1]:
+            os.write(fd, data)
+    else:
+        if sink.startswith('file:'):
+            sink = sink[len('file:'):]
+        fd = os.open(sink, os.O_WRONLY|os.O_APPEND|os.O_CREAT|os.O_NONBLOCK, 0600)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+def aggregate(records):
+    """
+    Group ``records`` by command, returning ``{command: {phase: [seconds]}}``
+    (where the ``total`` phase is the whole invocation)
+    """
+    result = {}
+    for record in records:
+        command = ' '.join(record.get('command') or [])
+        phases = result.setdefault(command, {})
+        phases.setdefault('total', []).append(record['total'])
+        for name, seconds in record.get('phases', {}).items():
+            phases.setdefault(name, []).append(seconds)
+    return result
+
+def report(aggregated, stream=sys.stdout, phases=('total', 'resolve', 'execute')):
+    stream.write('%-30s %6s' % ('command', 'count'))
+    for name in phases:
+        stream.write(' %24s' % ('%s p50/p90/p99 (ms)' % name))
+    stream.write('\n')
+    commands = aggregated.keys()
+    commands.sort()
+    for command in commands:
+        found = aggregated[command]
+        stream.write('%-30s %6d' % (command or '-', len(found['total'])))
+        for name in phases:
+            values = found.get(name)
+            if values:
+                stream.write(' %24s' % '/'.join([ '%.1f' % (percentile(values, pct) * 1000)
+                                                  for pct in (50, 90, 99) ]))
+            else:
+                stream.write(' %24s' % '-')
+        stream.write('\n')
+
+def read_records(fds):
+    json = _import_json()
+    for fd in fds:
+        for line in fd:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if _import_json() is None:
+        sys.stderr.write('reading metrics needs json or simplejson\n')
+        raise SystemExit(1)
+    fds = [ open(path) for path in argv ] or [sys.stdin]
+    try:
+        report(aggregate(read_records(fds)))
+    finally:
+        for fd in fds:
+            if fd is not sys.stdin:
+                fd.close()
+
+if __name__ == '__main__':
+    main()
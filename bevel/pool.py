@@ -0,0 +1,100 @@
+"""
+A small, bounded thread pool.
+
+Unlike ``multiprocessing.pool``, ``imap_unordered`` consumes its input lazily
+(at most a few items ahead of the workers), so it can be fed from a generator
+such as ``os.walk`` and its results can be streamed as they complete.
+"""
+
+import sys
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# how often blocked threads check whether the pool has been abandoned
+POLL_INTERVAL = 0.1
+
+_DONE = object()
+
+def _put(q, item, stopped):
+    while not stopped.isSet():
+        try:
+            q.put(item, True, POLL_INTERVAL)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def _get(q, stopped):
+    while not stopped.isSet():
+        try:
+            return q.get(True, POLL_INTERVAL)
+        except queue.Empty:
+            pass
+    return _DONE
+
+def imap_unordered(func, iterable, jobs):
+    """
+    Yield ``func(item)`` for each item in ``iterable``, running up to ``jobs``
+    calls at once, in whatever order they finish. If ``func`` raises, the
+    exception is re-raised here. Closing the generator early stops the
+    workers.
+    """
+    if jobs <= 1:
+        for item in iterable:
+            yield func(item)
+        return
+
+    stopped = threading.Event()
+    todo = queue.Queue(jobs * 4)
+    results = queue.Queue()
+
+    def feed():
+        try:
+            try:
+                for item in iterable:
+                    if not _put(todo, item, stopped):
+                        return
+            except Exception:
+                results.put((False, sys.exc_info()))
+        finally:
+            for i in range(jobs):
+                _put(todo, _DONE, stopped)
+
+    def work():
+        try:
+            while True:
+                item = _get(todo, stopped)
+                if item is _DONE:
+                    return
+                try:
+                    results.put((True, func(item)))
+                except Exception:
+                    results.put((False, sys.exc_info()))
+        finally:
+            results.put(_DONE)
+
+    threads = [ threading.Thread(target=feed) ]
+    threads.extend([ threading.Thread(target=work) for i in range(jobs) ])
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+
+    try:
+        running = jobs
+        while running:
+            result = results.get()
+            if result is _DONE:
+                running -= 1
+                continue
+            ok, value = result
+            if not ok:
+                raise value[0], value[1], value[2]
+            yield value
+    finally:
+        stopped.set()
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,213 @@
+"""
+Completion of leaf commands' arguments by provider scripts.
+
+A command directory may hold a ``_complete`` script next to its ``_driver``,
+which completes the arguments of the leaf commands in it (and in any
+directories beneath it without a provider of their own). The provider is run
+with the words of the command line before the one being completed (e.g.
+``db status --cluster``) and prints one candidate per line; ``bevel`` keeps
+the ones which start with the word being completed.
+
+Candidates are cached per user, keyed by the provider and its arguments. A
+provider declares how many seconds its candidates stay valid with a header
+comment (``# bevel-ttl: 300``) in its first few lines. Without one, cached
+candidates are only used when the provider fails or runs for longer than the
+timeout, in which case whatever was cached last (even if expired) is
+returned. The cache holds a bounded number of entries, and evicts the least
+recently used ones.
+"""
+
+import os
+import re
+import time
+import errno
+import signal
+import select
+
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+from bevel import atomic
+
+# how long a provider may run before it's killed
+TIMEOUT = 1.0
+# only this much of a provider is read to find its TTL
+MAX_HEADER = 1024
+# at most this many candidates are kept for each command line
+MAX_CANDIDATES = 10000
+
+_RE_TTL = re.compile(r'^#\s*bevel-ttl:\s*(\d+(?:\.\d*)?)\s*$', re.MULTILINE)
+
+def declared_ttl(path):
+    """
+    How many seconds the provider ``path`` says its candidates stay valid
+    (0 if it doesn't say)
+    """
+    try:
+        fd = open(path, 'rb')
+        try:
+            header = fd.read(MAX_HEADER)
+        finally:
+            fd.close()
+    except IOError:
+        return 0
+    match = _RE_TTL.search(header)
+    if match is None:
+        return 0
+    return float(match.group(1))
+
+class ProviderCache(object):
+    """
+    Candidates from providers, one file per command line in ``path``. A
+    file's mtime is when it was last used, which decides what's evicted once
+    there are more than ``max_entries``.
+    """
+    MAX_ENTRIES = 256
+
+    def __init__(self, path, max_entries=None):
+        self.path = path
+        self.max_entries = max_entries or self.MAX_ENTRIES
+
+    def _file(self, key):
+        return os.path.join(self.path, sha1(key).hexdigest())
+
+    def get(self, key):
+        """
+        The ``(expires, candidates)`` cached for ``key``, or ``None``
+        """
+        path = self._file(key)
+        try:
+            fd = open(path, 'rb')
+            try:
+                data = fd.read()
+            finally:
+                fd.close()
+        except IOError:
+            return None
+        lines = data.split('\n')
+        try:
+            expires = float(lines[0])
+        except ValueError:
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return expires, [ line for line in lines[1:] if line ]
+
+    def put(self, key, expires, candidates):
+        """
+        Cache ``candidates`` for ``key`` until ``expires``. Failing to write
+        the cache is not an error.
+        """
+        lines = [ '%r\n' % expires ] + \
+          [ '%s\n' % line for line in candidates[:MAX_CANDIDATES] ]
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path, 0700)
+            atomic.write(self._file(key), lambda fd: fd.writelines(lines))
+            self.evict()
+        except (IOError, OSError):
+            pass
+
+    def evict(self):
+        """
+        Remove the least recently used entries beyond ``max_entries``
+        """
+        names = os.listdir(self.path)
+        if len(names) <= self.max_entries:
+            return
+        entries = []
+        for name in names:
+            path = os.path.join(self.path, name)
+            try:
+                entries.append((os.stat(path).st_mtime, path))
+            except OSError:
+                pass
+        entries.sort()
+        for mtime, path in entries[:len(entries) - self.max_entries]:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+def run_provider(path, args, timeout=None):
+    """
+    Run the provider ``path`` with ``args``, returning the candidates it
+    printed, or ``None`` if it failed or didn't finish within ``timeout``
+    seconds (in which case it's killed)
+    """
+    import subprocess
+    if timeout is None:
+        timeout = TIMEOUT
+    deadline = time.time() + timeout
+    devnull = open(os.devnull, 'r+')
+    try:
+        try:
+            proc = subprocess.Popen([path] + list(args), close_fds=True,
+              stdin=devnull, stdout=subprocess.PIPE, stderr=devnull,
+              preexec_fn=os.setpgrp)
+        except OSError:
+            return None
+    finally:
+        devnull.close()
+    fd = proc.stdout.fileno()
+    chunks = []
+    try:
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                _kill(proc)
+                return None
+            try:
+                ready = select.select([fd], [], [], remaining)[0]
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                continue
+            if not ready:
+                continue
+            data = os.read(fd, 65536)
+            if not data:
+                break
+            chunks.append(data)
+    finally:
+        proc.stdout.close()
+    # the output is complete, but the provider might not have exited yet
+    while proc.poll() is None:
+        if time.time() >= deadline:
+            _kill(proc)
+            return None
+        time.sleep(0.005)
+    if proc.returncode != 0:
+        return None
+    return [ line for line in ''.join(chunks).split('\n') if line ]
+
+def _kill(proc):
+    # the provider leads its own process group, so anything it started goes
+    # too
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        pass
+    proc.wait()
+
+def complete(path, args, cache, timeout=None):
+    """
+    The candidates provider ``path`` gives for ``args``, from ``cache`` (a
+    ``ProviderCache``) while they're valid
+    """
+    key = '\0'.join([os.path.abspath(path)] + list(args))
+    entry = cache.get(key)
+    now = time.time()
+    if entry is not None and entry[0] > now:
+        return entry[1]
+    candidates = run_provider(path, args, timeout)
+    if candidates is None:
+        if entry is None:
+            return []
+        return entry[1]
+    cache.put(key, now + declared_ttl(path), candidates)
+    return candidates
@@ -0,0 +1,112 @@
+"""
+Resource usage of finished subcommands, and soft limits on it.
+
+Children are reaped with ``os.wait4``, which reports what the child (and any
+of its own children it waited for) used: CPU time, peak memory, page faults
+and context switches. ``Result`` carries that along with the exit code.
+"""
+
+import os
+import errno
+
+# ``Result`` attributes which soft limits can be set on
+FIELDS = ['elapsed', 'user', 'sys', 'cpu', 'maxrss', 'minflt', 'majflt',
+          'nvcsw', 'nivcsw']
+
+class Result(int):
+    """
+    The exit code of a subcommand, along with the resources it used:
+
+    * ``elapsed``: wall clock seconds
+    * ``user``, ``sys`` and ``cpu``: user, system and total CPU seconds
+    * ``maxrss``: peak resident set size, in kilobytes
+    * ``minflt`` and ``majflt``: page faults without and with I/O
+    * ``nvcsw`` and ``nivcsw``: voluntary (e.g. waiting on I/O) and
+      involuntary (preempted) context switches
+
+    Resource fields are ``None`` if usage couldn't be collected.
+    """
+    def __new__(cls, code, rusage=None, elapsed=None):
+        self = int.__new__(cls, code)
+        self.elapsed = elapsed
+        for name in FIELDS[1:]:
+            setattr(self, name, None)
+        if rusage is not None:
+            self.user = rusage.ru_utime
+            self.sys = rusage.ru_stime
+            self.cpu = rusage.ru_utime + rusage.ru_stime
+            self.maxrss = rusage.ru_maxrss
+            self.minflt = rusage.ru_minflt
+            self.majflt = rusage.ru_majflt
+            self.nvcsw = rusage.ru_nvcsw
+            self.nivcsw = rusage.ru_nivcsw
+        return self
+
+    def as_dict(self):
+        result = {'exit_code': int(self)}
+        for name in FIELDS:
+            value = getattr(self, name)
+            if isinstance(value, float):
+                value = round(value, 6)
+            result[name] = value
+        return result
+
+def wait(pid):
+    """
+    Reap child ``pid``, returning its exit code (negative if it was killed by
+    a signal, like ``subprocess``) and its resource usage
+    """
+    while True:
+        try:
+            status, rusage = os.wait4(pid, 0)[1:]
+            break
+        except OSError, e:
+            if e.errno != errno.EINTR:
+                raise
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status), rusage
+    return os.WEXITSTATUS(status), rusage
+
+def load_limits(path):
+    """
+    Read soft limits from the JSON file ``path``, which maps commands (e.g.
+    ``"db status"``, or ``""`` for every command) to ``{field: limit}``
+    """
+    from bevel import _import_json
+    json = _import_json()
+    if json is None:
+        raise ValueError('reading limits needs json or simplejson')
+    fd = open(path)
+    try:
+        data = json.load(fd)
+    finally:
+        fd.close()
+    limits = {}
+    for command, fields in data.items():
+        for name in fields:
+            if name not in FIELDS:
+                raise ValueError('unknown limit "%s" for "%s"' % (name, command))
+        limits[tuple(command.split())] = fields
+    return limits
+
+def exceeded(limits, command, result):
+    """
+    The ``(field, value, limit)`` of each soft limit in ``limits`` which
+    ``result`` (of running ``command``) went over. A command's limits are
+    the ones set on it or its closest parent.
+    """
+    command = tuple(command)
+    for i in range(len(command), -1, -1):
+        fields = limits.get(command[:i])
+        if fields is not None:
+            break
+    else:
+        return []
+    over = []
+    names = fields.keys()
+    names.sort()
+    for name in names:
+        value = getattr(result, name)
+        if value is not None and value > fields[name]:
+            over.append((name, value, fields[name]))
+    return over
@@ -0,0 +1,134 @@
+"""
+A resident completion server for ``bevel`` apps.
+
+The server keeps an index of the command tree in memory (following changes to
+it through inotify where available, and polling directory mtimes otherwise)
+and answers completion requests over a per-user Unix socket, so that pressing
+TAB doesn't have to walk the tree again. ``bevel-complete`` (``bevel.client``)
+is the matching client; when no server is listening it falls back to ``bevel
+--complete``.
+"""
+
+import os
+import sys
+import stat
+import time
+import errno
+import signal
+import socket
+import struct
+import SocketServer
+
+from bevel.client import socket_path
+
+# how often the server checks whether the tree changed underneath it
+REFRESH_INTERVAL = 2.0
+MAX_REQUEST = 64 * 1024
+# Linux's value, which Python 2's ``socket`` module doesn't export
+SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17)
+_UCRED = struct.Struct('3i')
+
+def _ensure_socket_dir(path):
+    dirname = os.path.dirname(path)
+    try:
+        os.makedirs(dirname, 0700)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+    if not is_private_dir(dirname):
+        raise RuntimeError('socket directory "%s" is not private' % dirname)
+
+def is_private_dir(path):
+    """
+    Whether ``path`` is a directory only this user can get into
+    """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and \
+        not st.st_mode & 077
+
+def peer_uid(sock):
+    """
+    The uid of the process on the other end of the Unix socket ``sock``, or
+    ``None`` where that can't be found out
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    data = sock.getsockopt(socket.SOL_SOCKET, SO_PEERCRED, _UCRED.size)
+    return _UCRED.unpack(data)[1]
+
+class CompletionHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        comp_line = self.rfile.read(MAX_REQUEST)
+        self.server.refresh()
+        result = self.server.app.complete_line(comp_line)
+        self.wfile.write('\n'.join(result))
+
+class CompletionServer(SocketServer.UnixStreamServer):
+    """
+    Serve completions for ``app`` (a ``Bevel`` instance) on ``path``
+    """
+    def __init__(self, app, path):
+        from bevel.index import build_index
+        from bevel.live import LiveIndex, available
+        self._build_index = build_index
+        self.app = app
+        # a live index keeps itself up to date; otherwise poll for changes
+        self.live = available() and len(app.layers) == 1
+        if self.live:
+            if not isinstance(app.tree, LiveIndex):
+                self.app.tree = LiveIndex(app)
+        else:
+            self.app.tree = build_index(app)
+        self.checked = time.time()
+        _ensure_socket_dir(path)
+        if _is_listening(path):
+            raise RuntimeError('a server is already listening on "%s"' % path)
+        if os.path.exists(path):
+            os.unlink(path)
+        SocketServer.UnixStreamServer.__init__(self, path, CompletionHandler)
+
+    def refresh(self):
+        if self.live:
+            return
+        now = time.time()
+        if now - self.checked < REFRESH_INTERVAL:
+            return
+        self.checked = now
+        if not self.app.tree.is_fresh():
+            self.app.tree = self._build_index(self.app)
+            self.app.clear_cache()
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        if self.live:
+            self.app.tree.close()
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+def _is_listening(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(path)
+            return True
+        except socket.error:
+            return False
+    finally:
+        sock.close()
+
+def _exit(signum, frame):
+    raise SystemExit
+
+def serve_completions(app):
+    server = CompletionServer(app, socket_path(app.bin_dir))
+    # make sure the socket is cleaned up when we're told to stop
+    signal.signal(signal.SIGTERM, _exit)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
@@ -0,0 +1,308 @@
+"""
+Generate static shell scripts from ``bevel`` apps: bash/zsh completion
+scripts, and standalone ``sh`` dispatchers.
+
+The completion script has every command's subcommands built in, so completion
+doesn't need to start ``bevel`` (or any other process) at all. Before using
+the built-in table, it compares the mtimes of the directories along the words
+being completed (in every layer) with the script's own, and if any of them is
+newer, falls back to ``bevel --complete``. That catches commands being added,
+removed or renamed in those directories, but not changes which leave their
+mtimes alone: a script or ``_driver`` made (non-)executable, or a ``_driver``
+added to or removed from one of their subdirectories. Regenerate the script
+after such changes.
+"""
+
+import os
+import re
+
+SHELLS = ['bash', 'zsh']
+
+_BASH_TEMPLATE = """\
+# bash completion for `%(name)s', generated by bevel from %(bin_dir)s
+#
+# Source this file (rather than eval'ing it) so that it can tell when the
+# command tree has changed since it was generated.
+%(func)s_source="${BASH_SOURCE[0]}"
+
+%(func)s_subcommands() {
+    case "$1" in
+%(cases)s
+        *) subs='' ;;
+    esac
+}
+
+%(func)s_is_stale() {
+    local layer dir w
+    [[ -f "$%(func)s_source" ]] || return 0
+    for layer in %(layers)s; do
+        dir="$layer"
+        for w in '' "$@"; do
+            dir="$dir${w:+/$w}"
+            [[ -d "$dir" ]] || break
+            [[ "$dir" -nt "$%(func)s_source" ]] && return 0
+        done
+    done
+    return 1
+}
+
+%(func)s() {
+    local IFS=' ' cur="${COMP_WORDS[COMP_CWORD]}" parent subs w
+    parent="${COMP_WORDS[*]:1:COMP_CWORD-1}"
+    COMPREPLY=()
+    if %(func)s_is_stale $parent $cur; then
+        local IFS=$'\\n'
+        COMPREPLY=( $(COMP_LINE="$COMP_LINE" %(bevel)s --bindir %(bin_dir)s --complete) )
+        return
+    fi
+    %(func)s_subcommands "$parent"
+    for w in $subs; do
+        [[ "$w" == "$cur"* ]] && COMPREPLY+=("$w")
+    done
+    if [[ ${#COMPREPLY[@]} -eq 0 && -n "$cur" ]]; then
+        %(func)s_subcommands "${parent:+$parent }$cur"
+        for w in $subs; do
+            [[ "$w" == "$cur"* ]] && COMPREPLY+=("$w")
+        done
+    fi
+}
+
+complete -F %(func)s %(name)s
+"""
+
+_ZSH_TEMPLATE = """\
+# zsh completion for `%(name)s', generated by bevel from %(bin_dir)s
+#
+# Source this file (rather than eval'ing it) so that it can tell when the
+# command tree has changed since it was generated.
+%(func)s_source="${(%%):-%%x}"
+
+%(func)s_subcommands() {
+    case "$1" in
+%(cases)s
+        *) subs='' ;;
+    esac
+}
+
+%(func)s_is_stale() {
+    local layer dir w
+    [[ -f "$%(func)s_source" ]] || return 0
+    for layer in %(layers)s; do
+        dir="$layer"
+        for w in '' "$@"; do
+            dir="$dir${w:+/$w}"
+            [[ -d "$dir" ]] || break
+            [[ "$dir" -nt "$%(func)s_source" ]] && return 0
+        done
+    done
+    return 1
+}
+
+%(func)s() {
+    local cur="${words[CURRENT]}" parent="${(j: :)words[2,CURRENT-1]}" subs w
+    local -a matches
+    if %(func)s_is_stale ${=parent} $cur; then
+        matches=( ${(f)"$(COMP_LINE="$BUFFER" %(bevel)s --bindir %(bin_dir)s --complete)"} )
+        compadd -a matches
+        return
+    fi
+    %(func)s_subcommands "$parent"
+    for w in ${=subs}; do
+        [[ "$w" == "$cur"* ]] && matches+=("$w")
+    done
+    if (( ${#matches} == 0 )) && [[ -n "$cur" ]]; then
+        %(func)s_subcommands "${parent:+$parent }$cur"
+        for w in ${=subs}; do
+            [[ "$w" == "$cur"* ]] && matches+=("$w")
+        done
+    fi
+    compadd -a matches
+}
+
+compdef %(func)s %(name)s
+"""
+
+_TEMPLATES = {'bash': _BASH_TEMPLATE, 'zsh': _ZSH_TEMPLATE}
+
+def quote(value):
+    """
+    Quote ``value`` for safe use as a single shell word
+    """
+    return "'%s'" % value.replace("'", "'\\''")
+
+def emit_completion(app, shell, bevel='bevel'):
+    """
+    Generate a completion script for ``app`` (a ``Bevel`` instance) for
+    ``shell`` (one of ``SHELLS``)
+    """
+    from bevel.index import build_index
+    index = build_index(app)
+    nodes = index.nodes.items()
+    nodes.sort()
+    cases = []
+    for args, node in nodes:
+        if not node[0]:
+            continue
+        cases.append('        %s) subs=%s ;;' % (quote(' '.join(args)),
+                                                 quote(' '.join(node[2]))))
+    return _TEMPLATES[shell] % {
+        'name': app.name,
+        'func': '_bevel_%s' % re.sub('[^A-Za-z0-9]', '_', app.name),
+        'bin_dir': quote(index.bin_dir),
+        'layers': ' '.join([ quote(layer) for layer in index.bin_dir.split(os.pathsep) ]),
+        'bevel': bevel,
+        'cases': '\n'.join(cases),
+    }
+
+_DISPATCHER_TEMPLATE = """\
+#!/bin/sh
+# `%(name)s' dispatcher, compiled by bevel from %(bin_dir)s
+# (tree fingerprint %(fingerprint)s).
+#
+# This is a snapshot of the command tree: recompile it whenever the tree
+# changes.
+
+# suggest the subcommands (the remaining arguments) closest to the mistyped
+# $1, the same way ``Bevel._suggestions`` does
+suggest() {
+    LC_ALL=C awk -v q="'" -v max=%(max_suggestions)d -v cap=%(max_distance)d '
+    function distance(a, b,    i, j, x, cost, previous, current) {
+        for (j = 0; j <= length(b); j++)
+            previous[j] = j
+        for (i = 1; i <= length(a); i++) {
+            current[0] = i
+            for (j = 1; j <= length(b); j++) {
+                cost = substr(a, i, 1) != substr(b, j, 1)
+                x = previous[j] + 1
+                if (current[j - 1] + 1 < x) x = current[j - 1] + 1
+                if (previous[j - 1] + cost < x) x = previous[j - 1] + cost
+                current[j] = x
+            }
+            for (j = 0; j <= length(b); j++)
+                previous[j] = current[j]
+        }
+        return previous[length(b)]
+    }
+    BEGIN {
+        word = ARGV[1]
+        limit = int(length(word) / 3)
+        if (limit < 1) limit = 1
+        if (limit > length(word) - 1) limit = length(word) - 1
+        if (limit > cap) limit = cap
+        if (limit < 1) exit
+        best = limit + 1
+        for (i = 2; i < ARGC; i++) {
+            d[i] = distance(word, ARGV[i])
+            if (d[i] < best) best = d[i]
+        }
+        found = 0
+        for (i = 2; i < ARGC && found < max; i++)
+            if (d[i] == best && best <= limit)
+                names = names (found++ ? ", " : "") ARGV[i]
+        if (found)
+            printf "Unknown subcommand %%s%%s%%s; did you mean: %%s?\\n\\n", q, word, q, names
+        exit
+    }' "$@"
+}
+
+resolved=%(root)s
+consumed=0
+path=
+i=0
+for arg in "$@"; do
+    case "$arg" in
+        ''|*/*) break ;;
+    esac
+    path="$path/$arg"
+    i=$((i + 1))
+    case "$path" in
+%(nodes)s
+%(dirs)s
+        *) break ;;
+    esac
+done
+shift $consumed
+
+case "$resolved" in
+%(dispatch)s
+    *)
+        echo %(unresolved)s >&2
+        exit 1 ;;
+esac
+"""
+
+def _is_executable_format(path):
+    """
+    Whether the kernel can run ``path`` directly (otherwise running it fails
+    with ``ENOEXEC``)
+    """
+    fd = open(path, 'rb')
+    try:
+        magic = fd.read(4)
+    finally:
+        fd.close()
+    return magic.startswith('#!') or magic == '\x7fELF'
+
+def compile_dispatcher(app):
+    """
+    Compile ``app`` (a ``Bevel`` instance) into a POSIX ``sh`` script which
+    dispatches commands exactly like ``Bevel.run``, without starting Python.
+
+    Arguments are taken as given (i.e. from ``"$@"``), rather than being
+    re-split from a single string the way ``--args "$*"`` is.
+    """
+    from bevel.index import build_index
+    index = build_index(app)
+    nodes = index.nodes.items()
+    nodes.sort()
+
+    def key(args):
+        return quote('/' + '/'.join(args))
+
+    node_cases = []
+    dispatch = []
+    for args, node in nodes:
+        args = list(args)
+        if args:
+            node_cases.append('        %s) resolved="$path"; consumed=$i ;;' % key(args))
+        script = os.path.join(index.layer(args), *args)
+        if node[0]:
+            script = os.path.join(script, app.DRIVER_NAME)
+        if node[0] and node[1]:
+            usage = app._default_usage(' '.join([app.name] + args), node[2])
+            action = 'printf \'%%s\\n\' %s' % quote(usage)
+            if node[2]:
+                action += '\n        if [ $# -gt 0 ]; then suggest "$1" %s; fi' % \
+                  ' '.join([ quote(name) for name in node[2] ])
+        elif not _is_executable_format(script):
+            action = 'echo %s >&2\n        exit 1' % quote(
+              '%s: internal error: could not determine subcommand runtime' % app.name)
+        elif node[0]:
+            # like ``Bevel.run``, drivers get no arguments and their exit
+            # status is ignored
+            action = '%s\n        exit 0' % quote(script)
+        else:
+            action = 'exec %s "$@"' % quote(script)
+        dispatch.append('    %s)\n        %s ;;' % (key(args), action))
+
+    dir_cases = []
+    dirs = index.mtimes.keys()
+    dirs.sort()
+    for rel in dirs:
+        args = rel and rel.split(os.path.sep) or []
+        if args and tuple(args) not in index.nodes:
+            dir_cases.append('        %s) ;;' % key(args))
+
+    return _DISPATCHER_TEMPLATE % {
+        'name': app.name,
+        'bin_dir': index.bin_dir,
+        'fingerprint': index.fingerprint(),
+        'root': () in index.nodes and '/' or '',
+        'max_suggestions': app.MAX_SUGGESTIONS,
+        'max_distance': app.MAX_SUGGESTION_DISTANCE,
+        'nodes': '\n'.join(node_cases),
+        'dirs': '\n'.join(dir_cases),
+        'dispatch': '\n'.join(dispatch),
+        'unresolved': quote('%s: internal error: could not resolve any valid, '
+                            'runnable scripts' % app.name),
+    }
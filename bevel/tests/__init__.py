@@ -1,9 +1,37 @@
 import unittest
 import errno
-from bevel import Bevel, InternalError
+from bevel import Bevel, InternalError, create_cli, _fast_parse
+from bevel.server import CompletionServer
+from bevel.client import request_completions
+from bevel.zygote import ZygoteServer, Fallback, request_run
+from bevel.completion import Trie, UsageLog, SuggestionIndex, edit_distance
+from bevel.tests import bench
+from bevel.metrics import Metrics, aggregate, report
+from bevel.rusage import load_limits
+from bevel.bundle import pack
+from bevel.providers import ProviderCache
+from bevel.compact import CompactIndex, CompactIndexError
+import bevel.bundle
+import bevel.compact
+import bevel.providers
+import bevel.metrics
+import bevel.fanout
+from bevel.shell import emit_completion, compile_dispatcher, quote
+from bevel.index import build_index
+from bevel import live
 from mock import Mock, patch
 import StringIO
 import sys
+import os
+import shutil
+import socket
+import select
+import signal
+import threading
+import subprocess
+import time
+import random
+import json
 import tempfile
 
 class Stdout(object):
@@ -65,21 +93,21 @@ class BevelStubTestCases(unittest.TestCase):
         self.assertEquals(self.bevel._args_to_path(['bar']), '/foo/bar')
         self.assertEquals(self.bevel._args_to_path(['bar', 'baz']), '/foo/bar/baz')
 
-    @patch('os.path.isdir')
-    @patch('os.path.isfile')
+    @patch('bevel.Bevel._isdir')
+    @patch('bevel.Bevel._isfile')
     def test_get_bin_dir(self, isdir, isfile):
         isdir.return_value = True
         isfile.return_value = True
         self.assertEquals(self.bevel._get_bin('/foo/bar'), '/foo/bar/_driver')        
     
-    @patch('os.path.isdir')
-    @patch('os.path.isfile')
+    @patch('bevel.Bevel._isdir')
+    @patch('bevel.Bevel._isfile')
     def test_get_bin_dir(self, isfile, isdir):
         isdir.return_value = True
         isfile.return_value = False
         self.assertEquals(self.bevel._get_bin('/foo/bar'), None)        
 
-    @patch('os.path.isfile')
+    @patch('bevel.Bevel._isfile')
     def test_get_bin(self, isfile):
         isfile.return_value = True
         self.assertEquals(self.bevel._get_bin('/foo/bar'), '/foo/bar')        
@@ -87,6 +115,17 @@ class BevelStubTestCases(unittest.TestCase):
     def test_get_bin_missing(self):
         self.assertEquals(self.bevel._get_bin('/foo/bar'), None)        
 
+    @patch('os.stat')
+    def test_stat_cache(self, stat):
+        stat.side_effect = OSError(errno.ENOENT, 'foo')
+        self.assertEquals(self.bevel._get_bin('/foo/bar'), None)
+        self.assertEquals(self.bevel._get_bin('/foo/bar'), None)
+        self.assertEquals(stat.call_count, 1)
+        self.assertEquals(self.bevel.syscalls, 1)
+        self.bevel.clear_cache()
+        self.assertEquals(self.bevel._get_bin('/foo/bar'), None)
+        self.assertEquals(stat.call_count, 2)
+
     def test_command_is_valid(self):
         for cmd in ['foo', '48', 'foo-bar', 'foo-bar-baz']:
             self.assertTrue(self.bevel._is_valid_name(cmd))
@@ -129,13 +168,25 @@ class BevelStubTestCases(unittest.TestCase):
         popen.side_effect = OSError(9, 'foo')
         self.assertRaises(OSError, self.bevel._run, 'foo', ['bar'])
 
+    @patch('bevel.rusage.wait', Mock(return_value=(0, None)))
     @patch('subprocess.Popen')
     def test_successful_run(self, popen):
         proc = Mock()
-        proc.returncode = 0
         popen.return_value = proc
         self.assertEquals(self.bevel._run('foo', ['bar']), 0)
 
+    @patch('os.dup2')
+    @patch('os.execv')
+    def test_exec_run(self, execv, dup2):
+        self.bevel._run('foo', ['bar'], use_exec=True)
+        execv.assert_called_with('foo', ['foo', 'bar'])
+
+    @patch('os.dup2')
+    @patch('os.execv')
+    def test_exec_missing_runtime(self, execv, dup2):
+        execv.side_effect = OSError(errno.ENOEXEC, 'foo')
+        self.assertRaises(InternalError, self.bevel._run, 'foo', ['bar'], use_exec=True)
+
 class BevelRealTestCases(TestCase):
     fixture_dir = 'bevel/tests/fixtures/myapplib'
 
@@ -153,6 +204,16 @@ class BevelRealTestCases(TestCase):
         self.assertEquals(self.bevel._subcommands([]), ['emptydriver', 'hasdriver', 'hasdriver2', 'takesargs'])
         self.assertEquals(self.bevel._subcommands(['hasdriver', 'subcommand']), [])
 
+    def test_subcommands_syscalls(self):
+        self.bevel._subcommands(['hasdriver'])
+        # resolving ``hasdriver`` (two stats and an access check), one
+        # listing, then a stat and an access check for each of its two
+        # subcommands (fewer if ``scandir`` is available)
+        self.assertTrue(self.bevel.syscalls <= 3 + 1 + 2 * 2, self.bevel.syscalls)
+        syscalls = self.bevel.syscalls
+        self.bevel._subcommands(['hasdriver'])
+        self.assertEquals(self.bevel.syscalls, syscalls + 1)
+
     def test_is_regular_command(self):
         self.assertTrue(self.bevel._is_regular_command('%s/hasdriver/subcommand' % self.fixture_dir))
         self.assertFalse(self.bevel._is_regular_command('%s/nodriver/subcommand' % self.fixture_dir))
@@ -185,3 +246,1612 @@ class BevelRealTestCases(TestCase):
     def test_argument_passing(self):
         self.bevel.run('takesargs foo')
         self.assertEquals('foo\n', self.stdout.get())
+
+class BevelIndexTestCases(TestCase):
+    fixture_dir = 'bevel/tests/fixtures/myapplib'
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.bevel = Bevel(self.fixture_dir, cache_dir=self.cache_dir)
+        super(BevelIndexTestCases, self).setUp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        super(BevelIndexTestCases, self).tearDown()
+
+    def test_matches_filesystem(self):
+        plain = Bevel(self.fixture_dir)
+        for args in ([], ['hasdriver'], ['hasdriver', 'subcommand'],
+          ['nodriver', 'subcommand'], ['hasbaddriver'], ['nodriver'],
+          ['emptydriver', 'foo', 'bar'], ['takesargs', 'foo']):
+            self.assertEquals(self.bevel._resolve_args(list(args)),
+                              plain._resolve_args(list(args)))
+            self.assertEquals(self.bevel._subcommands(list(args)),
+                              plain._subcommands(list(args)))
+        for str_args in ('', 'hasdrive', 'hasdriver ', 'hasdriver s', 'x'):
+            self.assertEquals(self.bevel.complete(str_args),
+                              plain.complete(str_args))
+
+    @patch('os.access')
+    @patch('os.path.isfile')
+    def test_no_filesystem_checks(self, isfile, access):
+        bevel = Bevel(self.fixture_dir, cache_dir=self.cache_dir)
+        bevel._resolve_args(['hasdriver', 'subcommand', 'foo'])
+        bevel.complete('hasdriver ')
+        self.assertFalse(isfile.called)
+        self.assertFalse(access.called)
+
+    def test_missing_command(self):
+        self.bevel.run('emptydriver foo')
+        self.assertEquals('usage: myapplib emptydriver <subcommand> [arguments] '
+                          '[options]\n\nValid subcommands are: subcommand\n\n',
+                          self.stdout.get())
+
+    def test_stale_index(self):
+        bin_dir = os.path.join(self.cache_dir, 'app')
+        shutil.copytree(self.fixture_dir, bin_dir)
+        self.assertEquals(Bevel(bin_dir, cache_dir=self.cache_dir)._subcommands(['hasdriver']),
+                          ['dashed-command', 'subcommand'])
+        new = os.path.join(bin_dir, 'hasdriver', 'another')
+        open(new, 'w').write('#!/bin/bash\n')
+        os.chmod(new, 0755)
+        os.utime(os.path.dirname(new), (0, 0))
+        self.assertEquals(Bevel(bin_dir, cache_dir=self.cache_dir)._subcommands(['hasdriver']),
+                          ['another', 'dashed-command', 'subcommand'])
+
+    def test_symlinked_aliases(self):
+        bin_dir = os.path.join(self.cache_dir, 'app')
+        os.makedirs(os.path.join(bin_dir, 'list'))
+        for rel in ('_driver', 'list/_driver', 'list/x'):
+            open(os.path.join(bin_dir, rel), 'w').write('#!/bin/sh\necho %s\n' % rel)
+            os.chmod(os.path.join(bin_dir, rel), 0755)
+        os.symlink('list', os.path.join(bin_dir, 'ls'))
+        # a cycle, which is cut off rather than walked forever
+        os.symlink('..', os.path.join(bin_dir, 'list', 'up'))
+        indexed, plain = Bevel(bin_dir, cache_dir=self.cache_dir), Bevel(bin_dir)
+        for args in (['ls', 'x'], ['list', 'x'], ['ls']):
+            self.assertEquals(indexed._resolve_args(list(args)), plain._resolve_args(list(args)))
+        self.assertEquals(indexed._subcommands([]), ['list', 'ls'])
+        self.assertEquals(indexed._subcommands(['ls']), ['x'])
+
+class CompletionServerTestCases(unittest.TestCase):
+    fixture_dir = 'bevel/tests/fixtures/myapplib'
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'complete.sock')
+        self.server = CompletionServer(Bevel(self.fixture_dir), self.path)
+
+    def tearDown(self):
+        self.server.server_close()
+        shutil.rmtree(self.tempdir)
+
+    def request(self, comp_line):
+        thread = threading.Thread(target=self.server.handle_request)
+        thread.start()
+        try:
+            return request_completions(self.path, comp_line)
+        finally:
+            thread.join()
+
+    def test_completion(self):
+        self.assertEquals(self.request('myapp hasdriver '), 'dashed-command\nsubcommand')
+        self.assertEquals(self.request('myapp hasdrive'), 'hasdriver\nhasdriver2')
+        self.assertEquals(self.request('myapp hasdriver f'), '')
+
+    def test_already_running(self):
+        self.assertRaises(RuntimeError, CompletionServer, Bevel(self.fixture_dir), self.path)
+
+    def test_no_server(self):
+        self.server.server_close()
+        self.assertRaises(socket.error, request_completions, self.path, 'myapp ')
+
+class ZygoteTestCases(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tempdir, 'app')
+        self.path = os.path.join(self.tempdir, 'run.sock')
+        self.script('_driver', '')
+        self.script('env', '#!/bin/sh\necho "$ZYGOTE_TEST $(pwd) $*"\nexit 3\n')
+        self.script('limits', '#!/bin/sh\numask\nulimit -c\n')
+        self.server = ZygoteServer(Bevel(self.root), self.path)
+
+    def tearDown(self):
+        self.server.server_close()
+        shutil.rmtree(self.tempdir)
+
+    def script(self, rel, body):
+        path = os.path.join(self.root, rel)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, 'w').write(body)
+        os.chmod(path, 0755)
+
+    def request(self, args):
+        """
+        Run ``args`` through the server, with stdout and stderr pointed at a
+        file, and return the exit code and output
+        """
+        output = tempfile.TemporaryFile()
+        saved = [ os.dup(fd) for fd in (1, 2) ]
+        thread = threading.Thread(target=self.server.handle_request)
+        thread.start()
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(output.fileno(), 1)
+            os.dup2(output.fileno(), 2)
+            try:
+                return request_run(self.path, self.root, args), self.read(output)
+            finally:
+                for fd, copy in zip((1, 2), saved):
+                    os.dup2(copy, fd)
+                    os.close(copy)
+        finally:
+            thread.join()
+
+    def read(self, output):
+        output.seek(0)
+        return output.read()
+
+    def test_run(self):
+        os.environ['ZYGOTE_TEST'] = 'from the client'
+        cwd = os.getcwd()
+        os.chdir(self.tempdir)
+        try:
+            code, output = self.request('env "a b" c')
+        finally:
+            os.chdir(cwd)
+            del os.environ['ZYGOTE_TEST']
+        self.assertEquals(code, 3)
+        self.assertEquals(output, 'from the client %s a b c\n' % os.path.realpath(self.tempdir))
+
+    def test_usage(self):
+        self.assertEquals(self.request('envv'), (None,
+          'usage: app <subcommand> [arguments] [options]\n\nValid subcommands are: env, limits\n\n'
+          "Unknown subcommand 'envv'; did you mean: env?\n\n"))
+
+    def test_stale(self):
+        self.script('new', '#!/bin/sh\necho new\n')
+        # the tree changed since the server last looked, so the client has
+        # to run this one itself
+        self.assertRaises(Fallback, self.request, 'new')
+        self.assertEquals(self.request('new'), (0, 'new\n'))
+
+    def test_mismatch(self):
+        self.server.identity['bevel'] = u'0.0.1'
+        self.assertRaises(Fallback, self.request, 'env')
+
+    def test_no_server(self):
+        self.server.server_close()
+        self.assertRaises(socket.error, request_run, self.path, self.root, 'env')
+
+    def test_umask_and_rlimits(self):
+        import resource
+        hard = resource.getrlimit(resource.RLIMIT_CORE)[1]
+        with patch('bevel.zygote._umask', Mock(return_value=027)):
+            with patch('bevel.zygote._get_rlimits', Mock(return_value={'RLIMIT_CORE': [0, hard]})):
+                self.assertEquals(self.request('limits'), (0, '0027\n0\n'))
+
+    def test_public_socket_dir(self):
+        os.chmod(self.tempdir, 0755)
+        self.assertRaises(Fallback, request_run, self.path, self.root, 'env')
+
+    def test_metrics(self):
+        sink = os.path.join(self.tempdir, 'metrics.log')
+        self.server.app.metrics = Metrics(sink)
+        # the server sits idle for a while before the request
+        time.sleep(0.5)
+        before = time.time()
+        self.assertEquals(self.request('env')[0], 3)
+        record = json.loads(open(sink).read())
+        self.assertEquals(record['command'], ['env'])
+        self.assertTrue(record['time'] >= before)
+        self.assertTrue(record['total'] < 0.5, record)
+
+    def test_terminal(self):
+        import pty
+        self.script('ask', '#!/bin/sh\nread x\necho "got $x"\n')
+        self.server.refresh()
+        pid, master = pty.fork()
+        if pid == 0:
+            code = 100
+            try:
+                # a server started from the same session, in the background
+                if os.fork() == 0:
+                    os.setpgid(0, 0)
+                    try:
+                        self.server.handle_request()
+                    finally:
+                        os._exit(0)
+                code = request_run(self.path, self.root, 'ask')
+            finally:
+                os._exit(code)
+        output = ''
+        deadline = time.time() + 5
+        try:
+            os.write(master, 'hello\n')
+            while 'got hello' not in output and time.time() < deadline:
+                if select.select([master], [], [], 0.1)[0]:
+                    try:
+                        output += os.read(master, 1024)
+                    except OSError:
+                        # everything holding the terminal has exited
+                        break
+        finally:
+            try:
+                os.killpg(pid, signal.SIGKILL)
+            except OSError:
+                pass
+            code = os.waitpid(pid, 0)[1]
+            os.close(master)
+        self.assertTrue('got hello' in output, (output, code))
+
+    def test_client_fallback(self):
+        self.server.server_close()
+        env = dict(os.environ, PYTHONPATH=os.getcwd(),
+                   XDG_RUNTIME_DIR=os.path.join(self.tempdir, 'run'))
+        proc = subprocess.Popen([sys.executable, 'bin/bevel-run', self.root, 'env', 'x y'],
+          stdout=subprocess.PIPE, env=env)
+        self.assertEquals(proc.communicate()[0].split()[-2:], ['x', 'y'])
+        self.assertEquals(proc.returncode, 3)
+
+class StartupTestCases(unittest.TestCase):
+    fixture_dir = 'bevel/tests/fixtures/myapplib'
+    # modules a plain ``run``/``complete`` should never have to import
+    heavy_modules = ['subprocess', 'optparse', 'logging', 'json', 'pprint', 'copy']
+    # completing may take at most this many times as long as starting the
+    # interpreter alone; comparing the two, rather than against a fixed
+    # number of seconds, holds on slow and busy machines alike
+    startup_factor = 2.0
+
+    def python(self, code, *args):
+        env = dict(os.environ, PYTHONPATH=os.getcwd())
+        env.pop('BEVEL_DEBUG', None)
+        proc = subprocess.Popen([sys.executable, '-c', code] + list(args),
+          stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+        out, err = proc.communicate()
+        return out
+
+    def loaded_modules(self, code):
+        code = 'import sys\ntry:\n    %s\nfinally:\n' \
+               '    sys.stdout.write(" ".join(sys.modules))' % code
+        return self.python(code).split()
+
+    def assertLazy(self, code):
+        baseline = self.loaded_modules('pass')
+        modules = self.loaded_modules(code)
+        for name in self.heavy_modules:
+            self.assertFalse(name in modules and name not in baseline, name)
+
+    def test_import_is_lazy(self):
+        self.assertLazy('import bevel')
+
+    def test_completion_is_lazy(self):
+        self.assertLazy('import bevel; bevel.main(["-b", "%s", "-c", "-a", "hasdriver "])'
+          % self.fixture_dir)
+
+    def test_client_is_lazy(self):
+        baseline = self.loaded_modules('pass')
+        modules = self.loaded_modules('import bevel.client')
+        for name in self.heavy_modules + ['socket', 'SocketServer', 'threading', 'bevel.index']:
+            self.assertFalse(name in modules and name not in baseline, name)
+
+    def test_run_is_lazy(self):
+        # ``--exec``, but stopping short of actually replacing the process
+        self.assertLazy('import os, bevel; os.execv = lambda *args: None; '
+          'bevel.main(["-b", "%s", "-x", "-a", "hasdriver subcommand"])' % self.fixture_dir)
+
+    def timed(self, code, *args):
+        now = time.time()
+        self.python(code, *args)
+        return time.time() - now
+
+    def test_startup_budget(self):
+        # otherwise bevel might be compiled all over again on every run
+        import compileall
+        compileall.compile_dir(os.path.dirname(sys.modules['bevel'].__file__), quiet=True)
+        baseline, elapsed = [], []
+        for i in range(5):
+            baseline.append(self.timed('pass'))
+            elapsed.append(self.timed('import sys, bevel; bevel.main(sys.argv[1:])',
+              '-b', self.fixture_dir, '-c', '-a', 'hasdriver '))
+        self.assertTrue(min(elapsed) <= self.startup_factor * min(baseline),
+          (min(elapsed), min(baseline)))
+
+class FastParseTestCases(unittest.TestCase):
+    def test_defaults_match_optparse(self):
+        defaults = create_cli().get_default_values().__dict__
+        self.assertEquals(_fast_parse([]).__dict__, defaults)
+
+    def test_matches_optparse(self):
+        for argv in (['-b', 'foo', '-a', 'bar baz'], ['--bindir=foo', '--args', '-x'],
+          ['-b', 'foo', '-c', 'myapp', 'ba', 'myapp'], ['-b', 'foo', '-N', 'app', '-x', '-i'],
+          ['--bindir', 'foo', '--cache-dir', '/tmp', '--reindex', '--complete-server']):
+            opts, args = create_cli().parse_args(argv)
+            self.assertEquals(_fast_parse(argv).__dict__, opts.__dict__)
+
+    def test_falls_back(self):
+        for argv in (['-h'], ['-cn'], ['-bfoo'], ['--bind', 'foo'], ['-b'], ['--', '-b'],
+          ['--complete=yes']):
+            self.assertEquals(_fast_parse(argv), None)
+
+class CompletionScriptTestCases(unittest.TestCase):
+    fixture_dir = 'bevel/tests/fixtures/myapplib'
+    comp_lines = ['myapp ', 'myapp hasd', 'myapp hasdriver ', 'myapp hasdriver s',
+                  'myapp hasdriver f', 'myapp hasdrive ', 'myapp emptydriver su']
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.script = os.path.join(self.tempdir, 'completion.bash')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def emit(self, bevel):
+        command = '%s %s' % (sys.executable, os.path.abspath('bin/bevel'))
+        open(self.script, 'w').write(emit_completion(bevel, 'bash', bevel=command))
+
+    def complete(self, comp_line):
+        words = comp_line.split(' ')
+        code = 'source %s; COMP_WORDS=(%s); COMP_CWORD=%d; COMP_LINE=%s; ' \
+               '_bevel_myapplib; printf "%%s\\n" "${COMPREPLY[@]}"' % (
+               self.script, ' '.join([quote(w) for w in words]), len(words) - 1,
+               quote(comp_line))
+        env = dict(os.environ, PYTHONPATH=os.getcwd())
+        proc = subprocess.Popen(['bash', '-c', code], stdout=subprocess.PIPE, env=env)
+        return [ i for i in proc.communicate()[0].split('\n') if i ]
+
+    def test_matches_complete(self):
+        bevel = Bevel(self.fixture_dir)
+        self.emit(bevel)
+        for comp_line in self.comp_lines:
+            self.assertEquals(self.complete(comp_line),
+                              bevel.complete(comp_line.split(' ', 1)[1]))
+
+    def test_stale_falls_back(self):
+        bin_dir = os.path.join(self.tempdir, 'myapplib')
+        shutil.copytree(self.fixture_dir, bin_dir)
+        self.emit(Bevel(bin_dir))
+        os.utime(self.script, (0, 0))
+        new = os.path.join(bin_dir, 'hasdriver', 'another')
+        open(new, 'w').write('#!/bin/bash\n')
+        os.chmod(new, 0755)
+        self.assertEquals(self.complete('myapp hasdriver '),
+                          ['another', 'dashed-command', 'subcommand'])
+
+def make_tree(root, seed, names=('a', 'b', 'c-d'), depth=3):
+    """
+    Generate a random command tree under ``root``, with a mix of empty,
+    regular, missing and broken drivers and leaf commands
+    """
+    rand = random.Random(seed)
+
+    def script(path, body, mode=0755):
+        open(path, 'w').write(body)
+        os.chmod(path, mode)
+
+    def populate(path, level):
+        os.mkdir(path)
+        label = os.path.relpath(path, root)
+        driver = rand.choice(['empty', 'empty', 'echo', 'echo', 'missing', 'unrunnable'])
+        if driver == 'empty':
+            script(os.path.join(path, '_driver'), '')
+        elif driver == 'echo':
+            script(os.path.join(path, '_driver'), '#!/bin/sh\necho driver %s "$@"\n' % label)
+        elif driver == 'unrunnable':
+            script(os.path.join(path, '_driver'), '#!/bin/sh\n', 0644)
+        for name in rand.sample(names, rand.randint(0, len(names))):
+            child = os.path.join(path, name)
+            kind = rand.choice(['leaf', 'leaf', 'dir', 'dir', 'noshebang', 'unrunnable'])
+            if kind == 'dir' and level < depth:
+                populate(child, level + 1)
+            elif kind == 'noshebang':
+                script(child, 'echo oops\n')
+            elif kind == 'unrunnable':
+                script(child, '#!/bin/sh\n', 0644)
+            else:
+                script(child, '#!/bin/sh\necho leaf %s/%s "$@"\nexit %d\n' % (
+                  label, name, rand.randint(0, 3)))
+
+    populate(root, 0)
+
+class CompiledDispatcherTestCases(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def call(self, argv):
+        env = dict(os.environ, PYTHONPATH=os.getcwd())
+        env.pop('BEVEL_DEBUG', None)
+        proc = subprocess.Popen(argv, stdout=subprocess.PIPE,
+          stderr=subprocess.PIPE, env=env)
+        out, err = proc.communicate()
+        return out, err, proc.returncode
+
+    def test_equivalence(self):
+        words = ['a', 'b', 'c-d', 'a', 'b', 'c-d', 'x', 'a/b', '-v']
+        for seed in range(8):
+            bin_dir = os.path.join(self.tempdir, 'app%d' % seed)
+            make_tree(bin_dir, seed)
+            dispatcher = os.path.join(self.tempdir, 'dispatch%d' % seed)
+            open(dispatcher, 'w').write(compile_dispatcher(Bevel(bin_dir)))
+            rand = random.Random(seed)
+            for i in range(12):
+                args = [ rand.choice(words) for j in range(rand.randint(0, 4)) ]
+                self.assertEquals(
+                  self.call(['sh', dispatcher] + args),
+                  self.call([sys.executable, 'bin/bevel', '--bindir', bin_dir,
+                             '--args', ' '.join(args)]),
+                  args)
+
+    def test_suggestion_equivalence(self):
+        names = ('status', 'start', 'create-db')
+        words = list(names) + ['stat', 'statsu', 'sart', 'creat-db', 'x', 'startt']
+        for seed in range(4):
+            bin_dir = os.path.join(self.tempdir, 'app%d' % seed)
+            make_tree(bin_dir, seed, names, depth=2)
+            dispatcher = os.path.join(self.tempdir, 'dispatch%d' % seed)
+            open(dispatcher, 'w').write(compile_dispatcher(Bevel(bin_dir)))
+            rand = random.Random(seed)
+            for i in range(8):
+                args = [ rand.choice(words) for j in range(rand.randint(1, 3)) ]
+                self.assertEquals(
+                  self.call(['sh', dispatcher] + args),
+                  self.call([sys.executable, 'bin/bevel', '--bindir', bin_dir,
+                             '--args', ' '.join(args)]),
+                  args)
+
+class VerifyTestCases(unittest.TestCase):
+    fixture_dir = 'bevel/tests/fixtures/myapplib'
+
+    def setUp(self):
+        self.bevel = Bevel(self.fixture_dir)
+
+    def key(self, item):
+        return item['name'], item['reason']
+
+    def test_problems(self):
+        self.assertEquals(sorted(map(self.key, self.bevel._verify())), [
+          ('%s/_driver' % self.fixture_dir, 'missing shebang'),
+          ('%s/emptydriver/_driver' % self.fixture_dir, 'missing shebang'),
+          ('%s/hasbaddriver/_driver' % self.fixture_dir, 'could not read or execute'),
+          ('%s/hasbaddriver/_driver' % self.fixture_dir, 'missing shebang'),
+          ('%s/hasdriver2/_driver' % self.fixture_dir, 'missing shebang'),
+          ('%s/nodriver/subcommand' % self.fixture_dir, 'missing shebang'),
+        ])
+
+    def test_parallel(self):
+        self.assertEquals(sorted(map(self.key, self.bevel._verify(jobs=4))),
+                          sorted(map(self.key, self.bevel._verify())))
+
+    def test_max_problems(self):
+        self.assertEquals(len(self.bevel._verify(jobs=4, max_problems=2)), 2)
+
+    def test_stream(self):
+        stream = StringIO.StringIO()
+        self.assertEquals(self.bevel.verify_stream(stream, jobs=4), 6)
+        lines = [ json.loads(i) for i in stream.getvalue().splitlines() ]
+        self.assertEquals(len(lines), 7)
+        summary = lines[-1]
+        self.assertEquals(summary['type'], 'summary')
+        self.assertEquals((summary['directories'], summary['files'], summary['problems']),
+                          (5, 10, 6))
+        self.assertFalse(summary['truncated'])
+
+class TrieTestCases(unittest.TestCase):
+    def test_startswith(self):
+        trie = Trie(['status', 'start', 'stop', 'create', 'st'])
+        self.assertEquals(trie.startswith('st'), ['st', 'start', 'status', 'stop'])
+        self.assertEquals(trie.startswith('sta'), ['start', 'status'])
+        self.assertEquals(trie.startswith('c'), ['create'])
+        self.assertEquals(trie.startswith('x'), [])
+        self.assertEquals(trie.startswith(''), ['create', 'st', 'start', 'status', 'stop'])
+        self.assertEquals(Trie([]).startswith(''), [])
+
+    def test_built_on_reuse(self):
+        app = Bevel('bevel/tests/fixtures/myapplib')
+        with patch('bevel.completion.Trie', Mock(wraps=Trie)) as trie:
+            # a one-off completion just scans
+            self.assertEquals(app.complete('hasdriver s'), ['subcommand'])
+            self.assertEquals(trie.call_count, 0)
+            for i in range(3):
+                self.assertEquals(app.complete('hasdriver d'), ['dashed-command'])
+            self.assertEquals(trie.call_count, 1)
+
+class SuggestionIndexTestCases(unittest.TestCase):
+    def test_edit_distance(self):
+        self.assertEquals(edit_distance('status', 'status'), 0)
+        self.assertEquals(edit_distance('status', 'stauts'), 2)
+        self.assertEquals(edit_distance('kitten', 'sitting'), 3)
+        self.assertEquals(edit_distance('', 'abc'), 3)
+        self.assertEquals(edit_distance('kitten', 'sitting', 1), 2)
+
+    def test_search(self):
+        index = SuggestionIndex(['status', 'start', 'stop', 'create', 'st'])
+        self.assertEquals(index.search('statsu', 2), [(2, 'status')])
+        self.assertEquals(index.search('sop', 1), [(1, 'stop')])
+        self.assertEquals(index.search('stat', 1), [(1, 'start')])
+        self.assertEquals(index.search('stat', 2),
+                          [(1, 'start'), (2, 'st'), (2, 'status'), (2, 'stop')])
+        self.assertEquals(index.search('xyz', 2), [])
+        self.assertEquals(SuggestionIndex([]).search('x', 1), [])
+
+    def test_matches_brute_force(self):
+        rand = random.Random(0)
+        for alphabet in ('abc-', 'abcdefghij'):
+            words = set([ ''.join([ rand.choice(alphabet) for i in range(rand.randint(1, 9)) ])
+                          for j in range(300) ])
+            index = SuggestionIndex(words)
+            for i in range(100):
+                query = ''.join([ rand.choice(alphabet) for j in range(rand.randint(1, 9)) ])
+                for limit in (1, 2):
+                    expected = sorted([ (edit_distance(query, word), word) for word in words
+                                        if edit_distance(query, word) <= limit ])
+                    self.assertEquals(index.search(query, limit), expected, (query, limit))
+
+    def test_shared_prefixes(self):
+        rand = random.Random(0)
+        def letters(length):
+            return ''.join([ rand.choice('abcdefghij') for i in range(length) ])
+        words = set([ rand.choice(['svc-', 'svc-api-', 'job-']) + letters(rand.randint(3, 6))
+                      for i in range(1000) ])
+        index = SuggestionIndex(words)
+        for i in range(30):
+            query = rand.choice(list(words))
+            query = query[:-2] + letters(2)
+            distances = [ (edit_distance(query, word, 2), word) for word in words ]
+            for limit in (1, 2):
+                expected = sorted([ item for item in distances if item[0] <= limit ])
+                self.assertEquals(index.search(query, limit), expected, (query, limit))
+                # the prefixes don't make every word a candidate
+                self.assertTrue(len(index._candidates(query, limit)) < len(words) // 4)
+
+class SuggestionTestCases(TestCase):
+    fixture_dir = 'bevel/tests/fixtures/myapplib'
+
+    def setUp(self):
+        self.bevel = Bevel(self.fixture_dir)
+        super(SuggestionTestCases, self).setUp()
+
+    def test_usage(self):
+        self.bevel.run('emptydriver subcomand')
+        self.assertEquals('usage: myapplib emptydriver <subcommand> [arguments] '
+                          '[options]\n\nValid subcommands are: subcommand\n\n'
+                          "Unknown subcommand 'subcomand'; did you mean: subcommand?\n\n",
+                          self.stdout.get())
+
+    def test_persisted(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            root = os.path.join(tempdir, 'app')
+            cache_dir = os.path.join(tempdir, 'cache')
+            os.mkdir(root)
+            open(os.path.join(root, '_driver'), 'w').close()
+            os.chmod(os.path.join(root, '_driver'), 0755)
+            def script(name):
+                open(os.path.join(root, name), 'w').write('#!/bin/sh\n')
+                os.chmod(os.path.join(root, name), 0755)
+            for i in range(150):
+                script('svc-%d' % i)
+            self.assertEquals(Bevel(root, cache_dir=cache_dir).suggest('svc-1x')['suggestions'],
+                              ['svc-1', 'svc-10', 'svc-11'])
+            cached = [ name for name in os.listdir(cache_dir) if '.suggest-' in name ]
+            self.assertEquals(len(cached), 1)
+            with patch('bevel.completion.SuggestionIndex.__init__') as build:
+                build.return_value = None
+                Bevel(root, cache_dir=cache_dir).suggest('svc-1x')
+                self.assertFalse(build.called)
+            # the index is rebuilt once the subcommands change
+            script('svc-1y')
+            self.assertEquals(Bevel(root, cache_dir=cache_dir).suggest('svc-1yy')['suggestions'],
+                              ['svc-1y'])
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_suggest(self):
+        self.assertEquals(self.bevel.suggest('hasdriver3 x'),
+          {'command': [], 'unknown': 'hasdriver3', 'suggestions': ['hasdriver', 'hasdriver2']})
+        self.assertEquals(self.bevel.suggest('emptydriver zzz'),
+          {'command': ['emptydriver'], 'unknown': 'zzz', 'suggestions': []})
+        # arguments to leaf commands aren't subcommands
+        self.assertEquals(self.bevel.suggest('hasdriver subcommand subcomand'),
+          {'command': ['hasdriver', 'subcommand'], 'unknown': None, 'suggestions': []})
+
+class UsageLogTestCases(TestCase):
+    fixture_dir = 'bevel/tests/fixtures/myapplib'
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'usage')
+        super(UsageLogTestCases, self).setUp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        super(UsageLogTestCases, self).tearDown()
+
+    def test_counts(self):
+        usage = UsageLog(self.path)
+        usage.record(['db', 'status'])
+        usage.record(['db', 'status'])
+        usage.record(['db', 'create'])
+        self.assertEquals(usage.counts(), {('db',): 3, ('db', 'status'): 2, ('db', 'create'): 1})
+        self.assertEquals(usage.rank(['db'], ['create', 'migrate', 'status']),
+                          ['status', 'create', 'migrate'])
+
+    def test_compaction(self):
+        usage = UsageLog(self.path)
+        usage.MAX_SIZE = 200
+        usage.MAX_ENTRIES = 2
+        for i in range(30):
+            usage.record(['a'])
+            usage.record(['b', str(i % 3)])
+        # the log never grows much past its limit
+        self.assertTrue(os.path.getsize(self.path) <= 200 + len('1\tb 10\n'))
+        usage.compact()
+        self.assertEquals(len(usage._read()), 2)
+        self.assertTrue(('a',) in usage.counts())
+
+    def test_ranked_completion(self):
+        bevel = Bevel(self.fixture_dir, usage_log=self.path)
+        self.assertEquals(bevel.complete('hasdriver '), ['dashed-command', 'subcommand'])
+        for i in range(2):
+            bevel.run('hasdriver subcommand')
+        self.assertEquals(bevel.complete('hasdriver '), ['subcommand', 'dashed-command'])
+        self.assertEquals(bevel.complete('hasd'), ['hasdriver', 'hasdriver2'])
+        bevel.run('hasdriver2')
+        bevel.run('hasdriver2')
+        bevel.run('hasdriver2')
+        self.assertEquals(bevel.complete('hasd'), ['hasdriver2', 'hasdriver'])
+
+class BatchTestCases(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tempdir, 'app')
+        os.mkdir(self.root)
+        for name, code in (('ok', 0), ('fail', 3)):
+            path = os.path.join(self.root, name)
+            open(path, 'w').write('#!/bin/sh\nexit %d\n' % code)
+            os.chmod(path, 0755)
+        super(BatchTestCases, self).setUp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        super(BatchTestCases, self).tearDown()
+
+    def run_batch(self, lines, jobs=1):
+        stream = StringIO.StringIO()
+        code = Bevel(self.root).run_batch(lines, stream, jobs)
+        records = [ json.loads(line) for line in stream.getvalue().splitlines() ]
+        return code, records[:-1], records[-1]
+
+    def test_batch(self):
+        lines = ['ok a b\n', 'fail\n', '\n', '# comment\n', 'missing\n', "ok 'x\n"]
+        code, records, summary = self.run_batch(lines)
+        self.assertEquals(code, 2)
+        self.assertEquals([ (r['line'], r['exit_code']) for r in records ],
+                          [(1, 0), (2, 3), (5, None), (6, None)])
+        self.assertEquals((summary['lines'], summary['failed'], summary['errors']), (4, 1, 2))
+        self.assertEquals(self.run_batch(['ok', 'fail'])[0], 1)
+        self.assertEquals(self.run_batch(['ok', 'ok'])[0], 0)
+
+    def test_unstartable(self):
+        path = os.path.join(self.root, 'bad')
+        open(path, 'w').write('#!/nonexistent/interpreter\n')
+        os.chmod(path, 0755)
+        code, records, summary = self.run_batch(['ok', 'bad', 'ok'])
+        self.assertEquals(code, 1)
+        self.assertEquals([ (r['line'], r['exit_code']) for r in records ],
+                          [(1, 0), (2, 1), (3, 0)])
+        self.assertTrue(records[1]['error'])
+        self.assertEquals((summary['lines'], summary['failed'], summary['errors']), (3, 1, 0))
+
+    def test_jobs(self):
+        lines = [ '%s %d' % (i % 3 and 'ok' or 'fail', i) for i in range(30) ]
+        code, records, summary = self.run_batch(lines, jobs=4)
+        self.assertEquals(code, 1)
+        self.assertEquals(sorted([ r['line'] for r in records ]), range(1, 31))
+        self.assertEquals(summary['failed'], 10)
+
+    def test_live_sync(self):
+        if not live.available():
+            raise unittest.SkipTest('inotify is not available')
+        bevel = Bevel(self.root, live=True)
+        update = bevel.tree.update
+        state = {'active': 0, 'most': 0}
+        def slow_update():
+            state['active'] += 1
+            state['most'] = max(state['most'], state['active'])
+            time.sleep(0.001)
+            try:
+                return update()
+            finally:
+                state['active'] -= 1
+        bevel.tree.update = slow_update
+        try:
+            stream = StringIO.StringIO()
+            self.assertEquals(bevel.run_batch(['ok'] * 40, stream, 8), 0)
+        finally:
+            bevel.tree.close()
+        # workers take turns bringing the tree up to date
+        self.assertEquals(state['most'], 1)
+
+    def test_resolution_cache(self):
+        bevel = Bevel(self.root)
+        stream = StringIO.StringIO()
+        bevel.run_batch(['ok a', 'fail'], stream)
+        syscalls = bevel.syscalls
+        bevel.run_batch(['ok a', 'fail'] * 5, stream)
+        self.assertEquals(bevel.syscalls, syscalls)
+
+class FanOutTestCases(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tempdir, 'app')
+        os.makedirs(os.path.join(self.root, 'parent'))
+        path = os.path.join(self.root, 'greet')
+        open(path, 'w').write('#!/bin/sh\n'
+          'printf "hello $1\\nbye "; echo "$1" >&2\n'
+          '[ "$1" = slow ] && sleep 10\n'
+          '[ "$1" = stubborn ] && trap "" TERM && sleep 10\n'
+          '[ "$1" = bad ] && exit 4\n'
+          'echo "$1"\n')
+        os.chmod(path, 0755)
+        self.stdout = StringIO.StringIO()
+        self.stderr = StringIO.StringIO()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def fan_out(self, targets, **kwargs):
+        return Bevel(self.root).fan_out('greet', targets, stdout=self.stdout,
+          stderr=self.stderr, **kwargs)
+
+    def test_prefixed_lines(self):
+        targets = [ 'host%d' % i for i in range(20) ]
+        self.assertEquals(self.fan_out(targets, jobs=5), 0)
+        lines = self.stdout.getvalue().splitlines()
+        self.assertEquals(len(lines), 40)
+        for target in targets:
+            mine = [ line for line in lines if line.startswith(target + ' ') ]
+            self.assertEquals(mine, ['%-6s | hello %s' % (target, target),
+                                     '%-6s | bye %s' % (target, target)])
+        self.assertTrue('20 succeeded, 0 failed, 0 timed out' in self.stderr.getvalue())
+
+    def test_keep_going(self):
+        self.assertEquals(self.fan_out(['a', 'bad', 'c'], jobs=1), 1)
+        self.assertTrue('c   | bye c' in self.stdout.getvalue())
+        self.assertTrue('app: bad exited with status 4' in self.stderr.getvalue())
+
+    def test_fail_fast(self):
+        self.assertEquals(self.fan_out(['a', 'bad', 'c', 'd'], jobs=1, fail_fast=True), 1)
+        self.assertFalse('c   |' in self.stdout.getvalue())
+        self.assertTrue('1 succeeded, 1 failed, 0 timed out, 2 skipped' in self.stderr.getvalue())
+
+    def test_timeout(self):
+        now = time.time()
+        self.assertEquals(self.fan_out(['slow', 'a'], jobs=2, timeout=0.5), 1)
+        self.assertTrue(time.time() - now < 5)
+        self.assertTrue('app: slow timed out' in self.stderr.getvalue())
+        self.assertTrue('slow | hello slow' in self.stdout.getvalue())
+
+    def test_ignores_sigterm(self):
+        calls = []
+        def counting(*args):
+            calls.append(args)
+            return original(*args)
+        original = select.select
+        grace = bevel.fanout.KILL_GRACE
+        select.select = counting
+        bevel.fanout.KILL_GRACE = 0.5
+        try:
+            self.assertEquals(self.fan_out(['stubborn'], timeout=0.2), 1)
+        finally:
+            select.select = original
+            bevel.fanout.KILL_GRACE = grace
+        self.assertTrue('app: stubborn timed out' in self.stderr.getvalue())
+        # waiting out the grace period doesn't spin
+        self.assertTrue(len(calls) < 50)
+
+    def test_leaf_only(self):
+        self.assertRaises(InternalError, Bevel(self.root).fan_out, 'parent', ['a'])
+
+class LiveIndexTestCases(unittest.TestCase):
+    def setUp(self):
+        if not live.available():
+            raise unittest.SkipTest('inotify is not available')
+        self.tempdir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tempdir, 'app')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def mutate(self, rand):
+        """
+        Make a random change somewhere in the tree
+        """
+        paths = [self.root]
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            paths.extend([ os.path.join(dirpath, name) for name in dirnames + filenames ])
+        path = rand.choice(paths)
+        action = rand.choice(['chmod', 'remove', 'rewrite', 'create', 'rename'])
+        if path == self.root and action != 'create':
+            return
+        elif action == 'chmod' and os.path.isfile(path):
+            os.chmod(path, rand.choice([0755, 0644]))
+        elif action == 'remove':
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.unlink(path)
+        elif action == 'rewrite' and os.path.isfile(path):
+            open(path, 'w').write(rand.choice(['', '#!/bin/sh\n']))
+        elif action == 'create':
+            parent = os.path.isdir(path) and path or os.path.dirname(path)
+            name = rand.choice(['a', 'b', 'new', '_driver'])
+            if not os.path.exists(os.path.join(parent, name)):
+                make_tree(os.path.join(parent, name), rand.random(), depth=1)
+        elif action == 'rename':
+            target = os.path.join(os.path.dirname(path), rand.choice(['a', 'b', 'moved']))
+            if not os.path.exists(target):
+                os.rename(path, target)
+
+    def test_follows_changes(self):
+        for seed in range(10):
+            make_tree(self.root, seed)
+            app = Bevel(self.root)
+            index = live.LiveIndex(app)
+            try:
+                rand = random.Random(seed)
+                for i in range(15):
+                    self.mutate(rand)
+                    index.update()
+                    self.assertEquals(index.nodes, build_index(app).nodes)
+                self.assertEquals(index.update(), False)
+            finally:
+                index.close()
+            shutil.rmtree(self.root)
+
+    def test_overflow(self):
+        make_tree(self.root, 0)
+        index = live.LiveIndex(Bevel(self.root))
+        try:
+            os.mkdir(os.path.join(self.root, 'new'))
+            open(os.path.join(self.root, 'new', '_driver'), 'w').close()
+            os.chmod(os.path.join(self.root, 'new', '_driver'), 0755)
+            # what an overflowed event queue falls back to
+            index._rescan()
+            self.assertEquals(index.nodes, build_index(Bevel(self.root)).nodes)
+        finally:
+            index.close()
+
+    def test_symlinked_aliases(self):
+        make_tree(self.root, 0)
+        os.mkdir(os.path.join(self.tempdir, 'shared'))
+        os.symlink(os.path.join(self.tempdir, 'shared'), os.path.join(self.root, 'one'))
+        os.symlink(os.path.join(self.tempdir, 'shared'), os.path.join(self.root, 'two'))
+        app = Bevel(self.root)
+        index = live.LiveIndex(app)
+        try:
+            path = os.path.join(self.tempdir, 'shared', '_driver')
+            open(path, 'w').write('#!/bin/sh\n')
+            os.chmod(path, 0755)
+            index.update()
+            self.assertTrue(('one',) in index.nodes and ('two',) in index.nodes)
+            self.assertEquals(index.nodes, build_index(app).nodes)
+            os.unlink(os.path.join(self.root, 'one'))
+            index.update()
+            os.unlink(path)
+            index.update()
+            self.assertEquals(index.nodes, build_index(app).nodes)
+        finally:
+            index.close()
+
+    def test_bevel(self):
+        os.mkdir(self.root)
+        open(os.path.join(self.root, '_driver'), 'w').close()
+        os.chmod(os.path.join(self.root, '_driver'), 0755)
+        app = Bevel(self.root, live=True)
+        self.assertEquals(app.complete(''), [])
+        path = os.path.join(self.root, 'new')
+        open(path, 'w').write('#!/bin/sh\n')
+        os.chmod(path, 0755)
+        self.assertEquals(app.complete('n'), ['new'])
+        self.assertEquals(app._resolve_args(['new', 'x']), (path, ['x']))
+        # between changes, nothing touches the filesystem
+        syscalls = app.syscalls
+        for i in range(10):
+            app._resolve_args(['new', 'x'])
+            app.complete('n')
+        self.assertEquals(app.syscalls, syscalls)
+        os.chmod(path, 0644)
+        self.assertEquals(app.complete('n'), [])
+        app.tree.close()
+
+class InProcessTestCases(TestCase):
+    scripts = {
+        'argv': 'import sys\nprint sys.argv[1:], "bevel" in sys.modules\n',
+        'status': 'import sys\nsys.stdout.write("out")\nsys.exit(int(sys.argv[1]))\n',
+        'message': 'import sys\nsys.exit("went wrong")\n',
+        'raises': 'import atexit, sys\n'
+                  'atexit.register(lambda: sys.stdout.write("bye\\n"))\n'
+                  'raise ValueError("oops")\n',
+        'killed': 'import os, signal\nos.kill(os.getpid(), signal.SIGTERM)\n',
+        'shell': None,
+    }
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tempdir, 'app')
+        os.mkdir(self.root)
+        for name, body in self.scripts.items():
+            path = os.path.join(self.root, name)
+            if body is None:
+                body = '#!/bin/sh\necho shell "$@"\n'
+            else:
+                body = '#!/usr/bin/env %s\n%s' % (os.path.basename(sys.executable), body)
+            open(path, 'w').write(body)
+            os.chmod(path, 0755)
+        self.environ = dict(os.environ)
+        os.environ['PATH'] = '%s:%s' % (os.path.dirname(sys.executable), os.environ['PATH'])
+        super(InProcessTestCases, self).setUp()
+
+    def tearDown(self):
+        super(InProcessTestCases, self).tearDown()
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tempdir)
+
+    def run_both(self, args):
+        results = []
+        for in_process in (False, True):
+            for stream in (self.stdout, self.stderr):
+                stream.tempfile.seek(0)
+                stream.tempfile.truncate()
+            code = Bevel(self.root, in_process=in_process).run(args)
+            results.append((code, self.stdout.get(), self.stderr.get()))
+        return results
+
+    def test_matches_subprocess(self):
+        for args in ('status 0', 'status 3', 'message', 'shell a b', 'killed'):
+            separate, forked = self.run_both(args)
+            self.assertEquals(separate, forked)
+        separate, forked = self.run_both('raises')
+        self.assertEquals(separate[:2], (1, 'bye\n'))
+        self.assertEquals(forked[:2], separate[:2])
+        self.assertTrue(forked[2].endswith('ValueError: oops\n'))
+
+    def test_no_second_interpreter(self):
+        separate, forked = self.run_both('argv a "b c"')
+        self.assertEquals(separate[1], "['a', 'b c'] False\n")
+        self.assertEquals(forked[1], "['a', 'b c'] True\n")
+
+    def test_other_runtimes(self):
+        from bevel.inprocess import is_this_python
+        self.assertTrue(is_this_python(os.path.join(self.root, 'argv')))
+        self.assertFalse(is_this_python(os.path.join(self.root, 'shell')))
+
+    def test_no_run_path(self):
+        # Python 2.6
+        import runpy
+        run_path = runpy.run_path
+        del runpy.run_path
+        try:
+            separate, forked = self.run_both('argv a')
+        finally:
+            runpy.run_path = run_path
+        self.assertEquals(forked[:2], (0, "['a'] False\n"))
+
+class RusageTestCases(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tempdir, 'app')
+        os.mkdir(self.root)
+        path = os.path.join(self.root, 'hungry')
+        open(path, 'w').write('#!%s\n'
+          'data = "x" * (64 * 1024 * 1024)\n'
+          'total = sum(range(2000000))\n' % sys.executable)
+        os.chmod(path, 0755)
+        super(RusageTestCases, self).setUp()
+
+    def tearDown(self):
+        super(RusageTestCases, self).tearDown()
+        shutil.rmtree(self.tempdir)
+
+    def test_result(self):
+        for in_process in (False, True):
+            result = Bevel(self.root, in_process=in_process).run('hungry')
+            self.assertEquals(result, 0)
+            self.assertTrue(result.maxrss > 64 * 1024, result.maxrss)
+            self.assertTrue(result.cpu > 0)
+            self.assertTrue(result.elapsed >= result.cpu * 0.5)
+            self.assertEquals(result.as_dict()['exit_code'], 0)
+
+    def test_soft_limits(self):
+        path = os.path.join(self.tempdir, 'limits.json')
+        json.dump({'': {'maxrss': 1024}, 'hungry': {'elapsed': 60}}, open(path, 'w'))
+        bevel = Bevel(self.root, limits=load_limits(path))
+        self.assertEquals(bevel.run('hungry'), 0)
+        self.assertEquals(self.stderr.get(), '')
+        bevel.limits[()]['elapsed'] = 0
+        bevel.limits[('hungry',)]['maxrss'] = 1024
+        self.assertEquals(bevel.run('hungry'), 0)
+        self.assertTrue("app: warning: 'app hungry' exceeded its soft limit on maxrss" in self.stderr.get())
+        json.dump({'': {'rss': 1}}, open(path, 'w'))
+        self.assertRaises(ValueError, load_limits, path)
+
+    def test_metrics(self):
+        path = os.path.join(self.tempdir, 'metrics')
+        Bevel(self.root, metrics=Metrics(path)).run('hungry')
+        record = json.load(open(path))
+        self.assertTrue(record['rusage']['maxrss'] > 64 * 1024)
+
+class BundleTestCases(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tempdir, 'app')
+        self.bundle = os.path.join(self.tempdir, 'app.bundle')
+        self.environ = dict(os.environ)
+        os.environ['XDG_RUNTIME_DIR'] = os.path.join(self.tempdir, 'run')
+        super(BundleTestCases, self).setUp()
+
+    def tearDown(self):
+        super(BundleTestCases, self).tearDown()
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tempdir)
+
+    def script(self, rel, body, mode=0755):
+        path = os.path.join(self.root, rel)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, 'w').write(body)
+        os.chmod(path, mode)
+
+    def make_app(self):
+        self.script('_driver', '')
+        self.script('db/_driver', '#!/bin/sh\necho db driver\n')
+        self.script('db/status', '#!/bin/sh\necho "$(basename $0)" "$@"\nexit 3\n')
+        self.script('db/create', '#!/bin/sh\necho create\n')
+        self.script('deploy', '#!/bin/sh\necho deploy\n')
+        self.script('notes', 'not a command\n', 0644)
+
+    def test_round_trip(self):
+        self.make_app()
+        self.assertEquals(pack(Bevel(self.root), self.bundle), [])
+        packed, unpacked = Bevel(self.bundle), Bevel(self.root)
+        self.assertEquals(packed.name, 'app')
+        for line in ('', 'd', 'db ', 'db s', 'deploy'):
+            self.assertEquals(packed.complete(line), unpacked.complete(line))
+        shutil.rmtree(self.root)
+        self.assertEquals(packed.run('db status a b'), 3)
+        self.assertEquals(packed.run('db'), None)
+        self.assertEquals(self.stdout.get(), 'status a b\ndb driver\n')
+        # nothing is written out until it's run, and then only once
+        cached = os.listdir(os.path.join(self.tempdir, 'run', 'bevel', 'scripts'))
+        self.assertEquals(len(cached), 2)
+        packed.run('db status')
+        self.assertEquals(len(os.listdir(os.path.join(self.tempdir, 'run', 'bevel', 'scripts'))), 2)
+
+    def test_concurrent_materialize(self):
+        self.make_app()
+        pack(Bevel(self.root), self.bundle)
+        packed = Bevel(self.bundle)
+        paths, errors = [], []
+        def materialize():
+            try:
+                for i in range(50):
+                    paths.append(packed.bundle.materialize(['db', 'status']))
+            except Exception, e:
+                errors.append(e)
+        # every call writes the script out again, as if they had all missed
+        # the cache at once
+        is_cached = bevel.bundle._is_cached
+        bevel.bundle._is_cached = lambda *args: False
+        try:
+            threads = [ threading.Thread(target=materialize) for i in range(8) ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            bevel.bundle._is_cached = is_cached
+        self.assertEquals(errors, [])
+        self.assertEquals(len(set(paths)), 1)
+        self.assertEquals(os.listdir(os.path.dirname(paths[0])), ['status'])
+        self.assertEquals(os.stat(paths[0]).st_mode & 0777, 0755)
+
+    def test_only_tree_touched_is_the_bundle(self):
+        self.make_app()
+        pack(Bevel(self.root), self.bundle)
+        shutil.rmtree(self.root)
+        packed = Bevel(self.bundle)
+        packed._resolve_args(['db', 'create', 'x'])
+        packed.complete('db ')
+        self.assertEquals(packed.syscalls, 0)
+
+    def test_planted_script(self):
+        self.make_app()
+        pack(Bevel(self.root), self.bundle)
+        packed = Bevel(self.bundle)
+        packed.run('deploy')
+        scripts = os.path.join(self.tempdir, 'run', 'bevel', 'scripts')
+        path = os.path.join(scripts, os.listdir(scripts)[0], 'deploy')
+        # a same-size impostor is replaced, not run
+        size = os.path.getsize(path)
+        os.unlink(path)
+        open(path, 'w').write(('#!/bin/sh\necho planted' + ' ' * size)[:size - 1] + '\n')
+        os.chmod(path, 0755)
+        packed.run('deploy')
+        self.assertEquals(self.stdout.get(), 'deploy\ndeploy\n')
+        # and so is a cache anyone else can write to
+        os.chmod(os.path.join(self.tempdir, 'run', 'bevel'), 0777)
+        self.assertRaises(InternalError, packed.run, 'deploy')
+
+    def test_invalid_tree(self):
+        self.make_app()
+        self.script('db/broken', 'echo no shebang\n')
+        problems = pack(Bevel(self.root), self.bundle)
+        self.assertEquals([ (p['name'], p['reason']) for p in problems ],
+                          [(os.path.join(self.root, 'db', 'broken'), 'missing shebang')])
+        self.assertFalse(os.path.exists(self.bundle))
+
+class LayeredTestCases(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.base = os.path.join(self.tempdir, 'app')
+        self.site = os.path.join(self.tempdir, 'site')
+        self.bin_dir = os.pathsep.join([self.site, self.base])
+        super(LayeredTestCases, self).setUp()
+        self.script(self.base, '_driver', '')
+        self.script(self.base, 'db/_driver', '#!/bin/sh\necho base db\n')
+        self.script(self.base, 'db/status', '#!/bin/sh\necho base status\n')
+        self.script(self.base, 'db/create', '#!/bin/sh\necho base create\n')
+        self.script(self.base, 'deploy', '#!/bin/sh\necho base deploy\n')
+        self.script(self.base, 'tools/_driver', '#!/bin/sh\necho base tools\n')
+        self.script(self.base, 'tools/lint', '#!/bin/sh\necho base lint\n')
+        self.script(self.base, 'plugin', '#!/bin/sh\necho base plugin\n')
+        # overrides one command, adds another, and replaces a directory with
+        # a leaf and a leaf with a directory
+        self.script(self.site, 'db/status', '#!/bin/sh\necho site status\n')
+        self.script(self.site, 'db/backup', '#!/bin/sh\necho site backup\n')
+        self.script(self.site, 'tools', '#!/bin/sh\necho site tools "$@"\n')
+        self.script(self.site, 'plugin/_driver', '#!/bin/sh\necho site plugin\n')
+        self.script(self.site, 'plugin/go', '#!/bin/sh\necho site go\n')
+
+    def tearDown(self):
+        super(LayeredTestCases, self).tearDown()
+        shutil.rmtree(self.tempdir)
+
+    def script(self, layer, rel, body):
+        path = os.path.join(layer, rel)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, 'w').write(body)
+        os.chmod(path, 0755)
+
+    def check(self, bevel):
+        self.assertEquals(bevel.name, 'app')
+        self.assertEquals(bevel.complete(''), ['db', 'deploy', 'plugin', 'tools'])
+        self.assertEquals(bevel.complete('db '), ['backup', 'create', 'status'])
+        self.assertEquals(bevel.complete('tools '), [])
+        self.assertEquals(bevel.complete('plugin '), ['go'])
+        for line in ('db status', 'db create', 'db backup', 'deploy', 'tools lint',
+                     'plugin', 'plugin go'):
+            bevel.run(line)
+        self.assertEquals(self.stdout.get(), 'site status\nbase create\nsite backup\n'
+          'base deploy\nsite tools lint\nsite plugin\nsite go\n')
+
+    def test_merged(self):
+        self.check(Bevel(self.bin_dir))
+
+    def test_cached(self):
+        cache_dir = os.path.join(self.tempdir, 'cache')
+        Bevel(self.bin_dir, cache_dir=cache_dir)
+        self.assertEquals(len(os.listdir(cache_dir)), 1)
+        self.check(Bevel(self.bin_dir, cache_dir=cache_dir))
+
+    def test_verify_targets(self):
+        files = [ path for kind, path in Bevel(self.bin_dir)._verify_targets()
+                  if kind == 'file' ]
+        self.assertTrue(os.path.join(self.site, 'tools') in files)
+        self.assertTrue(os.path.join(self.base, 'db', 'status') not in files)
+        self.assertTrue(os.path.join(self.base, 'tools', 'lint') not in files)
+        self.assertTrue(os.path.join(self.base, 'plugin') not in files)
+        self.assertTrue(os.path.join(self.base, 'db', 'create') in files)
+
+    def test_pack(self):
+        bundle = os.path.join(self.tempdir, 'app.bundle')
+        self.assertEquals(pack(Bevel(self.bin_dir), bundle), [])
+        packed = Bevel(bundle)
+        for line in ('', 'db ', 'plugin '):
+            self.assertEquals(packed.complete(line), Bevel(self.bin_dir).complete(line))
+
+class ProviderTestCases(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tempdir, 'app')
+        self.cache_dir = os.path.join(self.tempdir, 'cache')
+        self.runs = os.path.join(self.tempdir, 'runs')
+        self.script('_driver', '')
+        self.script('db/_driver', '#!/bin/sh\necho db\n')
+        self.script('db/status', '#!/bin/sh\necho status\n')
+        self.script('db/backup/_driver', '#!/bin/sh\necho backup\n')
+        self.script('db/backup/now', '#!/bin/sh\necho now\n')
+        self.provider('# bevel-ttl: 300\n')
+        super(ProviderTestCases, self).setUp()
+
+    def tearDown(self):
+        super(ProviderTestCases, self).tearDown()
+        shutil.rmtree(self.tempdir)
+
+    def script(self, rel, body):
+        path = os.path.join(self.root, rel)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, 'w').write(body)
+        os.chmod(path, 0755)
+
+    def provider(self, header, delay=0):
+        self.script('db/_complete', '#!/bin/sh\n%s'
+          'echo "$@" >> %s\nsleep %s\necho alpha; echo beta; echo "$#"\n'
+          % (header, self.runs, delay))
+
+    def bevel(self):
+        return Bevel(self.root, cache_dir=self.cache_dir)
+
+    def runs_so_far(self):
+        return open(self.runs).read().splitlines()
+
+    def test_complete(self):
+        self.assertEquals(self.bevel().complete('db status '), ['alpha', 'beta', '2'])
+        self.assertEquals(self.bevel().complete('db status --cluster a'), ['alpha'])
+        # inherited by the directory beneath
+        self.assertEquals(self.bevel().complete('db backup now b'), ['beta'])
+        # subcommands come first, and drivers don't take arguments
+        self.assertEquals(self.bevel().complete('db st'), ['status'])
+        self.assertEquals(self.bevel().complete('db x'), [])
+        self.assertEquals(self.runs_so_far(), ['db status', 'db status --cluster',
+          'db backup now'])
+
+    def test_cached(self):
+        for i in range(3):
+            self.assertEquals(self.bevel().complete('db status b'), ['beta'])
+        self.assertEquals(self.runs_so_far(), ['db status'])
+
+    def test_undeclared_ttl(self):
+        self.provider('')
+        for i in range(2):
+            self.assertEquals(self.bevel().complete('db status b'), ['beta'])
+        self.assertEquals(len(self.runs_so_far()), 2)
+
+    def test_timeout(self):
+        self.provider('', delay=5)
+        with patch.object(bevel.providers, 'TIMEOUT', 0.2):
+            now = time.time()
+            self.assertEquals(self.bevel().complete('db status '), [])
+            self.assertTrue(time.time() - now < 2)
+            self.provider('')
+            self.assertEquals(self.bevel().complete('db status '), ['alpha', 'beta', '2'])
+            self.provider('', delay=5)
+            # what was cached, even though it's expired
+            self.assertEquals(self.bevel().complete('db status '), ['alpha', 'beta', '2'])
+
+    def test_eviction(self):
+        cache = ProviderCache(self.cache_dir, max_entries=2)
+        cache.put('a', 1, ['x'])
+        cache.put('b', 2, ['y'])
+        os.utime(cache._file('a'), (0, 0))
+        os.utime(cache._file('b'), (1, 1))
+        self.assertEquals(cache.get('a'), (1, ['x']))
+        cache.put('c', 3, ['z'])
+        self.assertEquals(cache.get('b'), None)
+        self.assertEquals(cache.get('a'), (1, ['x']))
+        self.assertEquals(cache.get('c'), (3, ['z']))
+        self.assertEquals(len(os.listdir(self.cache_dir)), 2)
+
+class MemoTestCases(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tempdir, 'app')
+        self.cache_dir = os.path.join(self.tempdir, 'cache')
+        self.runs = os.path.join(self.tempdir, 'runs')
+        os.mkdir(self.root)
+        self.script('status', '# bevel-memoize: 60\n')
+        self.script('plain', '')
+        super(MemoTestCases, self).setUp()
+
+    def tearDown(self):
+        super(MemoTestCases, self).tearDown()
+        shutil.rmtree(self.tempdir)
+
+    def script(self, name, header, delay=0):
+        path = os.path.join(self.root, name)
+        open(path, 'w').write('#!/bin/sh\n%secho "$@" >> %s\nsleep %s\n'
+          'echo "%s $*"\nexit 3\n' % (header, self.runs, delay, name))
+        os.chmod(path, 0755)
+
+    def bevel(self, **kwargs):
+        kwargs.setdefault('memoize', True)
+        return Bevel(self.root, cache_dir=self.cache_dir, **kwargs)
+
+    def runs_so_far(self):
+        return len(open(self.runs).read().splitlines())
+
+    def test_not_configured(self):
+        bevel = Bevel(self.root, cache_dir=self.cache_dir)
+        for i in range(2):
+            bevel.run('status')
+        self.assertEquals(self.runs_so_far(), 2)
+        # the header isn't even read
+        self.assertEquals(bevel._memo_ttls, {})
+
+    def test_bypassed(self):
+        self.bevel().run('status a')
+        os.environ['BEVEL_NO_MEMOIZE'] = '1'
+        try:
+            self.assertEquals(self.bevel().run('status a'), 3)
+        finally:
+            del os.environ['BEVEL_NO_MEMOIZE']
+        self.assertEquals(self.runs_so_far(), 2)
+        self.bevel().run('status a')
+        self.assertEquals(self.runs_so_far(), 2)
+
+    def test_memoized(self):
+        for i in range(3):
+            self.assertEquals(self.bevel().run('status a'), 3)
+        self.assertEquals(self.runs_so_far(), 1)
+        self.bevel().run('status b')
+        self.assertEquals(self.runs_so_far(), 2)
+        self.assertEquals(self.stdout.get(), 'status a\n' * 3 + 'status b\n')
+        for i in range(2):
+            self.bevel().run('plain')
+        self.assertEquals(self.runs_so_far(), 4)
+
+    def test_bypass_and_invalidation(self):
+        self.bevel().run('status')
+        self.bevel(memoize=False).run('status')
+        self.assertEquals(self.runs_so_far(), 2)
+        self.bevel().run('status')
+        self.assertEquals(self.runs_so_far(), 2)
+        path = os.path.join(self.root, 'status')
+        os.utime(path, (0, 0))
+        self.bevel().run('status')
+        self.assertEquals(self.runs_so_far(), 3)
+
+    @patch('bevel.memo.MAX_OUTPUT', 16)
+    def test_large_output(self):
+        for i in range(2):
+            self.bevel().run('status a')
+        self.bevel().run('status ' + 'x' * 20)
+        self.bevel().run('status ' + 'x' * 20)
+        self.assertEquals(self.runs_so_far(), 3)
+        self.assertEquals(self.stdout.get(), 'status a\n' * 2 + ('status %s\n' % ('x' * 20)) * 2)
+
+    def test_streamed(self):
+        # output is passed through as it's produced, not once the script
+        # has finished
+        path = os.path.join(self.root, 'slow')
+        open(path, 'w').write('#!/bin/sh\n# bevel-memoize: 60\necho first\n'
+          'while [ ! -e %s ]; do sleep 0.01; done\necho second\n' % self.runs)
+        os.chmod(path, 0755)
+        read, write = os.pipe()
+        stdout = os.fdopen(write, 'w')
+        thread = threading.Thread(target=self.bevel()._dispatch, args=('slow',),
+          kwargs={'stdout': stdout})
+        thread.start()
+        try:
+            self.assertTrue(select.select([read], [], [], 10)[0])
+            self.assertEquals(os.read(read, 6), 'first\n')
+        finally:
+            open(self.runs, 'w').close()
+            thread.join()
+            stdout.close()
+        self.assertEquals(os.read(read, 100), 'second\n')
+        os.close(read)
+
+    def test_expiry(self):
+        self.script('status', '# bevel-memoize: 0.2\n')
+        self.bevel().run('status')
+        time.sleep(0.3)
+        self.bevel().run('status')
+        self.assertEquals(self.runs_so_far(), 2)
+        # the expired entry was swept when the new one was written
+        self.assertEquals(len(os.listdir(os.path.join(self.cache_dir, 'output'))), 1)
+
+    def test_no_stampede(self):
+        self.script('status', '# bevel-memoize: 60\n', delay=0.5)
+        env = dict(os.environ, PYTHONPATH=os.getcwd())
+        procs = [ subprocess.Popen([sys.executable, '-c',
+                    'import sys, bevel; bevel.main(sys.argv[1:])', '-b', self.root,
+                    '--cache-dir', self.cache_dir, '--memoize', '-a', 'status x'],
+                    stdout=subprocess.PIPE, env=env) for i in range(5) ]
+        outputs = [ proc.communicate()[0] for proc in procs ]
+        self.assertEquals([ proc.returncode for proc in procs ], [3] * 5)
+        self.assertEquals(outputs, ['status x\n'] * 5)
+        self.assertEquals(self.runs_so_far(), 1)
+        # only the entry is left behind, not the lock
+        self.assertEquals(len(os.listdir(os.path.join(self.cache_dir, 'output'))), 1)
+
+class CompactIndexTestCases(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tempdir, 'app')
+        self.site = os.path.join(self.tempdir, 'site')
+        self.path = os.path.join(self.tempdir, 'app.index')
+        self.script(self.root, '_driver', '')
+        self.script(self.root, 'db/_driver', '')
+        self.script(self.root, 'db/status', '#!/bin/sh\necho status "$@"\n')
+        self.script(self.root, 'db/backup/_driver', '#!/bin/sh\necho backup\n')
+        self.script(self.root, 'db/backup/now', '#!/bin/sh\necho now\n')
+        self.script(self.root, 'hidden/inner', '#!/bin/sh\necho inner\n')
+        for i in range(50):
+            self.script(self.root, 'wide/cmd%d' % i, '#!/bin/sh\necho %d\n' % i)
+        self.script(self.root, 'wide/_driver', '#!/bin/sh\necho wide\n')
+        self.script(self.site, 'db/status', '#!/bin/sh\necho site status\n')
+        super(CompactIndexTestCases, self).setUp()
+
+    def tearDown(self):
+        super(CompactIndexTestCases, self).tearDown()
+        shutil.rmtree(self.tempdir)
+
+    def script(self, layer, rel, body):
+        path = os.path.join(layer, rel)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, 'w').write(body)
+        os.chmod(path, 0755)
+
+    def check(self, bin_dir):
+        index = build_index(Bevel(bin_dir))
+        bevel.compact.write(index, self.path)
+        compact = CompactIndex(self.path)
+        self.assertEquals(compact.fingerprint(), index.fingerprint())
+        self.assertTrue(compact.is_fresh())
+        for args, node in index.nodes.items():
+            self.assertEquals(compact.node(args)[:2], node[:2])
+            self.assertEquals(list(compact.node(args)[2]), node[2])
+            self.assertEquals(compact.subcommands(args), index.subcommands(args))
+            self.assertEquals(compact.layer(args), index.layer(args))
+        for args in (['nope'], ['hidden'], ['db', 'status', 'x'], ['wide', 'cmd50']):
+            self.assertEquals(compact.node(args), None)
+            self.assertEquals(compact.subcommands(args), [])
+        indexed = Bevel(bin_dir, index_file=self.path)
+        plain = Bevel(bin_dir)
+        for line in ('', 'db ', 'db b', 'wide cmd1', 'hidden ', 'hidden/inner'):
+            self.assertEquals(indexed.complete(line), plain.complete(line))
+        lines = ('db status x', 'db backup now', 'hidden inner', 'wide cmd7 y', 'db')
+        for line in lines:
+            indexed.run(line)
+        self.assertEquals(indexed.syscalls, 0)
+        output = self.stdout.get()
+        for line in lines:
+            plain.run(line)
+        self.assertEquals(self.stdout.get(), output * 2)
+        return output
+
+    def test_index(self):
+        output = self.check(self.root)
+        self.assertTrue(output.startswith('status x\nnow\ninner\n7\n'))
+
+    def test_layered(self):
+        output = self.check(os.pathsep.join([self.site, self.root]))
+        self.assertTrue(output.startswith('site status\n'))
+
+    def test_validation(self):
+        bevel.compact.write(build_index(Bevel(self.root)), self.path)
+        compact = CompactIndex(self.path)
+        self.assertTrue(compact.is_current(Bevel(self.root)))
+        self.assertRaises(CompactIndexError, Bevel, self.site, index_file=self.path)
+        self.script(self.root, 'db/create', '#!/bin/sh\n')
+        self.assertFalse(compact.is_fresh())
+        self.assertFalse(compact.is_current(Bevel(self.root)))
+        open(self.path, 'w').write('not an index')
+        self.assertRaises(CompactIndexError, CompactIndex, self.path)
+
+    def test_stale(self):
+        os.mkdir(os.path.join(self.root, 'tools'))
+        bevel.compact.write(build_index(Bevel(self.root)), self.path)
+        # changes off the path of a lookup aren't noticed by it
+        self.script(self.root, 'wide/cmd50', '#!/bin/sh\n')
+        indexed = Bevel(self.root, index_file=self.path)
+        indexed.run('db backup now')
+        self.assertEquals(indexed.tree.rebuilt, None)
+        os.unlink(os.path.join(self.root, 'db', 'status'))
+        self.script(self.root, 'db/create', '#!/bin/sh\necho create\n')
+        indexed = Bevel(self.root, index_file=self.path)
+        indexed.run('db create')
+        indexed.run('db status')
+        self.assertTrue(self.stdout.get().startswith('now\ncreate\nusage: app db'))
+        self.assertEquals(indexed.complete('db '), ['backup', 'create'])
+        self.assertEquals(indexed.complete('wide cmd5'), ['cmd5', 'cmd50'])
+        # a directory which had no commands in it when the index was built
+        self.script(self.root, 'tools/lint', '#!/bin/sh\necho lint\n')
+        indexed = Bevel(self.root, index_file=self.path)
+        indexed.run('tools lint')
+        self.assertTrue(self.stdout.get().endswith('lint\n'))
+        self.assertRaises(CompactIndexError, CompactIndex(self.path).node, ['db'])
+
+    def test_cli(self):
+        def main(*args):
+            try:
+                bevel.main(['-b', self.root] + list(args))
+            except SystemExit, e:
+                return e.code
+        self.assertEquals(main('--build-index', self.path), None)
+        self.assertEquals(main('--index-file', self.path, '--check-index'), None)
+        self.assertEquals(main('--index-file', self.path, '-c', '-a', 'db '), None)
+        self.assertEquals(self.stdout.get(), 'backup\nstatus\n')
+        self.script(self.root, 'db/create', '#!/bin/sh\n')
+        self.assertEquals(main('--index-file', self.path, '--check-index'), 1)
+
+class MetricsTestCases(TestCase):
+    fixture_dir = 'bevel/tests/fixtures/myapplib'
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'metrics')
+        super(MetricsTestCases, self).setUp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        super(MetricsTestCases, self).tearDown()
+
+    def records(self):
+        return [ json.loads(line) for line in open(self.path) ]
+
+    def test_file_sink(self):
+        bevel = Bevel(self.fixture_dir, metrics=Metrics(self.path))
+        bevel.run('hasdriver subcommand')
+        bevel = Bevel(self.tempdir, app_name='empty', metrics=Metrics('file:' + self.path))
+        self.assertRaises(InternalError, bevel.run, 'nonexistent')
+        records = self.records()
+        self.assertEquals(len(records), 2)
+        self.assertEquals(records[0]['command'], ['hasdriver', 'subcommand'])
+        self.assertEquals(records[0]['exit_code'], 0)
+        self.assertEquals(sorted(records[0]['phases']), ['execute', 'parse', 'resolve'])
+        self.assertEquals(records[1]['exit_code'], 1)
+        self.assertTrue('error' in records[1])
+
+    def test_main(self):
+        self.assertRaises(SystemExit, bevel.main,
+          ['--bindir', self.fixture_dir, '--metrics', self.path, '-a', 'hasdriver'])
+        phases = self.records()[0]['phases']
+        for name in ('import', 'startup', 'parse', 'resolve', 'usage', 'execute'):
+            self.assertTrue(name in phases, name)
+
+    def test_unix_sink(self):
+        path = os.path.join(self.tempdir, 'sock')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(path)
+        try:
+            metrics = Metrics('unix:' + path)
+            metrics.emit(exit_code=3)
+            metrics.emit(exit_code=4)
+            sock.setblocking(0)
+            self.assertEquals(json.loads(sock.recv(4096))['exit_code'], 3)
+            self.assertRaises(socket.error, sock.recv, 4096)
+        finally:
+            sock.close()
+        # nobody listening: the record is dropped
+        Metrics('unix:' + path).emit()
+
+    def test_report(self):
+        records = [ {'command': ['a'], 'total': i / 1000.0, 'phases': {'resolve': 0.001}}
+                    for i in range(1, 101) ]
+        aggregated = aggregate(records)
+        self.assertEquals(len(aggregated['a']['total']), 100)
+        self.assertEquals(bevel.metrics.percentile(aggregated['a']['total'], 90), 0.09)
+        stream = StringIO.StringIO()
+        report(aggregated, stream)
+        self.assertTrue('51.0/90.0/99.0' in stream.getvalue())
+
+class BenchmarkTestCases(unittest.TestCase):
+    def test_smoke(self):
+        summary = bench.summarize(bench.run([10], ['wide', 'deep'], 2, 0))
+        self.assertTrue('deep/10/resolve/cold' in summary)
+        self.assertEquals(bench.compare(summary, summary, 0.5, 0), [])
+        slower = dict([ (key, {'p50': item['p50'] * 3 + 1}) for key, item in summary.items() ])
+        self.assertEquals(len(bench.compare(slower, summary, 0.5, 0)), len(summary))
@@ -0,0 +1,318 @@
+"""
+Benchmarks for ``bevel``'s entry points on synthetic command trees.
+
+Each benchmark is timed cold (a fresh ``Bevel`` instance, so nothing is
+memoized) and warm (the same instance, called repeatedly), on trees of
+different sizes and shapes, and reported as percentiles. Results can be saved
+as a baseline, and later runs compared against it::
+
+    $ python -m bevel.tests.bench --save bench-baseline.json
+    $ python -m bevel.tests.bench --baseline bench-baseline.json
+
+Comparing exits non-zero if any benchmark's median got slower than the
+baseline's by more than the tolerance.
+"""
+
+from __future__ import with_statement
+
+import os
+import sys
+import time
+import shutil
+import optparse
+import tempfile
+import subprocess
+
+from bevel import Bevel, _import_json
+from bevel.metrics import percentile
+
+json = _import_json()
+
+def numbered(i):
+    return 'cmd%d' % i
+
+def prefixed(i):
+    """
+    A name like ``svc-kqzfa``, different for each ``i``
+    """
+    n = (i * 2654435761) % 26 ** 5
+    letters = []
+    for j in range(5):
+        n, letter = divmod(n, 26)
+        letters.append(chr(ord('a') + letter))
+    return 'svc-' + ''.join(letters)
+
+SHAPES = {
+    # (fanout, whether drivers are empty, how commands are named)
+    'wide': (None, False, numbered),
+    'deep': (4, False, numbered),
+    'empty': (4, True, numbered),
+    # siblings which all share a prefix, the worst case for suggestions
+    'prefixed': (None, False, prefixed),
+}
+ENTRY_POINTS = ['resolve', 'resolve-indexed', 'resolve-compact', 'subcommands', 'complete', 'suggest',
+                'suggest-indexed', 'verify', 'run']
+CLI_ENTRY_POINTS = ['main-import', 'main-complete', 'main-run']
+
+def make_tree(root, commands, fanout=None, empty_drivers=False, naming=numbered):
+    """
+    Generate a balanced tree under ``root`` with ``commands`` leaf commands,
+    where each parent has ``fanout`` subcommands (``None`` puts every command
+    directly under the root), and the ``i``th subcommand of each is called
+    ``naming(i)``. Returns the args of the deepest leaf and of the widest
+    parent.
+    """
+    fanout = fanout or max(commands, 1)
+    driver = empty_drivers and '' or '#!/bin/sh\necho usage\n'
+    leaf = '#!/bin/sh\nexit 0\n'
+
+    def script(path, body):
+        open(path, 'w').write(body)
+        os.chmod(path, 0755)
+
+    # how many levels of parents are needed to hold ``commands`` leaves
+    depth = 0
+    while fanout ** (depth + 1) < commands:
+        depth += 1
+
+    made = [0]
+    deepest = [[]]
+
+    def populate(path, args, level):
+        os.mkdir(path)
+        script(os.path.join(path, '_driver'), driver)
+        for i in range(fanout):
+            if made[0] >= commands:
+                return
+            command = naming(i)
+            if level < depth:
+                populate(os.path.join(path, command), args + [command], level + 1)
+            else:
+                script(os.path.join(path, command), leaf)
+                made[0] += 1
+                if len(args) + 1 > len(deepest[0]):
+                    deepest[0] = args + [command]
+
+    populate(root, [], 0)
+    return deepest[0], deepest[0][:-1]
+
+def measure(func, repeat, cold, make_app):
+    timings = []
+    app = make_app()
+    for i in range(repeat):
+        if cold:
+            app = make_app()
+        now = time.time()
+        func(app)
+        timings.append(time.time() - now)
+    return timings
+
+class _Devnull(object):
+    """
+    Point ``sys.stdout`` at ``/dev/null`` while running commands
+    """
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *exc):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+def add_latency(seconds):
+    """
+    Simulate slow (e.g. network) storage by delaying every ``stat``,
+    ``access`` and directory listing
+    """
+    def slow(func):
+        def wrapper(*args, **kwargs):
+            time.sleep(seconds)
+            return func(*args, **kwargs)
+        return wrapper
+    os.stat = slow(os.stat)
+    os.access = slow(os.access)
+    os.listdir = slow(os.listdir)
+
+def typo(word):
+    """
+    ``word`` with its last but one character doubled
+    """
+    return word[:-1] + word[-2:]
+
+def bench_tree(root, size, deepest, widest, repeat, cache_dir, naming=numbered):
+    leaf_args = ' '.join(deepest + ['extra', 'args'])
+    complete_args = ' '.join(widest + [naming(1)])
+    typo_args = ' '.join(widest + [typo(naming(1))])
+    benchmarks = {
+        'resolve': lambda app: app._resolve_args(deepest + ['extra', 'args']),
+        'subcommands': lambda app: app._subcommands(widest),
+        'complete': lambda app: app.complete(complete_args),
+        'suggest': lambda app: app.suggest(typo_args),
+        'verify': lambda app: app._verify(),
+        'run': lambda app: app.run(leaf_args),
+    }
+    benchmarks['resolve-indexed'] = benchmarks['resolve']
+    benchmarks['resolve-compact'] = benchmarks['resolve']
+    benchmarks['suggest-indexed'] = benchmarks['suggest']
+    index_file = os.path.join(cache_dir, 'compact.index')
+    from bevel.compact import write
+    from bevel.index import build_index
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    write(build_index(Bevel(root)), index_file)
+    results = {}
+    for name in ENTRY_POINTS:
+        if name == 'verify' and size > 10000:
+            continue
+        if name in ('resolve-indexed', 'suggest-indexed'):
+            make_app = lambda: Bevel(root, cache_dir=cache_dir)
+        elif name == 'resolve-compact':
+            make_app = lambda: Bevel(root, index_file=index_file)
+        else:
+            make_app = lambda: Bevel(root)
+        for mode in ('cold', 'warm'):
+            with _Devnull():
+                results[(name, mode)] = measure(benchmarks[name],
+                  name == 'verify' and max(1, repeat // 10) or repeat,
+                  mode == 'cold', make_app)
+    return results
+
+def bench_cli(root, deepest, widest, repeat, naming=numbered):
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(
+      os.path.dirname(os.path.abspath(__file__)))))
+    env.pop('BEVEL_DEBUG', None)
+    code = 'import sys, bevel; bevel.main(sys.argv[1:])'
+    commands = {
+        'main-import': ['-c', 'import bevel'],
+        'main-complete': ['-c', code, '-b', root, '-c', '-a', ' '.join(widest + [naming(1)])],
+        'main-run': ['-c', code, '-b', root, '-a', ' '.join(deepest)],
+    }
+    results = {}
+    devnull = open(os.devnull, 'w')
+    try:
+        for name in CLI_ENTRY_POINTS:
+            timings = []
+            for i in range(repeat):
+                now = time.time()
+                subprocess.call([sys.executable] + commands[name],
+                  stdout=devnull, env=env)
+                timings.append(time.time() - now)
+            results[(name, 'cold')] = timings
+    finally:
+        devnull.close()
+    return results
+
+def run(sizes, shapes, repeat, cli_repeat):
+    """
+    Run every benchmark, returning ``{key: timings}`` where ``key`` is
+    ``shape/size/entry point/mode``
+    """
+    results = {}
+    tempdir = tempfile.mkdtemp()
+    try:
+        for shape in shapes:
+            fanout, empty, naming = SHAPES[shape]
+            for size in sizes:
+                root = os.path.join(tempdir, '%s%d' % (shape, size))
+                cache_dir = os.path.join(tempdir, 'cache')
+                deepest, widest = make_tree(root, size, fanout, empty, naming)
+                found = bench_tree(root, size, deepest, widest, repeat, cache_dir, naming)
+                if cli_repeat:
+                    found.update(bench_cli(root, deepest, widest, cli_repeat, naming))
+                for (name, mode), timings in found.items():
+                    results['%s/%d/%s/%s' % (shape, size, name, mode)] = timings
+    finally:
+        shutil.rmtree(tempdir)
+    return results
+
+def summarize(results):
+    return dict([ (key, {
+        'p50': percentile(timings, 50),
+        'p90': percentile(timings, 90),
+        'p99': percentile(timings, 99),
+    }) for key, timings in results.items() ])
+
+def report(summary, stream=sys.stdout):
+    stream.write('%-40s %10s %10s %10s\n' % ('benchmark', 'p50 (ms)', 'p90 (ms)', 'p99 (ms)'))
+    keys = summary.keys()
+    keys.sort()
+    for key in keys:
+        item = summary[key]
+        stream.write('%-40s %10.3f %10.3f %10.3f\n' % (key, item['p50'] * 1000,
+          item['p90'] * 1000, item['p99'] * 1000))
+
+def compare(summary, baseline, tolerance, floor):
+    """
+    Benchmarks whose median is more than ``tolerance`` (a fraction) and
+    ``floor`` (seconds) slower than in ``baseline``
+    """
+    regressions = []
+    for key, item in summary.items():
+        if key not in baseline:
+            continue
+        before, after = baseline[key]['p50'], item['p50']
+        if after > before * (1 + tolerance) and after - before > floor:
+            regressions.append((key, before, after))
+    regressions.sort()
+    return regressions
+
+def create_cli():
+    cli = optparse.OptionParser(prog='python -m bevel.tests.bench')
+    cli.add_option('-s', '--sizes', default='10,1000,10000',
+        help="Comma-separated numbers of commands per tree (default: %default)")
+    cli.add_option('--shapes', default=','.join(sorted(SHAPES)),
+        help="Comma-separated tree shapes (default: %default)")
+    cli.add_option('-n', '--repeat', type='int', default=20,
+        help="Timings per benchmark (default: %default)")
+    cli.add_option('--cli-repeat', type='int', default=5,
+        help="Timings per CLI startup benchmark, 0 to skip (default: %default)")
+    cli.add_option('--latency', type='float', default=0,
+        help="Milliseconds of simulated filesystem latency per call")
+    cli.add_option('--save', metavar='FILE',
+        help="Save the results as a baseline")
+    cli.add_option('--baseline', metavar='FILE',
+        help="Compare the results against a baseline")
+    cli.add_option('--tolerance', type='float', default=0.5,
+        help="Allowed slowdown as a fraction of the baseline (default: %default)")
+    cli.add_option('--floor', type='float', default=0.5,
+        help="Ignore slowdowns smaller than this many milliseconds (default: %default)")
+    return cli
+
+def main(argv=None):
+    cli = create_cli()
+    opts, args = cli.parse_args(argv)
+    if json is None and (opts.save or opts.baseline):
+        cli.error('saving or comparing baselines needs json or simplejson')
+    if opts.latency:
+        add_latency(opts.latency / 1000.0)
+    sizes = [ int(i) for i in opts.sizes.split(',') ]
+    shapes = opts.shapes.split(',')
+    for shape in shapes:
+        if shape not in SHAPES:
+            cli.error('unknown shape "%s"' % shape)
+
+    summary = summarize(run(sizes, shapes, opts.repeat, opts.cli_repeat))
+    report(summary)
+
+    if opts.save:
+        fd = open(opts.save, 'w')
+        try:
+            json.dump(summary, fd, indent=2, sort_keys=True)
+        finally:
+            fd.close()
+
+    if opts.baseline:
+        fd = open(opts.baseline)
+        try:
+            baseline = json.load(fd)
+        finally:
+            fd.close()
+        regressions = compare(summary, baseline, opts.tolerance, opts.floor / 1000.0)
+        for key, before, after in regressions:
+            sys.stderr.write('regression: %s went from %.3fms to %.3fms\n' % (
+              key, before * 1000, after * 1000))
+        if regressions:
+            raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,438 @@
+"""
+A resident "zygote" server which runs ``bevel`` commands in forks of itself.
+
+Most of the cost of a short command is ``bevel`` starting up: the interpreter,
+imports, option parsing and looking up the tree. The zygote pays that once. It
+keeps the tree model in memory (following changes through inotify where
+available, and checking directory mtimes otherwise) and listens on a per-user
+Unix socket. ``bevel-run`` is the matching client: it sends its arguments,
+environment and working directory, and passes its stdin, stdout and stderr
+over the socket (``SCM_RIGHTS``). The server forks a worker which takes on
+those, runs the command just like ``Bevel.run`` would and reports the exit
+code back, which the client exits with.
+
+Before forking, the server brings its model up to date. If the tree's
+fingerprint changed since the last request (or the client is a different
+version of ``bevel``), the server refuses the request and the client falls
+back to running the command itself, as it does when no server is listening.
+"""
+
+import os
+import sys
+import time
+import errno
+import signal
+import socket
+import select
+import struct
+import SocketServer
+
+from bevel.client import CLIENT_TIMEOUT, socket_path
+from bevel.server import _ensure_socket_dir, _is_listening, _exit, \
+  is_private_dir, peer_uid
+
+PROTOCOL = 2
+# resource limits which workers take on from their clients
+RLIMITS = ['RLIMIT_AS', 'RLIMIT_CORE', 'RLIMIT_CPU', 'RLIMIT_DATA',
+           'RLIMIT_FSIZE', 'RLIMIT_NOFILE', 'RLIMIT_NPROC', 'RLIMIT_STACK']
+# requests (mostly the environment) bigger than this are refused
+MAX_REQUEST = 1024 * 1024
+_LENGTH = struct.Struct('>I')
+
+class Fallback(Exception):
+    """
+    The server can't run the command, and the client should run it itself
+    """
+
+def _import_fd_passing():
+    try:
+        import _multiprocessing
+        return _multiprocessing.sendfd, _multiprocessing.recvfd
+    except (ImportError, AttributeError):
+        return None
+
+def _dumps(data):
+    from bevel import _import_json
+    return _import_json().dumps(data)
+
+def _loads(data):
+    from bevel import _import_json
+    return _import_json().loads(data)
+
+# strings go over the wire as latin-1 decoded unicode, which JSON can carry
+# and which round-trips any bytes (unlike paths or environments assumed to
+# be UTF-8)
+def _wire(value):
+    return value.decode('latin-1')
+
+def _unwire(value):
+    return value.encode('latin-1')
+
+def _send(sock, data):
+    data = _dumps(data)
+    sock.sendall(_LENGTH.pack(len(data)) + data)
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise socket.error(errno.ECONNRESET, 'connection closed')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+def _recv(sock):
+    size = _LENGTH.unpack(_recv_exactly(sock, _LENGTH.size))[0]
+    if size > MAX_REQUEST:
+        raise ValueError('message too large (%d bytes)' % size)
+    return _loads(_recv_exactly(sock, size))
+
+def _identity(bin_dir):
+    """
+    What a client and server have to agree on before a command is run
+    """
+    from bevel import __version__
+    from bevel.client import _root
+    return {'protocol': PROTOCOL, 'bevel': _wire(__version__),
+            'bin_dir': _wire(_root(bin_dir))}
+
+class ZygoteServer(SocketServer.UnixStreamServer):
+    """
+    Run commands for ``app`` (a ``Bevel`` instance, whose bin directory
+    should be absolute, since workers change to the client's working
+    directory) on ``path``
+    """
+    def __init__(self, app, path):
+        fd_passing = _import_fd_passing()
+        if fd_passing is None:
+            raise RuntimeError('passing file descriptors is not supported here')
+        self._recvfd = fd_passing[1]
+        from bevel.index import build_index
+        from bevel.live import LiveIndex, available
+        self._build_index = build_index
+        self.app = app
+        self.identity = _identity(app.bin_dir)
+        self.live = isinstance(app.tree, LiveIndex)
+        if app.tree is None:
+            if available() and len(app.layers) == 1:
+                app.tree = LiveIndex(app)
+                self.live = True
+            else:
+                app.tree = build_index(app)
+        self.fingerprint = app.tree.fingerprint()
+        # what every worker needs, imported once rather than in each of them
+        import shlex
+        import subprocess
+        import resource
+        import traceback
+        import bevel.memo
+        import bevel.metrics
+        import bevel.rusage
+        _ensure_socket_dir(path)
+        if _is_listening(path):
+            raise RuntimeError('a server is already listening on "%s"' % path)
+        if os.path.exists(path):
+            os.unlink(path)
+        SocketServer.UnixStreamServer.__init__(self, path, None)
+
+    def refresh(self):
+        """
+        Bring the tree model up to date, returning whether its fingerprint
+        is unchanged
+        """
+        tree = self.app.tree
+        if self.live:
+            changed = tree.update()
+        elif tree.is_fresh():
+            changed = False
+        else:
+            self.app.tree = self._build_index(self.app)
+            changed = True
+        if not changed:
+            return True
+        self.app.clear_cache()
+        before, self.fingerprint = self.fingerprint, self.app.tree.fingerprint()
+        return before == self.fingerprint
+
+    def process_request(self, request, client_address):
+        arrived = time.time()
+        fds = []
+        try:
+            try:
+                request.settimeout(CLIENT_TIMEOUT)
+                header = _recv(request)
+                for i in range(3):
+                    # the socket is non-blocking (it has a timeout), which
+                    # ``recvfd`` doesn't know about
+                    if not select.select([request], [], [], CLIENT_TIMEOUT)[0]:
+                        raise socket.error(errno.ETIMEDOUT, 'timed out')
+                    fds.append(self._recvfd(request.fileno()))
+                reason = self._refuse(header)
+                uid = peer_uid(request)
+                if uid is not None and uid != os.getuid():
+                    reason = 'mismatch'
+                if reason is not None:
+                    _send(request, {'status': reason, 'fingerprint': self.fingerprint})
+                    request.shutdown(socket.SHUT_RDWR)
+                    return
+                pid = os.fork()
+                if pid == 0:
+                    code = 1
+                    try:
+                        code = self._work(request, header, fds, arrived)
+                    finally:
+                        os._exit(code)
+            except (socket.error, OSError, ValueError, TypeError, KeyError):
+                self.handle_error(request, client_address)
+        finally:
+            for fd in fds:
+                os.close(fd)
+            # the worker's copy of the connection must stay up, so it's only
+            # closed here rather than shut down
+            self.close_request(request)
+
+    def _refuse(self, header):
+        """
+        Why the server won't run the command in ``header`` (``None`` if it
+        will)
+        """
+        for key, value in self.identity.items():
+            if header.get(key) != value:
+                return 'mismatch'
+        for key in ('args', 'cwd', 'env', 'umask', 'rlimits'):
+            if key not in header:
+                return 'mismatch'
+        if not self.refresh():
+            return 'stale'
+        return None
+
+    def _work(self, request, header, fds, arrived):
+        """
+        Run the command in ``header`` in a freshly forked worker, on the
+        client's file descriptors ``fds``, and return the worker's exit code.
+        The request arrived at ``arrived``.
+        """
+        from bevel import InternalError
+        from bevel.index import TreeIndex
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        # the client forwards signals to the worker's whole process group, and
+        # hands it the terminal if it has one
+        os.setpgrp()
+        self.socket.close()
+        tree = self.app.tree
+        if self.live:
+            # only the server should consume the tree's change events
+            self.app.tree = TreeIndex(tree.bin_dir, tree.nodes, tree.mtimes)
+        request.settimeout(None)
+        _send(request, {'status': 'ok', 'pid': os.getpid(),
+                        'fingerprint': self.fingerprint})
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for target, fd in enumerate(fds):
+            os.dup2(fd, target)
+        sys.stdout = os.fdopen(1, 'w')
+        sys.stderr = os.fdopen(2, 'w', 0)
+        os.chdir(_unwire(header['cwd']))
+        os.umask(header['umask'])
+        _set_rlimits(header['rlimits'])
+        os.environ.clear()
+        for key, value in header['env'].items():
+            os.environ[_unwire(key)] = _unwire(value)
+        if self.app.metrics is not None:
+            # timed from the request, not from when the server started
+            from bevel.metrics import Metrics
+            metrics = Metrics(self.app.metrics.sink)
+            metrics.started = metrics.last = arrived
+            metrics.set(app=self.app.name)
+            metrics.lap('startup')
+            self.app.metrics = metrics
+
+        try:
+            code = self.app.run(_unwire(header['args']))
+        except InternalError, e:
+            sys.stderr.write("%s: internal error: %s\n" % (self.app.name, e.args[0]))
+            code = 1
+        except:
+            import traceback
+            traceback.print_exc()
+            code = 1
+        sys.stdout.flush()
+        _send(request, {'exit_code': code})
+        return 0
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        if self.live:
+            self.app.tree.close()
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+def _get_rlimits():
+    import resource
+    limits = {}
+    for name in RLIMITS:
+        if hasattr(resource, name):
+            limits[name] = list(resource.getrlimit(getattr(resource, name)))
+    return limits
+
+def _set_rlimits(limits):
+    # limits the worker isn't allowed to take on (e.g. a hard limit above its
+    # own) are left alone
+    import resource
+    for name, (soft, hard) in limits.items():
+        if name in RLIMITS and hasattr(resource, name):
+            try:
+                resource.setrlimit(getattr(resource, name), (soft, hard))
+            except (ValueError, resource.error):
+                pass
+
+def _umask():
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+def serve_runs(app):
+    server = ZygoteServer(app, socket_path(app.bin_dir, 'run'))
+    # workers are never waited on, so have the kernel reap them
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, _exit)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+def request_run(path, bin_dir, args):
+    """
+    Ask the server on ``path`` to run ``args`` (a command line) on this
+    process' stdin, stdout and stderr, and return the command's exit code.
+    Raises ``socket.error`` if no server is listening, and ``Fallback`` if it
+    won't run the command.
+    """
+    fd_passing = _import_fd_passing()
+    if fd_passing is None:
+        raise Fallback('passing file descriptors is not supported here')
+    sendfd = fd_passing[0]
+    # the environment and terminal only go to a server this user started
+    if not is_private_dir(os.path.dirname(path)):
+        raise Fallback('the socket directory "%s" is not private' % os.path.dirname(path))
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(CLIENT_TIMEOUT)
+        sock.connect(path)
+        uid = peer_uid(sock)
+        if uid is not None and uid != os.getuid():
+            raise Fallback('the server belongs to another user (uid %d)' % uid)
+        header = _identity(bin_dir)
+        env = dict([ (_wire(key), _wire(value)) for key, value in os.environ.items() ])
+        header.update({'args': _wire(args), 'cwd': _wire(os.getcwd()), 'env': env,
+                       'umask': _umask(), 'rlimits': _get_rlimits()})
+        _send(sock, header)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        try:
+            for fd in (0, 1, 2):
+                sendfd(sock.fileno(), fd)
+        except OSError, e:
+            raise Fallback('could not pass file descriptors: %s' % e)
+        try:
+            reply = _recv(sock)
+        except socket.error:
+            raise Fallback('the server hung up')
+        if reply.get('status') != 'ok':
+            raise Fallback('the server refused the command (%s)' % reply.get('status'))
+
+        # from here on the command is running, so it can't be retried
+        pid = reply['pid']
+
+        def forward(signum, frame):
+            try:
+                os.killpg(pid, signum)
+            except OSError:
+                pass
+        for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP, signal.SIGQUIT):
+            signal.signal(signum, forward)
+        terminal = _hand_terminal(pid)
+        try:
+            sock.settimeout(None)
+            while True:
+                try:
+                    reply = _recv(sock)
+                    break
+                except socket.error, e:
+                    if e.args[0] != errno.EINTR:
+                        sys.stderr.write('bevel-run: lost the connection to the '
+                                         'server: %s\n' % e)
+                        return 1
+        finally:
+            if terminal is not None:
+                try:
+                    _set_foreground(terminal, os.getpgrp())
+                except OSError:
+                    pass
+        return reply['exit_code']
+    finally:
+        sock.close()
+
+def _hand_terminal(pgrp):
+    """
+    Make ``pgrp`` (the worker's process group) the foreground process group
+    of the client's terminal, if the client is in the foreground of one, so
+    that the command can read from it (rather than being stopped by
+    ``SIGTTIN``). Returns the terminal's file descriptor, or ``None`` if it
+    wasn't handed over.
+    """
+    for fd in (0, 1, 2):
+        try:
+            if os.isatty(fd) and os.tcgetpgrp(fd) == os.getpgrp():
+                break
+        except OSError:
+            pass
+    else:
+        return None
+    try:
+        _set_foreground(fd, pgrp)
+    except OSError:
+        # e.g. a server started in another session, whose workers the
+        # terminal doesn't stop anyway
+        return None
+    # the command may already have been stopped trying to use the terminal
+    try:
+        os.killpg(pgrp, signal.SIGCONT)
+    except OSError:
+        pass
+    return fd
+
+def _set_foreground(fd, pgrp):
+    # a background process taking the terminal back would otherwise be
+    # stopped by ``SIGTTOU``
+    handler = signal.signal(signal.SIGTTOU, signal.SIG_IGN)
+    try:
+        os.tcsetpgrp(fd, pgrp)
+    finally:
+        signal.signal(signal.SIGTTOU, handler)
+
+def run_client(argv=None):
+    """
+    Entry point for ``bevel-run BINDIR [ARGS...]``
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    if not argv:
+        sys.stderr.write('usage: bevel-run BINDIR [ARGS...]\n')
+        raise SystemExit(2)
+    from bevel.shell import quote
+    bin_dir = argv[0]
+    args = ' '.join([ quote(arg) for arg in argv[1:] ])
+    try:
+        code = request_run(socket_path(bin_dir, 'run'), bin_dir, args)
+    except (socket.error, Fallback):
+        from bevel import main
+        main(['--bindir', bin_dir, '--args', args])
+    else:
+        raise SystemExit(code)
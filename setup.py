@@ -7,7 +7,7 @@ setup(
   version=bevel.__version__,
   author=bevel.__author__,
   url='https://github.com/jcmcken/bevel',
-  scripts=['bin/bevel'],
+  scripts=['bin/bevel', 'bin/bevel-complete', 'bin/bevel-run'],
   packages=['bevel'],
   classifiers=[
     'Topic :: Utilities',